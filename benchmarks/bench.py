@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+'''
+End to end benchmarks of the cloudland client against a local fake.
+
+Each benchmark runs a number of iterations against cloudlandclient.fake
+and reports throughput with p50/p99 latency. Results are saved as JSON
+so runs of different versions can be compared:
+
+    python benchmarks/bench.py --output before.json
+    python benchmarks/bench.py --compare before.json
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import cloudlandclient  # noqa
+from cloudlandclient.client import CloudlandClient  # noqa
+from cloudlandclient.download import Downloader  # noqa
+from cloudlandclient.fake import FakeCloudland  # noqa
+from cloudlandclient import models  # noqa
+from cloudlandclient import utils  # noqa
+
+
+class BenchClient(CloudlandClient):
+    '''Keeps its cookies in the benchmark's scratch directory.'''
+    scratch = None
+
+    @property
+    def cpath(self):
+        return os.path.join(self.scratch, 'cloudland.cookies')
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def measure(name, iterations, func, items=1):
+    '''Time iterations calls of func, each handling items operations.'''
+    samples = []
+    start = time.time()
+    for _ in range(iterations):
+        begin = time.time()
+        func()
+        samples.append(time.time() - begin)
+    total = time.time() - start
+    result = {'name': name,
+              'iterations': iterations,
+              'ops_per_second': iterations * items / total if total else 0,
+              'p50': percentile(samples, 0.5),
+              'p99': percentile(samples, 0.99)}
+    print('%-28s %10.1f ops/s  p50 %8.2fms  p99 %8.2fms' % (
+        name, result['ops_per_second'], result['p50'] * 1000,
+        result['p99'] * 1000))
+    return result
+
+
+def run(args):
+    scratch = tempfile.mkdtemp(prefix='cloudland-bench-')
+    BenchClient.scratch = scratch
+    results = []
+    try:
+        with FakeCloudland(vms=args.vms, latency=args.latency,
+                           snapshot_size=args.snapshot_size) as fake:
+            cookies = os.path.join(scratch, 'cloudland.cookies')
+
+            def login():
+                if os.path.exists(cookies):
+                    os.remove(cookies)
+                BenchClient(fake.endpoint, 'bench', 'secret').close()
+            results.append(measure('login', args.iterations, login))
+
+            client = BenchClient(fake.endpoint, 'bench', 'secret')
+            body = client.vm_list()
+            results.append(measure(
+                'vm_list (%d rows)' % args.vms, args.iterations,
+                client.vm_list))
+            results.append(measure(
+                'utils.loads (%d rows)' % args.vms, args.iterations,
+                lambda: utils.loads(body)))
+            results.append(measure(
+                'utils.iterloads (%d rows)' % args.vms, args.iterations,
+                lambda: list(utils.iterloads([body]))))
+            results.append(measure(
+                'records vm (%d rows)' % args.vms, args.iterations,
+                lambda: client.records('vm')))
+            results.append(measure(
+                'inventory vm (%d rows)' % args.vms, args.iterations,
+                lambda: client.inventory('vm')))
+
+            results.append(measure(
+                'vm_create', args.iterations,
+                lambda: client.vm_create('image-0', 5000)))
+            results.append(measure(
+                'vm_create_many (x%d)' % args.batch, 1,
+                lambda: client.vm_create_many('image-0', 5000,
+                                              count=args.batch,
+                                              concurrency=args.concurrency),
+                items=args.batch))
+
+            devnull = open(os.devnull, 'w')
+            stdout = sys.stdout
+            lines = utils.loads(body)
+
+            def render(format):
+                sys.stdout = devnull
+                try:
+                    utils.output(models.VM.head, lines, format)
+                finally:
+                    sys.stdout = stdout
+            for format in utils.FORMATS:
+                results.append(measure(
+                    '%s render (%d rows)' % (format, args.vms),
+                    max(1, args.iterations // 10),
+                    lambda: render(format)))
+            devnull.close()
+
+            uri = utils.loads(client.snapshot_download('snap-0'))[0]
+            target = os.path.join(scratch, 'snapshot.qcow2')
+
+            def download(connections):
+                if os.path.exists(target):
+                    os.remove(target)
+                Downloader(session=client.session, connections=connections,
+                           quiet=True).fetch(uri, target)
+            for connections in (1, 4):
+                results.append(measure(
+                    'snapshot download x%d (%dM)' % (
+                        connections, args.snapshot_size // (1024 * 1024)),
+                    max(1, args.iterations // 10),
+                    lambda: download(connections)))
+            client.close()
+
+            # Cold start of the CLI, each run a new interpreter.
+            env = dict(os.environ, CLOUDLAND_ENDPOINT=fake.endpoint,
+                       CLOUDLAND_USERNAME='bench',
+                       CLOUDLAND_PASSWORD='secret', TMPDIR=scratch)
+            root = os.path.join(os.path.dirname(__file__), '..')
+            env['PYTHONPATH'] = os.pathsep.join(
+                [root] + env.get('PYTHONPATH', '').split(os.pathsep))
+
+            def python(*argv):
+                with open(os.devnull, 'w') as devnull:
+                    subprocess.check_call([sys.executable] + list(argv),
+                                          env=env, stdout=devnull)
+
+            def cli(*argv):
+                python('-m', 'cloudlandclient.shell', *argv)
+            startup = max(1, args.iterations // 5)
+            results.append(measure('cli import', startup, lambda: python(
+                '-c', 'import cloudlandclient.shell')))
+            results.append(measure('cli help vm-list', startup,
+                                   lambda: cli('help', 'vm-list')))
+            results.append(measure('cli vm-list', startup,
+                                   lambda: cli('vm-list')))
+    finally:
+        shutil.rmtree(scratch)
+    return results
+
+
+def compare(results, previous):
+    before = dict((result['name'], result) for result in previous['results'])
+    print('\n%-28s %10s %10s %8s' % ('', 'before', 'after', 'change'))
+    for result in results:
+        old = before.get(result['name'])
+        if not old or not old['ops_per_second']:
+            continue
+        change = result['ops_per_second'] / old['ops_per_second'] - 1
+        print('%-28s %10.1f %10.1f %+7.1f%%' % (
+            result['name'], old['ops_per_second'], result['ops_per_second'],
+            change * 100))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n')[0])
+    parser.add_argument('--vms', type=int, default=10000,
+                        help='VMs in the fake inventory.')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds the fake server waits per request.')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--batch', type=int, default=200,
+                        help='VMs created by the vm_create_many run.')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--snapshot-size', type=int,
+                        default=64 * 1024 * 1024)
+    parser.add_argument('--output', help='Save the results to this file.')
+    parser.add_argument('--compare',
+                        help='Compare with results saved by --output.')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    record = {'version': cloudlandclient.version_string(),
+              'time': time.time(),
+              'python': platform.python_version(),
+              'options': vars(args),
+              'results': results}
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(record, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
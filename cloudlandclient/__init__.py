@@ -1,4 +1,20 @@
-import pbr.version
+def version_string():
+    '''The installed version, resolved through pbr.
 
-__version__ = pbr.version.VersionInfo(
-    'python-cloudlandclient').version_string()
+    Resolving it is slow, so it is left to code that asks for it, such
+    as "cloudland --version", instead of being done on import.
+    '''
+    import pbr.version
+    return pbr.version.VersionInfo(
+        'python-cloudlandclient').version_string()
+
+
+def __getattr__(name):
+    # Keeps cloudlandclient.__version__ working lazily where module
+    # __getattr__ is supported, Python 3.7 and later; other code calls
+    # version_string().
+    if name == '__version__':
+        version = version_string()
+        globals()['__version__'] = version
+        return version
+    raise AttributeError(name)
@@ -0,0 +1,460 @@
+'''
+asyncio client for cloudland, built on aiohttp.
+
+AsyncCloudlandClient has the plain API calls of CloudlandClient as
+coroutines: the *_list, *_show, *_create, *_delete, *_attach and
+*_detach calls, snapshot_download, vm_create_many and the image and VLAN
+catalog. It shares the cookie file of the blocking client, so either one
+can reuse a session the other logged in, and like it logs in again and
+replays a call answered with the login page.
+
+The rest of CloudlandClient is not here: records, inventory, iter_list,
+resolve, wait_for, watch, the other *_many calls, image_upload,
+snapshot_mirror, hooks, the retry policy and coalescing. Requests fail on
+the first error, after timeout seconds in all.
+'''
+
+import asyncio
+import logging
+import time
+
+import aiohttp
+from requests.cookies import cookiejar_from_dict
+
+from cloudlandclient import bulk
+from cloudlandclient.client import CookieFileMixin
+from cloudlandclient.client import listed
+from cloudlandclient.client import login_data
+from cloudlandclient.client import LOGIN_REQUIRED
+from cloudlandclient.client import PRIMED_TTL
+from cloudlandclient.exc import ImageNotExist
+from cloudlandclient.exc import VlanNotExist
+from cloudlandclient import utils
+
+
+logger = logging.getLogger(__name__)
+
+
+class Response(object):
+    '''The parts of an aiohttp response the client uses, fully read.'''
+    __slots__ = ('status', 'headers', 'text', 'cookies')
+
+    def __init__(self, status, headers, text, cookies):
+        self.status = status
+        self.headers = headers
+        self.text = text
+        self.cookies = cookies
+
+
+def _encode(fields):
+    # requests drops None and stringifies the rest; aiohttp does neither.
+    return dict((k, str(v)) for k, v in fields.items() if v is not None)
+
+
+class AsyncCloudlandClient(CookieFileMixin):
+    '''Asyncio counterpart of CloudlandClient.
+
+    Use as "async with AsyncCloudlandClient(...) as client", or await
+    login() before the first call and close() after the last.
+    '''
+
+    def __init__(self, endpoint, username, password,
+                 pool_maxsize=100, pool_per_host=0, keep_alive=True,
+                 timeout=60, session_ttl=300, probe_action='get_link_list',
+                 catalog_ttl=60):
+        self.endpoint = endpoint
+        self.username = username
+        self.password = password
+        self.cookies = None
+        self.session_ttl = session_ttl
+        self.probe_action = probe_action
+        self.validated = 0
+        # Counts logins, as in CloudlandClient.
+        self.generation = 0
+        self._login_lock = None
+        self._primed = {}
+        self.catalog_ttl = catalog_ttl
+        self._catalog = {}
+        self._catalog_lock = None
+        self.pool_maxsize = pool_maxsize
+        self.pool_per_host = pool_per_host
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.session = None
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _session(self):
+        # aiohttp sessions must be created inside the running loop.
+        if self.session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_maxsize,
+                limit_per_host=self.pool_per_host,
+                force_close=not self.keep_alive)
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _cookies(self):
+        if not self.cookies:
+            return None
+        return dict((cookie.name, cookie.value) for cookie in self.cookies)
+
+    async def _request(self, method, **kwargs):
+        async with self._session().request(
+                method, self.endpoint, cookies=self._cookies(),
+                **kwargs) as r:
+            text = await r.text()
+            result = Response(r.status, r.headers, text, cookiejar_from_dict(
+                dict((k, v.value) for k, v in r.cookies.items())))
+        logger.info(text)
+        return result
+
+    async def post(self, data):
+        logger.info(data)
+        login = data.get('op') == 'login'
+        try:
+            for attempt in range(2):
+                generation = self.generation
+                r = await self._request('POST', data=_encode(data))
+                # Only the login page came back, so replaying is safe.
+                if login or attempt or LOGIN_REQUIRED not in r.text:
+                    return r
+                await self.relogin(generation)
+        finally:
+            # The probe's response predates the change.
+            self._primed.clear()
+
+    async def get(self, params, relogin=True):
+        if len(params) == 1:
+            primed = self._primed.pop(params.get('action'), None)
+            if primed is not None and primed[0] > time.time():
+                return primed[1]
+        logger.info(params)
+        for attempt in range(2):
+            generation = self.generation
+            r = await self._request('GET', params=_encode(params))
+            if not relogin or attempt or LOGIN_REQUIRED not in r.text:
+                return r
+            await self.relogin(generation)
+
+    async def probe(self):
+        r = await self.get(params={'action': self.probe_action},
+                           relogin=False)
+        if LOGIN_REQUIRED in r.text:
+            return False
+        if not listed(r.status, r.text):
+            return True
+        self._primed[self.probe_action] = (time.time() + PRIMED_TTL, r)
+        self.validated = time.time()
+        self.dump_cookies()
+        return True
+
+    async def test_cookies(self, cookies):
+        self.cookies = cookies
+        if not cookies:
+            return False
+        if self.session_fresh():
+            return True
+        return await self.probe()
+
+    async def login(self, username=None, password=None):
+        self.username = username or self.username
+        self.password = password or self.password
+        if await self.test_cookies(self.load_cookies()):
+            return
+        await self._login(self.validated)
+
+    async def relogin(self, generation):
+        '''Log in again because the session of generation expired.
+
+        The coroutines calling this for one generation share one login.
+        '''
+        expired = time.time()
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+        async with self._login_lock:
+            if generation == self.generation:
+                logger.info('Session expired, logging in again.')
+                await self._login(expired)
+
+    async def _login(self, seen):
+        # Waiting for another process's login must not block the loop.
+        lock = await asyncio.get_event_loop().run_in_executor(
+            None, self.lock_cookies)
+        try:
+            if self.relogin_needed(seen):
+                r = await self.post(login_data(self.username, self.password))
+                if LOGIN_REQUIRED not in r.text:
+                    self.cookies = r.cookies
+                    self.validated = time.time()
+                    self.dump_cookies()
+            self.generation += 1
+        finally:
+            self.unlock_cookies(lock)
+
+    async def _catalog_entry(self, kind):
+        if self._catalog_lock is None:
+            self._catalog_lock = asyncio.Lock()
+        async with self._catalog_lock:
+            entry = self._catalog.get(kind)
+            if entry is None or entry[0] <= time.time():
+                if kind == 'images':
+                    names = utils.cut(utils.loads(await self.image_list()))
+                else:
+                    names = [int(x) for x in
+                             utils.cut(utils.loads(await self.vlan_list()))]
+                entry = (time.time() + self.catalog_ttl, names, set(names))
+                self._catalog[kind] = entry
+            return entry
+
+    def invalidate_catalog(self, kind=None):
+        if kind:
+            self._catalog.pop(kind, None)
+        else:
+            self._catalog.clear()
+
+    async def refresh_catalog(self):
+        self.invalidate_catalog()
+        await self._catalog_entry('images')
+        await self._catalog_entry('vlans')
+
+    async def has_image(self, image):
+        return image in (await self._catalog_entry('images'))[2]
+
+    async def has_vlan(self, vlan):
+        try:
+            vlan = int(vlan)
+        except (TypeError, ValueError):
+            return False
+        return vlan in (await self._catalog_entry('vlans'))[2]
+
+    async def vm_create(
+            self, image, vlan, name=None, cpu=None, memory=None,
+            increase=None, metadata={}):
+        if not await self.has_image(image):
+            raise ImageNotExist(image)
+
+        if not await self.has_vlan(vlan):
+            raise VlanNotExist(vlan)
+
+        return await self._launch_vm(image=image, vlan=vlan, name=name,
+                                     cpu=cpu, memory=memory,
+                                     increase=increase, metadata=metadata)
+
+    async def _launch_vm(self, image, vlan, name=None, cpu=None, memory=None,
+                         increase=None, metadata={}):
+        data = {'exec': 'launch_vm',
+                'image': image,
+                'vlan': vlan,
+                'name': name,
+                'cpu': cpu,
+                'memory': memory,
+                'disk_inc': increase,
+                'metadata': utils.dumps(metadata)}
+        r = await self.post(data=data)
+        return r.text.strip()
+
+    async def vm_create_many(self, image=None, vlan=None, count=1, name=None,
+                             specs=None, concurrency=8, cpu=None, memory=None,
+                             increase=None, metadata={}):
+        '''See CloudlandClient.vm_create_many.'''
+        if specs is None:
+            specs = [{} for _ in range(count)]
+        defaults = {'image': image, 'vlan': vlan, 'name': name, 'cpu': cpu,
+                    'memory': memory, 'increase': increase,
+                    'metadata': metadata}
+        launches = []
+        for spec in specs:
+            vm = dict(defaults)
+            vm.update(spec)
+            launches.append(vm)
+
+        images = {}
+        vlans = {}
+        for vm in launches:
+            images[vm['image']] = await self.has_image(vm['image'])
+            vlans[vm['vlan']] = await self.has_vlan(vm['vlan'])
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def launch(i, vm):
+            start = time.time()
+            try:
+                # A bad name template fails its own VM only.
+                if vm['name']:
+                    vm['name'] = vm['name'].format(i=i)
+                if not images[vm['image']]:
+                    raise ImageNotExist(vm['image'])
+                if not vlans[vm['vlan']]:
+                    raise VlanNotExist(vm['vlan'])
+                async with semaphore:
+                    result = await self._launch_vm(**vm)
+            except Exception as e:
+                return bulk.Outcome(vm, error=e, elapsed=time.time() - start)
+            return bulk.Outcome(vm, result=result,
+                                elapsed=time.time() - start)
+
+        return await asyncio.gather(*[launch(i, vm) for i, vm
+                                      in enumerate(launches, 1)])
+
+    async def vm_list(self):
+        params = {'action': 'get_vm_list'}
+        r = await self.get(params=params)
+        return r.text.strip()
+
+    async def vm_start(self, vm):
+        data = {'exec': 'create_vm',
+                'vm_ID': vm}
+        r = await self.post(data=data)
+        return r.text.strip()
+
+    async def vm_stop(self, vm, force=False):
+        data = {'exec': 'destroy_vm',
+                'vm_ID': vm,
+                'force': force}
+        r = await self.post(data=data)
+        return r.text.strip()
+
+    async def vm_delete(self, vm):
+        data = {'exec': 'clear_vm',
+                'vm_ID': vm}
+        r = await self.post(data=data)
+        return r.text.strip()
+
+    async def image_list(self):
+        params = {'action': 'get_img_list'}
+        r = await self.get(params=params)
+        return r.text.strip()
+
+    async def images(self):
+        return list((await self._catalog_entry('images'))[1])
+
+    async def image_show(self, image):
+        params = {'action': 'get_img',
+                  'name': image}
+        r = await self.get(params=params)
+        return r.text.strip()
+
+    async def image_delete(self, image):
+        data = {'exec': 'delete_img',
+                'img_name': image}
+        r = await self.post(data=data)
+        self.invalidate_catalog('images')
+        return r.text.strip()
+
+    async def image_create(self, url, platform, shared=True, desc=None):
+        data = {'exec': 'upload_img',
+                'img_url': url,
+                'platform': platform,
+                'shared': shared,
+                'img_desc': desc}
+        r = await self.post(data=data)
+        self.invalidate_catalog('images')
+        return r.text.strip()
+
+    async def vlan_list(self):
+        params = {'action': 'get_link_list'}
+        r = await self.get(params=params)
+        return r.text.strip()
+
+    async def vlans(self):
+        return list((await self._catalog_entry('vlans'))[1])
+
+    async def vlan_create(self, vlan, network, netmask, gateway, start_ip,
+                          end_ip, shared, use_dhcp):
+        data = {'exec': 'create_net',
+                'vlan': vlan,
+                'network': network,
+                'netmask': netmask,
+                'gateway': gateway,
+                'start_ip': start_ip,
+                'end_ip': end_ip,
+                'shared': shared,
+                'use_dpcp': use_dhcp}
+        r = await self.post(data=data)
+        self.invalidate_catalog('vlans')
+        return r.text.strip()
+
+    async def vlan_delete(self, vlan):
+        data = {'exec': 'clear_net',
+                'vlan': vlan}
+        r = await self.post(data=data)
+        self.invalidate_catalog('vlans')
+        return r.text.strip()
+
+    async def vlan_attach(self, vlan, vm):
+        data = {'exec': 'attach_nic',
+                'vlan': vlan,
+                'vm_ID': vm}
+        r = await self.post(data=data)
+        return r.text.strip()
+
+    async def volume_list(self):
+        params = {'action': 'get_vol_list'}
+        r = await self.get(params=params)
+        return r.text.strip()
+
+    async def volume_delete(self, volume):
+        data = {'exec': 'delete_vol',
+                'vol_name': volume}
+        r = await self.post(data=data)
+        return r.text.strip()
+
+    async def volume_create(self, size, image, desc):
+        if image and not await self.has_image(image):
+            raise ImageNotExist(image)
+        data = {'exec': 'create_vol',
+                'vol_size': size,
+                'img_name': image,
+                'vol_desc': desc}
+        r = await self.post(data=data)
+        return r.text.strip()
+
+    async def volume_attach(self, volume, vm):
+        data = {'exec': 'attach_vol',
+                'vol_name': volume,
+                'vm_ID': vm}
+        r = await self.post(data=data)
+        return r.text.strip()
+
+    async def volume_detach(self, volume):
+        data = {'exec': 'detach_vol',
+                'vol_name': volume}
+        r = await self.post(data=data)
+        return r.text.strip()
+
+    async def snapshot_list(self):
+        params = {'action': 'get_snapshot_list'}
+        r = await self.get(params=params)
+        return r.text.strip()
+
+    async def snapshot_delete(self, snapshot):
+        data = {'exec': 'delete_snapshot',
+                'snapshot': snapshot}
+        r = await self.post(data=data)
+        return r.text.strip()
+
+    async def snapshot_create(self, vm, desc):
+        data = {'exec': 'create_snapshot',
+                'vm_ID': vm,
+                'snap_desc': desc}
+        r = await self.post(data=data)
+        return r.text.strip()
+
+    async def snapshot_download(self, snapshot):
+        data = {'exec': 'download_snapshot',
+                'snapshot': snapshot}
+        r = await self.post(data=data)
+        return r.text.strip()
@@ -0,0 +1,86 @@
+'''
+Run many independent API calls on a bounded worker pool.
+'''
+
+from concurrent import futures
+import threading
+import time
+
+
+class Outcome(object):
+    '''Result of one call in a bulk run.
+
+    item is the input the call was made with, result its return value
+    and error the exception it raised, if any.
+    '''
+    __slots__ = ('item', 'result', 'error', 'elapsed')
+
+    def __init__(self, item, result=None, error=None, elapsed=0.0):
+        self.item = item
+        self.result = result
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return '<Outcome %r: %r>' % (self.item, self.result)
+        return '<Outcome %r failed: %s>' % (self.item, self.error)
+
+
+class RateLimit(object):
+    '''Spaces calls at least 1/rate seconds apart.
+
+    One RateLimit may be shared by any number of threads.
+    '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next)
+            self.next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def call(func, item):
+    '''func(item) as an Outcome, timed and with any exception caught.'''
+    start = time.time()
+    try:
+        result = func(item)
+    except Exception as e:
+        return Outcome(item, error=e, elapsed=time.time() - start)
+    return Outcome(item, result=result, elapsed=time.time() - start)
+
+
+def run(func, items, concurrency=8, rate=None):
+    '''Call func on every item on a bounded worker pool.
+
+    At most concurrency calls are in flight and, if rate is given, at
+    most rate calls are started per second. Returns one Outcome per
+    item, in input order. Failures are recorded in their Outcome
+    rather than raised.
+    '''
+    items = list(items)
+    if not items:
+        return []
+    if rate:
+        limit = RateLimit(rate)
+        unlimited = func
+
+        def func(item):
+            limit.wait()
+            return unlimited(item)
+    workers = max(1, min(concurrency, len(items)))
+    if workers == 1:
+        return [call(func, item) for item in items]
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda item: call(func, item), items))
@@ -1,49 +1,131 @@
+import errno
+import fnmatch
+import getpass
+import hashlib
+import itertools
 import logging
+import os
 import os.path as path
 import requests
+import requests.adapters
+from requests.compat import urlencode
+import stat
 import tempfile
+import threading
 import time
 
 import pickle
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from cloudlandclient import bulk
+from cloudlandclient.exc import DeadlineExceeded
 from cloudlandclient.exc import ImageNotExist
+from cloudlandclient.exc import NothingMatched
+from cloudlandclient.exc import SomeThingWrong
 from cloudlandclient.exc import VlanNotExist
+from cloudlandclient.exc import VmFailed
+from cloudlandclient.exc import WaitTimeout
+from cloudlandclient import models
+from cloudlandclient.models import DELETED
+from cloudlandclient.models import FAILED
+from cloudlandclient import retry
 from cloudlandclient import utils
 
 
 logger = logging.getLogger(__name__)
 
+LOGIN_REQUIRED = 'You need to login before proceed!'
 
-class CloudlandClient:
-    def __init__(self, endpoint, username, password):
-        self.endpoint = endpoint
-        self.cookies = None
-        self.login(username, password)
+# Seconds the session probe's response may answer a get() of its action.
+PRIMED_TTL = 2
 
-    def post(self, data):
-        logger.info(data)
-        result = requests.post(
-            self.endpoint, data=data, cookies=self.cookies, timeout=60)
-        logger.info(result.text)
-        return result
+# The get action of each list command, keyed by resource name.
+LIST_ACTIONS = {'vm': 'get_vm_list',
+                'image': 'get_img_list',
+                'vlan': 'get_link_list',
+                'volume': 'get_vol_list',
+                'snapshot': 'get_snapshot_list'}
 
-    def get(self, params):
-        logger.info(params)
-        result = requests.get(
-            self.endpoint, params=params, cookies=self.cookies)
-        logger.info(result.text)
-        return result
+
+def login_data(username, password):
+    if username.find('@') == -1 or not username.endswith(".ibm.com"):
+        password = utils.sha1sum(password)
+        return {'username': username, 'sha1': password, 'op': 'login'}
+    return {'username': username, 'password1': password, 'op': 'login'}
+
+
+def listed(status, body):
+    '''Whether a list request was answered with a list.'''
+    if status != 200 or not body:
+        return False
+    try:
+        utils.loads(body)
+    except (ValueError, SomeThingWrong):
+        return False
+    return True
+
+
+def cookie_dir():
+    '''This OS user's private directory for cookie files.
+
+    It is in the temp directory, created readable by its owner only,
+    and refused if another user owns it or can get into it.
+    '''
+    uid = getattr(os, 'getuid', None)
+    directory = path.join(tempfile.gettempdir(), 'cloudland-%s' % (
+        uid() if uid else getpass.getuser()))
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    if uid:
+        st = os.lstat(directory)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != uid() or (
+                st.st_mode & 0o077):
+            raise SomeThingWrong(message='Cookie directory %s is not '
+                                 'private to this user; remove it.'
+                                 % directory)
+    return directory
+
+
+class CookieFileMixin(object):
+    '''Session cookies cached on disk between client instances.
+
+    Every endpoint and username has its own cookie file, in a directory
+    private to the OS user; see cookie_dir. Writes replace it atomically,
+    and logins hold a lock file so that of many processes starting
+    together one logs in and the others reuse its session.
+    '''
 
     @property
     def cpath(self):
-        return path.join(tempfile.gettempdir(), 'cloudland.cookies')
+        owner = '%s\n%s' % (self.endpoint.rstrip('/'), self.username)
+        key = hashlib.sha1(owner.encode('utf-8')).hexdigest()[:16]
+        return path.join(cookie_dir(), 'cloudland-%s.cookies' % key)
 
     def load_cookies(self):
         cpath = self.cpath
         if not path.isfile(cpath):
             return None
-        with open(cpath, 'r') as cfile:
-            cookies = pickle.load(cfile)
+        try:
+            with open(cpath, 'rb') as cfile:
+                # Only a file this user wrote is unpickled.
+                if hasattr(os, 'getuid') and (
+                        os.fstat(cfile.fileno()).st_uid != os.getuid()):
+                    raise SomeThingWrong(message='owned by another user')
+                cookies = pickle.load(cfile)
+        except Exception as e:
+            logger.info('Unreadable cookie file %s: %s' % (cpath, e))
+            return None
+        # Older clients pickled the bare cookie jar.
+        if isinstance(cookies, dict):
+            self.validated = cookies.get('validated', 0)
+            cookies = cookies.get('cookies')
         if cookies:
             for cookie in cookies:
                 if cookie.is_expired():
@@ -55,41 +137,522 @@ class CloudlandClient:
         cookies = self.cookies
         for cookie in cookies:
             cookie.expires = time.time() + 6000 - 10
-        logger.info(self.cpath)
-        with open(self.cpath, 'w+') as cfile:
-            pickle.dump(cookies, cfile)
+        cpath = self.cpath
+        logger.info(cpath)
+        # Readers see the old file or the new one, never half of it.
+        fd, tmp = tempfile.mkstemp(dir=path.dirname(cpath),
+                                   prefix=path.basename(cpath) + '.')
+        try:
+            with os.fdopen(fd, 'wb') as cfile:
+                pickle.dump({'cookies': cookies,
+                             'validated': self.validated}, cfile)
+            getattr(os, 'replace', os.rename)(tmp, cpath)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    def lock_cookies(self):
+        '''Take the cookie file's lock, waiting for other processes.
+
+        Returns the handle to pass to unlock_cookies.
+        '''
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0)
+        fd = os.open(self.cpath + '.lock', flags, 0o600)
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def unlock_cookies(self, fd):
+        # Closing the descriptor releases the lock.
+        os.close(fd)
+
+    def relogin_needed(self, seen):
+        '''Tell whether this client must still log in.
+
+        The cookie file is reloaded after taking its lock. False when
+        another process logged in since the cookies validated at seen
+        were read.
+        '''
+        cookies = self.load_cookies()
+        if cookies and self.validated > seen:
+            self.cookies = cookies
+            return False
+        return True
+
+    def session_fresh(self):
+        return time.time() - self.validated < self.session_ttl
+
+
+class _Flight(object):
+    '''One read shared by every caller asking for it while it runs.'''
+    __slots__ = ('event', 'result', 'error', 'finished')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished = None
+
+    def wait(self, deadline):
+        if not self.event.wait(retry.Deadline.of(deadline).remaining()):
+            raise DeadlineExceeded()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class CloudlandClient(CookieFileMixin):
+    '''Client of the cloudland API.
+
+    One client may be shared by many threads. When the server answers a
+    call with its login page because the session expired, the client
+    logs in again, once for all threads that hit the expired session,
+    and replays the call.
+
+    With coalesce, threads sending the same non-streamed GET while one
+    is in flight wait for it and share its response, or its error. In
+    the same way, calls reading a whole list, records() and what builds
+    on it such as inventory(), resolve(), wait_for() and watch(), share
+    one request and one parsed row list per kind. iter_list() itself,
+    and records() with filters, sort or limit, always stream their own.
+    coalesce_window keeps a finished result for that many more seconds
+    for calls that follow right after. Any POST ends the sharing, so a
+    read sent after a change never sees a result from before it.
+    '''
+
+    def __init__(self, endpoint, username, password,
+                 pool_connections=10, pool_maxsize=10, pool_block=False,
+                 keep_alive=True, session_ttl=300,
+                 probe_action='get_link_list', catalog_ttl=60,
+                 retry_policy=None, connect_timeout=10, read_timeout=60,
+                 hooks=(), coalesce=True, coalesce_window=0):
+        self.endpoint = endpoint
+        self.username = username
+        self.password = password
+        self.cookies = None
+        # Serializes logins within the process; generation counts the
+        # sessions this client has had, so threads that saw the same
+        # session expire log in again only once.
+        self._login_lock = threading.Lock()
+        self.generation = 0
+        self.retry_policy = retry_policy or retry.RetryPolicy()
+        # Callables notified as hook(event, info) around every request;
+        # see add_hook.
+        self.hooks = list(hooks)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # Seconds a validated session is trusted without probing again.
+        self.session_ttl = session_ttl
+        self.probe_action = probe_action
+        self.validated = 0
+        # One-shot (expires, response) pairs left behind by the session
+        # probe, keyed by action, handed to the first matching get()
+        # unless a POST came first.
+        self._primed = {}
+        # Image and VLAN names used to validate creates, by kind:
+        # (expires, ordered names, name set).
+        self.catalog_ttl = catalog_ttl
+        self._catalog = {}
+        self._catalog_lock = threading.Lock()
+        # Reads in flight, or finished within coalesce_window, by writes
+        # and what they read; writes counts the POSTs done.
+        self.coalesce = coalesce
+        self.coalesce_window = coalesce_window
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        self.writes = 0
+        self.session = self.make_session(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+            keep_alive=keep_alive)
+        self.login(username, password)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def make_session(pool_connections=10, pool_maxsize=10, pool_block=False,
+                     keep_alive=True):
+        '''Build the pooled session shared by every call of a client.
+
+        pool_connections is the number of hosts to keep pools for,
+        pool_maxsize the connections kept alive per host, and pool_block
+        makes callers wait for a free connection instead of opening more
+        than pool_maxsize to one host.
+        '''
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def close(self):
+        self.session.close()
+
+    def add_hook(self, hook):
+        '''Call hook(event, info) when each request starts and ends.
+
+        event is 'start' or 'end'. info is a dict with the operation (the
+        exec, action or op value), method and payload_size; on 'end' it
+        also holds duration in seconds, status (None if no response came
+        back), response_size, retries and error (the exception raised,
+        or None). metrics.MetricsCollector is such a hook.
+        '''
+        self.hooks.append(hook)
+
+    def _fire(self, event, info):
+        for hook in self.hooks:
+            try:
+                hook(event, info)
+            except Exception:
+                logger.exception('Hook %r failed.' % hook)
+
+    def request(self, method, idempotent, timeout=None, deadline=None,
+                **kwargs):
+        '''Send a request under the retry policy and time budget.
+
+        timeout is a (connect, read) pair or a single number of seconds
+        and defaults to the client's; both are cut short to what is left
+        of deadline, a retry.Deadline or a number of seconds.
+        '''
+        info = {'retries': 0}
+        if not self.hooks:
+            return self._send(method, idempotent, timeout, deadline, info,
+                              kwargs)
+        fields = kwargs.get('data') or kwargs.get('params') or {}
+        # A streamed body counts the size of its form fields only.
+        fields = getattr(fields, 'fields', fields)
+        operation = [fields[key] for key in ('exec', 'action', 'op')
+                     if fields.get(key)]
+        info.update(
+            operation=operation[0] if operation else None,
+            method=method,
+            payload_size=len(urlencode(
+                [(k, v) for k, v in fields.items() if v is not None])))
+        self._fire('start', info)
+        start = time.time()
+        try:
+            result = self._send(method, idempotent, timeout, deadline, info,
+                                kwargs)
+        except Exception as e:
+            info.update(duration=time.time() - start, status=None,
+                        response_size=0, error=e)
+            self._fire('end', info)
+            raise
+        if kwargs.get('stream'):
+            size = int(result.headers.get('content-length') or 0)
+        else:
+            size = len(result.content)
+        info.update(duration=time.time() - start,
+                    status=result.status_code, response_size=size,
+                    error=None)
+        self._fire('end', info)
+        return result
+
+    def _send(self, method, idempotent, timeout, deadline, info, kwargs):
+        deadline = retry.Deadline.of(deadline)
+        if timeout is None:
+            timeout = (self.connect_timeout, self.read_timeout)
+        elif not isinstance(timeout, tuple):
+            timeout = (timeout, timeout)
+        policy = self.retry_policy
+        attempt = 0
+        while True:
+            deadline.check()
+            try:
+                result = self.session.request(
+                    method, self.endpoint, cookies=self.cookies,
+                    timeout=tuple(deadline.cap(t) for t in timeout),
+                    **kwargs)
+            except requests.exceptions.RequestException as e:
+                if not policy.should_retry(attempt, idempotent, error=e):
+                    raise
+                logger.info('Retrying after %s' % e)
+            else:
+                if not policy.should_retry(attempt, idempotent,
+                                           response=result):
+                    return result
+                logger.info('Retrying after HTTP %s' % result.status_code)
+                result.close()
+            time.sleep(deadline.cap(policy.delay(attempt)))
+            attempt += 1
+            info['retries'] = attempt
+
+    def post(self, data, timeout=None, deadline=None, headers=None):
+        '''Send a POST of data.
+
+        data is a dict of form fields or a streamed body such as
+        upload.MultipartBody, with its fields in data.fields.
+        '''
+        logger.info(data)
+        fields = data if isinstance(data, dict) else data.fields
+        login = fields.get('op') == 'login'
+        try:
+            for attempt in range(2):
+                generation = self.generation
+                # Logging in twice is harmless; every other POST changes
+                # state.
+                result = self.request('POST', login, timeout=timeout,
+                                      deadline=deadline, data=data,
+                                      headers=headers)
+                logger.info(result.text)
+                # The server did nothing but send its login page, so the
+                # call is safe to replay once logged in again.
+                if login or attempt or LOGIN_REQUIRED not in result.text:
+                    return result
+                self.relogin(generation)
+        finally:
+            # GETs from now on must not share one sent before the change,
+            # nor take the probe's response.
+            with self._flights_lock:
+                self.writes += 1
+                self._primed.clear()
+
+    def get(self, params, stream=False, timeout=None, deadline=None,
+            relogin=True):
+        '''Send a GET.
+
+        With relogin, a non-streamed call answered with the login page is
+        replayed after logging in again; iter_list does the same for
+        streamed ones. Non-streamed calls are shared with identical ones
+        in flight; see the class.
+        '''
+        if len(params) == 1:
+            primed = self._primed.pop(params.get('action'), None)
+            if primed is not None and primed[0] > time.time():
+                return primed[1]
+        if stream or not self.coalesce:
+            return self._get(params, stream, timeout, deadline, relogin)
+        return self._shared(
+            ('get', relogin, tuple(sorted(params.items()))),
+            lambda: self._get(params, stream, timeout, deadline, relogin),
+            deadline)
+
+    def _rows(self, kind, deadline=None):
+        # Every row of a list command. Like non-streamed GETs, calls for
+        # the same kind share one request and one parsed row list.
+        def fetch():
+            return list(self.iter_list(kind, deadline=deadline))
+        if not self.coalesce:
+            return fetch()
+        return self._shared(('rows', kind), fetch, deadline)
+
+    def _shared(self, key, func, deadline):
+        '''func(), or the result of an identical call.
+
+        That is the call of the same key in flight or within
+        coalesce_window; see the class.
+        '''
+        now = time.time()
+        with self._flights_lock:
+            key = (self.writes,) + key
+            flight = self._flights.get(key)
+            if flight is not None and not self._fresh(flight, now):
+                flight = None
+            if flight is not None:
+                leader = False
+            else:
+                for old in [k for k, f in self._flights.items()
+                            if not self._fresh(f, now)]:
+                    del self._flights[old]
+                flight = self._flights[key] = _Flight()
+                leader = True
+        if not leader:
+            return flight.wait(deadline)
+        try:
+            flight.result = func()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            flight.finished = time.time()
+            if not self.coalesce_window or flight.error is not None:
+                with self._flights_lock:
+                    if self._flights.get(key) is flight:
+                        del self._flights[key]
+            flight.event.set()
+
+    def _fresh(self, flight, now):
+        # Whether a flight may still be joined.
+        if flight.finished is None:
+            return True
+        return flight.error is None and (
+            now < flight.finished + self.coalesce_window)
+
+    def _get(self, params, stream, timeout, deadline, relogin):
+        logger.info(params)
+        for attempt in range(2):
+            generation = self.generation
+            result = self.request('GET', True, timeout=timeout,
+                                  deadline=deadline, params=params,
+                                  stream=stream)
+            if stream:
+                return result
+            logger.info(result.text)
+            if not relogin or attempt or LOGIN_REQUIRED not in result.text:
+                return result
+            self.relogin(generation)
+
+    def iter_list(self, kind, chunk_size=64 * 1024, deadline=None,
+                  filters=None, sort=None, limit=None):
+        '''Yield the rows of a list command while they are downloaded.
+
+        kind is a resource name of LIST_ACTIONS. filters, sort and limit
+        are those of utils.query and are applied as rows are parsed.
+        Closing the generator early, or reaching limit without sort,
+        closes the response without reading the rest.
+        '''
+        query = None
+        if filters or sort or limit is not None:
+            query = utils.query(models.KINDS[kind].head, filters=filters,
+                                sort=sort, limit=limit)
+        for attempt in range(2):
+            generation = self.generation
+            r = self.get(params={'action': LIST_ACTIONS[kind]}, stream=True,
+                         deadline=deadline)
+            try:
+                rows = utils.iterloads(r.iter_content(chunk_size=chunk_size))
+                try:
+                    first = next(rows)
+                except StopIteration:
+                    return
+                except SomeThingWrong as e:
+                    if attempt or LOGIN_REQUIRED not in str(e):
+                        raise
+                    self.relogin(generation)
+                    continue
+                rows = itertools.chain([first], rows)
+                if query is not None:
+                    rows = query(rows)
+                for row in rows:
+                    yield row
+                return
+            finally:
+                r.close()
+
+    def probe(self):
+        '''Check the current cookies with one cheap list request.
+
+        The response is kept for the first get() of the same action, so
+        probing with get_vm_list feeds the caller's first vm_list().
+        '''
+        r = self.get(params={'action': self.probe_action}, relogin=False)
+        if LOGIN_REQUIRED in r.text:
+            return False
+        if not listed(r.status_code, r.text):
+            # An error says nothing of the cookies; the next call retries,
+            # and logs in again if it finds them stale.
+            return True
+        self._primed[self.probe_action] = (time.time() + PRIMED_TTL, r)
+        self.validated = time.time()
+        self.dump_cookies()
+        return True
 
     def test_cookies(self, cookies):
-        result = False
         self.cookies = cookies
-        if cookies:
-            if 'You need to login before proceed!' not in self.vm_list():
-                result = True
-        return result
+        if not cookies:
+            return False
+        if self.session_fresh():
+            return True
+        return self.probe()
 
     def login(self, username, password):
-        cookies = self.load_cookies()
-        if self.test_cookies(cookies):
-            return
-        if username.find('@') == -1 or not username.endswith(".ibm.com"):
-            password = utils.sha1sum(password)
-            data = {'username': username, 'sha1': password, 'op': 'login'}
-        else:
-            data = {'username': username, 'password1': password, 'op': 'login'}
-        r = self.post(data)
-        if 'You need to login before proceed!' not in r.text:
-            self.cookies = r.cookies
-            self.dump_cookies()
+        self.username = username
+        self.password = password
+        with self._login_lock:
+            if not self.test_cookies(self.load_cookies()):
+                self._login(self.validated)
+
+    def relogin(self, generation):
+        '''Log in again because the session of generation expired.
+
+        Threads calling this for the same generation wait for one login
+        and then share its session.
+        '''
+        # Only a session validated after the expiry was seen, by another
+        # process, is worth reusing.
+        expired = time.time()
+        with self._login_lock:
+            if generation == self.generation:
+                logger.info('Session expired, logging in again.')
+                self._login(expired)
+
+    def _login(self, seen):
+        # Holds the cookie file lock, so of several processes only one
+        # logs in and the others load its cookies.
+        lock = self.lock_cookies()
+        try:
+            if self.relogin_needed(seen):
+                r = self.post(login_data(self.username, self.password))
+                if LOGIN_REQUIRED not in r.text:
+                    self.cookies = r.cookies
+                    self.validated = time.time()
+                    self.dump_cookies()
+            self.generation += 1
+        finally:
+            self.unlock_cookies(lock)
+
+    def _catalog_entry(self, kind):
+        # Holding the lock while fetching lets concurrent callers share
+        # one round trip instead of all refreshing an expired entry.
+        with self._catalog_lock:
+            entry = self._catalog.get(kind)
+            if entry is None or entry[0] <= time.time():
+                if kind == 'images':
+                    names = utils.cut(self._rows('image'))
+                else:
+                    names = [int(x) for x in utils.cut(self._rows('vlan'))]
+                entry = (time.time() + self.catalog_ttl, names, set(names))
+                self._catalog[kind] = entry
+            return entry
+
+    def invalidate_catalog(self, kind=None):
+        with self._catalog_lock:
+            if kind:
+                self._catalog.pop(kind, None)
+            else:
+                self._catalog.clear()
+
+    def refresh_catalog(self):
+        self.invalidate_catalog()
+        self._catalog_entry('images')
+        self._catalog_entry('vlans')
+
+    def has_image(self, image):
+        return image in self._catalog_entry('images')[2]
+
+    def has_vlan(self, vlan):
+        try:
+            vlan = int(vlan)
+        except (TypeError, ValueError):
+            return False
+        return vlan in self._catalog_entry('vlans')[2]
 
     def vm_create(
             self, image, vlan, name=None, cpu=None, memory=None,
             increase=None, metadata={}):
-        if image not in self.images():
+        if not self.has_image(image):
             raise ImageNotExist(image)
 
-        if vlan not in self.vlans():
+        if not self.has_vlan(vlan):
             raise VlanNotExist(vlan)
 
+        return self._launch_vm(image=image, vlan=vlan, name=name, cpu=cpu,
+                               memory=memory, increase=increase,
+                               metadata=metadata)
+
+    def _launch_vm(self, image, vlan, name=None, cpu=None, memory=None,
+                   increase=None, metadata={}, deadline=None):
         data = {'exec': 'launch_vm',
                 'image': image,
                 'vlan': vlan,
@@ -98,31 +661,294 @@ class CloudlandClient:
                 'memory': memory,
                 'disk_inc': increase,
                 'metadata': utils.dumps(metadata)}
-        r = self.post(data=data)
+        r = self.post(data=data, deadline=deadline)
         return r.text.strip()
 
+    def vm_create_many(self, image=None, vlan=None, count=1, name=None,
+                       specs=None, concurrency=8, cpu=None, memory=None,
+                       increase=None, metadata={}, deadline=None):
+        '''Launch several virtual machines concurrently.
+
+        Either count copies of one VM are launched, or one VM per dict in
+        specs, whose keys override the keyword defaults. A name such as
+        'web-{i}' is formatted with the 1-based position of each VM.
+        Images and VLANs are validated once for the whole batch. Returns a
+        bulk.Outcome per VM, in input order; each item is the spec that
+        was launched. Launches not finished within deadline fail with
+        DeadlineExceeded.
+        '''
+        deadline = retry.Deadline.of(deadline)
+        if specs is None:
+            specs = [{} for _ in range(count)]
+        defaults = {'image': image, 'vlan': vlan, 'name': name, 'cpu': cpu,
+                    'memory': memory, 'increase': increase,
+                    'metadata': metadata}
+        launches = []
+        for spec in specs:
+            vm = dict(defaults)
+            vm.update(spec)
+            launches.append(vm)
+
+        images = dict((vm['image'], self.has_image(vm['image']))
+                      for vm in launches)
+        vlans = dict((vm['vlan'], self.has_vlan(vm['vlan']))
+                     for vm in launches)
+
+        def launch(item):
+            i, vm = item
+            # A bad name template fails its own VM only.
+            if vm['name']:
+                vm['name'] = vm['name'].format(i=i)
+            if not images[vm['image']]:
+                raise ImageNotExist(vm['image'])
+            if not vlans[vm['vlan']]:
+                raise VlanNotExist(vm['vlan'])
+            return self._launch_vm(deadline=deadline, **vm)
+
+        outcomes = bulk.run(launch, enumerate(launches, 1),
+                            concurrency=concurrency)
+        for outcome in outcomes:
+            outcome.item = outcome.item[1]
+        return outcomes
+
+    def resolve(self, kind, patterns, deadline=None):
+        '''Ids of the records of a list command matching patterns.
+
+        A pattern is an id, or a VM name, and may hold the wildcards *, ?
+        and [...]. All patterns are matched against one list fetch.
+        Returns the ids, without repeats and in pattern order, and the
+        patterns that matched nothing.
+        '''
+        inventory = self.inventory(kind, deadline=deadline)
+        named = 'name' in inventory.index
+        ids = []
+        seen = set()
+        unmatched = []
+        for pattern in patterns:
+            pattern = str(pattern)
+            if any(c in pattern for c in '*?['):
+                found = [record for record in inventory
+                         if fnmatch.fnmatchcase(record.id, pattern) or (
+                             named and fnmatch.fnmatchcase(record.name,
+                                                           pattern))]
+            else:
+                found = inventory.lookup('name', pattern) if named else []
+                if pattern in inventory:
+                    found.insert(0, inventory.get(pattern))
+            if not found:
+                unmatched.append(pattern)
+            for record in found:
+                if record.id not in seen:
+                    seen.add(record.id)
+                    ids.append(record.id)
+        return ids, unmatched
+
+    def _bulk(self, kind, action, patterns, concurrency, rate, deadline,
+              resolved=None):
+        deadline = retry.Deadline.of(deadline)
+        ids, unmatched = resolved or self.resolve(kind, patterns,
+                                                  deadline=deadline)
+
+        def call(id):
+            deadline.check()
+            body = action(id, deadline=deadline)
+            # Raises on a failure status in the response.
+            utils.loads(body)
+            return body
+        outcomes = bulk.run(call, ids, concurrency=concurrency, rate=rate)
+        return outcomes + [bulk.Outcome(pattern,
+                                        error=NothingMatched(kind, pattern))
+                           for pattern in unmatched]
+
+    def vm_start_many(self, vms, concurrency=8, rate=None, deadline=None,
+                      resolved=None):
+        '''Start every VM matching vms, ids or names with wildcards.
+
+        The VMs are found with one VM list, then started with at most
+        concurrency calls in flight and rate calls a second. Returns a
+        bulk.Outcome per VM, whose result is the response body, followed
+        by one failed Outcome per pattern that matched nothing. resolved,
+        what resolve() already returned for vms, saves the list fetch.
+        '''
+        return self._bulk('vm', self.vm_start, vms, concurrency, rate,
+                          deadline, resolved)
+
+    def vm_stop_many(self, vms, force=False, concurrency=8, rate=None,
+                     deadline=None, resolved=None):
+        '''Stop every VM matching vms, as vm_start_many.'''
+        def stop(vm, deadline):
+            return self.vm_stop(vm, force=force, deadline=deadline)
+        return self._bulk('vm', stop, vms, concurrency, rate, deadline,
+                          resolved)
+
+    def vm_delete_many(self, vms, concurrency=8, rate=None, deadline=None,
+                       resolved=None):
+        '''Delete every VM matching vms, as vm_start_many.'''
+        return self._bulk('vm', self.vm_delete, vms, concurrency, rate,
+                          deadline, resolved)
+
+    def image_delete_many(self, images, concurrency=8, rate=None,
+                          deadline=None, resolved=None):
+        '''Delete every image matching images, as vm_start_many.'''
+        return self._bulk('image', self.image_delete, images, concurrency,
+                          rate, deadline, resolved)
+
+    def volume_delete_many(self, volumes, concurrency=8, rate=None,
+                           deadline=None, resolved=None):
+        '''Delete every volume matching volumes, as vm_start_many.'''
+        return self._bulk('volume', self.volume_delete, volumes,
+                          concurrency, rate, deadline, resolved)
+
+    def snapshot_delete_many(self, snapshots, concurrency=8, rate=None,
+                             deadline=None, resolved=None):
+        '''Delete every snapshot matching snapshots, as vm_start_many.'''
+        return self._bulk('snapshot', self.snapshot_delete, snapshots,
+                          concurrency, rate, deadline, resolved)
+
+    def records(self, kind, deadline=None, filters=None, sort=None,
+                limit=None):
+        '''Parsed records of a list command, such as records('vm').
+
+        filters, sort and limit are those of iter_list.
+        '''
+        cls = models.KINDS[kind]
+        if filters or sort or limit is not None:
+            rows = self.iter_list(kind, deadline=deadline, filters=filters,
+                                  sort=sort, limit=limit)
+        else:
+            rows = self._rows(kind, deadline=deadline)
+        return [cls.from_line(row) for row in rows if row]
+
+    def inventory(self, kind, deadline=None):
+        '''Indexed records of a list command, such as inventory('vm').'''
+        return models.Inventory(models.KINDS[kind],
+                                self.records(kind, deadline=deadline))
+
+    def watch(self, kind, interval=5, max_interval=60, initial=True):
+        '''Poll a list command forever, yielding what changed.
+
+        Each event is a dict with the keys event ('added', 'removed' or
+        'changed'), kind, id, time and row, plus old for changes. The
+        first poll reports every row as added unless initial is false.
+        Polling slows down, doubling up to max_interval, while nothing
+        changes or polls fail, and returns to interval after a change. A
+        failed poll is logged and the rows before it are kept.
+        '''
+        def event(name, record, old=None):
+            result = {'event': name, 'kind': kind, 'id': record.id,
+                      'time': now, 'row': record.as_dict()}
+            if old is not None:
+                result['old'] = old.as_dict()
+            return result
+
+        previous = None
+        delay = interval
+        while True:
+            try:
+                current = dict((record.id, record)
+                               for record in self.records(kind))
+            except (SomeThingWrong,
+                    requests.exceptions.RequestException) as e:
+                logger.info('Polling the %s list failed: %s' % (kind, e))
+                delay = min(delay * 2, max_interval)
+                time.sleep(delay)
+                continue
+            now = time.time()
+            events = []
+            if previous is not None or initial:
+                before = previous or {}
+                for id, record in current.items():
+                    old = before.get(id)
+                    if old is None:
+                        events.append(event('added', record))
+                    elif old != record:
+                        events.append(event('changed', record, old))
+                events.extend(event('removed', record)
+                              for id, record in before.items()
+                              if id not in current)
+            for e in events:
+                yield e
+            previous = current
+            delay = interval if events else min(delay * 2, max_interval)
+            time.sleep(delay)
+
     def vm_list(self):
         params = {'action': 'get_vm_list'}
         r = self.get(params=params)
         return r.text.strip()
 
-    def vm_start(self, vm):
+    def wait_for(self, vms, status, timeout=600, interval=1,
+                 max_interval=15, failed=FAILED, deadline=None):
+        '''Wait until every VM in vms, by id or name, has status.
+
+        status may also be a list of acceptable statuses. Each round
+        checks all pending VMs against a single VM list; the pause
+        between rounds doubles up to max_interval while nothing changes
+        and drops back to interval when something does. Returns a
+        bulk.Outcome per VM, in input order, whose result is the last
+        status seen and elapsed the seconds it took. VMs that time out
+        or reach a failed status carry the error instead. timeout is cut
+        short to what is left of deadline; with neither, waiting has no
+        limit.
+        '''
+        if isinstance(status, str):
+            status = [status]
+        start = time.time()
+        budget = retry.Deadline(retry.Deadline.of(deadline).cap(timeout))
+        outcomes = dict((vm, bulk.Outcome(vm)) for vm in vms)
+        pending = [vm for vm in outcomes]
+        delay = interval
+        while pending:
+            try:
+                inventory = self.inventory('vm', deadline=budget)
+            except DeadlineExceeded:
+                inventory = None
+            changed = False
+            for vm in list(pending if inventory is not None else ()):
+                outcome = outcomes[vm]
+                record = inventory.get(vm) or (
+                    inventory.lookup('name', vm) or [None])[0]
+                current = record.status if record else DELETED
+                if current != outcome.result:
+                    changed = True
+                outcome.result = current
+                outcome.elapsed = time.time() - start
+                if current in status:
+                    pending.remove(vm)
+                elif current in failed:
+                    outcome.error = VmFailed(vm, current)
+                    pending.remove(vm)
+            remaining = budget.remaining()
+            if pending and remaining is not None and remaining <= 0:
+                for vm in pending:
+                    outcome = outcomes[vm]
+                    outcome.error = WaitTimeout(vm, '/'.join(status),
+                                                outcome.result)
+                break
+            if pending:
+                delay = interval if changed else min(delay * 2, max_interval)
+                if remaining is not None:
+                    delay = min(delay, remaining)
+                time.sleep(delay)
+        return [outcomes[vm] for vm in vms]
+
+    def vm_start(self, vm, deadline=None):
         data = {'exec': 'create_vm',
                 'vm_ID': vm}
-        r = self.post(data=data)
+        r = self.post(data=data, deadline=deadline)
         return r.text.strip()
 
-    def vm_stop(self, vm, force=False):
+    def vm_stop(self, vm, force=False, deadline=None):
         data = {'exec': 'destroy_vm',
                 'vm_ID': vm,
                 'force': force}
-        r = self.post(data=data)
+        r = self.post(data=data, deadline=deadline)
         return r.text.strip()
 
-    def vm_delete(self, vm):
+    def vm_delete(self, vm, deadline=None):
         data = {'exec': 'clear_vm',
                 'vm_ID': vm}
-        r = self.post(data=data)
+        r = self.post(data=data, deadline=deadline)
         return r.text.strip()
 
     def image_list(self):
@@ -131,7 +957,7 @@ class CloudlandClient:
         return r.text.strip()
 
     def images(self):
-        return utils.cut(utils.loads(self.image_list()))
+        return list(self._catalog_entry('images')[1])
 
     def image_show(self, image):
         params = {'action': 'get_img',
@@ -139,10 +965,11 @@ class CloudlandClient:
         r = self.get(params=params)
         return r.text.strip()
 
-    def image_delete(self, image):
+    def image_delete(self, image, deadline=None):
         data = {'exec': 'delete_img',
                 'img_name': image}
-        r = self.post(data=data)
+        r = self.post(data=data, deadline=deadline)
+        self.invalidate_catalog('images')
         return r.text.strip()
 
     def image_create(self, url, platform, shared=True, desc=None):
@@ -152,6 +979,50 @@ class CloudlandClient:
                 'shared': shared,
                 'img_desc': desc}
         r = self.post(data=data)
+        self.invalidate_catalog('images')
+        return r.text.strip()
+
+    def image_upload(self, source, platform, name=None, shared=True,
+                     desc=None, resume=True, part_size=None, quiet=True):
+        '''Upload an image from source.
+
+        source is a local file name or '-' for stdin; see
+        upload.Uploader.
+        '''
+        from cloudlandclient.upload import Uploader
+        uploader = Uploader(self, quiet=quiet)
+        if part_size:
+            uploader.part_size = part_size
+        return uploader.send(source, name=name, platform=platform,
+                             shared=shared, desc=desc, resume=resume)
+
+    def image_upload_status(self, image):
+        '''Bytes the server holds of an unfinished upload of image.'''
+        params = {'action': 'get_upload',
+                  'name': image}
+        r = self.get(params=params)
+        rows = utils.loads(r.text)
+        return int(rows[0].split('|')[1]) if rows else 0
+
+    def image_upload_part(self, body):
+        '''Send one upload.MultipartBody.
+
+        Returns the bytes the server holds once it is stored.
+        '''
+        r = self.post(data=body, headers={'Content-Type': body.content_type})
+        return int(utils.loads(r.text)[0].split('|')[1])
+
+    def image_upload_commit(self, name, platform, shared, desc, size,
+                            checksum):
+        data = {'exec': 'upload_img',
+                'img_name': name,
+                'platform': platform,
+                'shared': shared,
+                'img_desc': desc,
+                'img_size': size,
+                'img_sha256': checksum}
+        r = self.post(data=data)
+        self.invalidate_catalog('images')
         return r.text.strip()
 
     def vlan_list(self):
@@ -160,7 +1031,7 @@ class CloudlandClient:
         return r.text.strip()
 
     def vlans(self):
-        return [int(x) for x in utils.cut(utils.loads(self.vlan_list()))]
+        return list(self._catalog_entry('vlans')[1])
 
     def vlan_create(self, vlan, network, netmask, gateway, start_ip, end_ip,
                     shared, use_dhcp):
@@ -174,12 +1045,14 @@ class CloudlandClient:
                 'shared': shared,
                 'use_dpcp': use_dhcp}
         r = self.post(data=data)
+        self.invalidate_catalog('vlans')
         return r.text.strip()
 
     def vlan_delete(self, vlan):
         data = {'exec': 'clear_net',
                 'vlan': vlan}
         r = self.post(data=data)
+        self.invalidate_catalog('vlans')
         return r.text.strip()
 
     def vlan_attach(self, vlan, vm):
@@ -194,14 +1067,14 @@ class CloudlandClient:
         r = self.get(params=params)
         return r.text.strip()
 
-    def volume_delete(self, volume):
+    def volume_delete(self, volume, deadline=None):
         data = {'exec': 'delete_vol',
                 'vol_name': volume}
-        r = self.post(data=data)
+        r = self.post(data=data, deadline=deadline)
         return r.text.strip()
 
     def volume_create(self, size, image, desc):
-        if image and image not in self.images():
+        if image and not self.has_image(image):
             raise ImageNotExist(image)
         data = {'exec': 'create_vol',
                 'vol_size': size,
@@ -228,10 +1101,10 @@ class CloudlandClient:
         r = self.get(params=params)
         return r.text.strip()
 
-    def snapshot_delete(self, snapshot):
+    def snapshot_delete(self, snapshot, deadline=None):
         data = {'exec': 'delete_snapshot',
                 'snapshot': snapshot}
-        r = self.post(data=data)
+        r = self.post(data=data, deadline=deadline)
         return r.text.strip()
 
     def snapshot_create(self, vm, desc):
@@ -241,8 +1114,22 @@ class CloudlandClient:
         r = self.post(data=data)
         return r.text.strip()
 
-    def snapshot_download(self, snapshot):
+    def snapshot_download(self, snapshot, deadline=None):
         data = {'exec': 'download_snapshot',
                 'snapshot': snapshot}
-        r = self.post(data=data)
+        r = self.post(data=data, deadline=deadline)
         return r.text.strip()
+
+    def snapshot_mirror(self, directory, snapshots=None, concurrency=4,
+                        connections=8, bandwidth=None, force=False,
+                        deadline=None, quiet=True):
+        '''Download snapshots into directory; see mirror.Mirror.
+
+        Every snapshot is downloaded, or those matching the snapshots
+        patterns.
+        '''
+        from cloudlandclient.mirror import Mirror
+        return Mirror(self, directory, concurrency=concurrency,
+                      connections=connections, bandwidth=bandwidth,
+                      quiet=quiet).run(snapshots, force=force,
+                                       deadline=deadline)
@@ -0,0 +1,594 @@
+'''
+Parallel, resumable, verified HTTP downloads.
+
+When the server honours Range requests the file is split into parts
+fetched over several connections, each written in place with positioned
+writes into a preallocated "<file>.part". Progress is recorded in a
+sidecar "<file>.part.progress" so an interrupted download resumes where
+it stopped. Servers without Range support get a single buffered stream.
+
+A SHA-256 of the file is computed while it downloads and checked against
+the expected checksum, if one is given or sent in a Digest header. Only
+a complete, verified file is renamed to its final name. A local file
+already matching the remote size and checksum or ETag is not fetched
+again.
+'''
+
+import base64
+import binascii
+from concurrent import futures
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+import requests
+
+from cloudlandclient.exc import ChecksumMismatch
+from cloudlandclient.exc import SomeThingWrong
+from cloudlandclient import retry
+
+
+logger = logging.getLogger(__name__)
+
+M = 1024 * 1024
+CONTENT_RANGE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+)')
+# Extended attributes holding the ETag or Last-Modified of a download
+# and the SHA-256 it was verified with.
+VALIDATOR_XATTR = 'user.cloudland.validator'
+DIGEST_XATTR = 'user.cloudland.sha256'
+
+
+class Downloader(object):
+    '''Fetch URLs to local files, or to stdout.
+
+    connections is the number of ranges fetched at once, part_size the
+    smallest range worth its own connection, chunk_size the size of each
+    read and write, and save_interval how often, in seconds, progress is
+    written to the sidecar. After a fetch, digest holds the hex SHA-256
+    of the file and skipped tells whether a local copy was kept.
+
+    Downloaders running side by side can share a TokenBucket as
+    bandwidth, a semaphore as slots capping the requests streaming at
+    once, and a Progress as meter, which counts every byte they expect
+    and receive.
+
+    Every request is sent with timeout, a (connect, read) pair or a
+    single number of seconds. A range whose request fails or stops
+    sending is asked for again from where it stopped, as retry_policy
+    allows; past that the download fails and resumes on the next run.
+    The deadline given to fetch caps those timeouts and the pauses
+    between attempts, and stops the transfer once it is spent.
+    '''
+
+    def __init__(self, session=None, connections=4, part_size=8 * M,
+                 chunk_size=M, save_interval=1.0, quiet=False,
+                 bandwidth=None, slots=None, meter=None, timeout=(10, 60),
+                 retry_policy=None):
+        self.session = session or requests
+        self.connections = max(1, connections)
+        self.part_size = part_size
+        self.chunk_size = chunk_size
+        self.save_interval = save_interval
+        self.quiet = quiet
+        self.bandwidth = bandwidth
+        self.slots = slots
+        self.meter = meter
+        self.timeout = timeout
+        self.retry_policy = retry_policy or retry.RetryPolicy()
+        self.digest = None
+        self.skipped = False
+        self.deadline = retry.Deadline()
+
+    def fetch(self, url, filename=None, checksum=None, force=False,
+              deadline=None):
+        '''Download url to filename.
+
+        filename defaults to the last part of the url in the current
+        directory; '-' writes to stdout. checksum is the expected
+        SHA-256, in hex and optionally prefixed by "sha256:". Unless
+        force is set, an existing filename with the remote size and the
+        expected checksum, or the ETag it was downloaded with, is kept.
+        deadline is a retry.Deadline or a number of seconds. Returns
+        filename.
+        '''
+        filename = filename or url.split('/')[-1]
+        self.digest = None
+        self.skipped = False
+        self.deadline = retry.Deadline.of(deadline)
+        if checksum and ':' in checksum:
+            algorithm, checksum = checksum.split(':', 1)
+            if algorithm.lower() not in ('sha256', 'sha-256'):
+                raise SomeThingWrong(message='Only sha256 checksums are '
+                                     'supported, not %s.' % algorithm)
+        # A one byte range request tells whether ranges are supported; if
+        # they are not, its body is the whole file and is used as is.
+        headers = {}
+        if filename != '-':
+            headers['Range'] = 'bytes=0-0'
+        with self._slot():
+            probe = self._get(url, headers)
+            probe.raise_for_status()
+            checksum = checksum or _digest_header(probe.headers) or ''
+            checksum = checksum.lower()
+            validator = probe.headers.get('etag') or probe.headers.get(
+                'last-modified')
+            match = CONTENT_RANGE.match(probe.headers.get('content-range',
+                                                          ''))
+            if filename == '-':
+                return self._stdout(probe, checksum)
+            if probe.status_code == 206 and match:
+                length = int(match.group(3))
+            else:
+                length = int(probe.headers.get('content-length') or -1)
+            if not force and self._current(filename, length, checksum,
+                                           validator):
+                probe.close()
+                self.skipped = True
+                logger.info('%s is up to date.' % filename)
+                return filename
+            if probe.status_code != 206 or not match:
+                return self._stream(probe, filename, checksum, validator)
+            probe.close()
+        return self._ranged(url, filename, length, checksum, validator)
+
+    def _get(self, url, headers):
+        self.deadline.check()
+        if isinstance(self.timeout, tuple):
+            timeout = tuple(self.deadline.cap(t) for t in self.timeout)
+        else:
+            timeout = self.deadline.cap(self.timeout)
+        return self.session.get(url, headers=headers, stream=True,
+                                timeout=timeout)
+
+    def _slot(self):
+        # Held by every request while its body streams.
+        if self.slots is None:
+            return _nothing()
+        return self.slots
+
+    def _expect(self, size):
+        if self.meter is not None and size > 0:
+            self.meter.expect(size)
+
+    def _received(self, progress, size):
+        progress.advance(size)
+        if self.meter is not None:
+            self.meter.advance(size)
+        if self.bandwidth is not None:
+            self.bandwidth.consume(size)
+
+    def _current(self, filename, length, checksum, validator):
+        '''Whether filename already holds the remote file.
+
+        The ETag or Last-Modified and the digest stored with the file
+        are checked first; the file is hashed again only when neither
+        tells.
+        '''
+        if not os.path.isfile(filename) or length < 0 or (
+                os.path.getsize(filename) != length):
+            return False
+        digest = _get_xattr(filename, DIGEST_XATTR)
+        if checksum and digest and digest != checksum:
+            return False
+        if checksum and digest == checksum or validator is not None and (
+                _get_xattr(filename, VALIDATOR_XATTR) == validator):
+            self.digest = digest
+            return True
+        if not checksum or self._hash(filename) != checksum:
+            return False
+        self.digest = checksum
+        _set_xattr(filename, DIGEST_XATTR, checksum)
+        return True
+
+    def _hash(self, filename):
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _complete(self, tmp, filename, checksum, validator, digest):
+        self.digest = digest
+        if checksum and digest != checksum:
+            os.remove(tmp)
+            raise ChecksumMismatch(filename, checksum, digest)
+        if validator:
+            _set_xattr(tmp, VALIDATOR_XATTR, validator)
+        _set_xattr(tmp, DIGEST_XATTR, digest)
+        _replace(tmp, filename)
+
+    def _stdout(self, res, checksum):
+        length = int(res.headers.get('content-length') or 0) or None
+        progress = Progress('-', length, quiet=self.quiet,
+                            stream=sys.stderr)
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+        digest = hashlib.sha256()
+        received = 0
+        self._expect(length or 0)
+        for chunk in res.iter_content(chunk_size=self.chunk_size):
+            self.deadline.check()
+            if chunk:
+                out.write(chunk)
+                digest.update(chunk)
+                received += len(chunk)
+                self._received(progress, len(chunk))
+        out.flush()
+        progress.finish()
+        self.digest = digest.hexdigest()
+        if length is not None and received != length:
+            raise SomeThingWrong(message='Download truncated at %d of %d '
+                                 'bytes.' % (received, length))
+        if checksum and self.digest != checksum:
+            raise ChecksumMismatch('-', checksum, self.digest)
+        return '-'
+
+    def _stream(self, res, filename, checksum, validator):
+        length = int(res.headers.get('content-length') or 0)
+        progress = Progress(filename, length, quiet=self.quiet)
+        tmp = filename + '.part'
+        digest = hashlib.sha256()
+        received = 0
+        self._expect(length)
+        try:
+            with open(tmp, 'wb', self.chunk_size) as f:
+                for chunk in res.iter_content(chunk_size=self.chunk_size):
+                    self.deadline.check()
+                    if chunk:
+                        f.write(chunk)
+                        digest.update(chunk)
+                        received += len(chunk)
+                        self._received(progress, len(chunk))
+            if length and received != length:
+                raise SomeThingWrong(message='Download of %s truncated at '
+                                     '%d of %d bytes.' % (filename, received,
+                                                          length))
+        except BaseException:
+            # Without ranges there is nothing to resume from.
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        progress.finish()
+        self._complete(tmp, filename, checksum, validator,
+                       digest.hexdigest())
+        return filename
+
+    def _parts(self, length):
+        count = min(self.connections,
+                    max(1, (length + self.part_size - 1) // self.part_size))
+        size = (length + count - 1) // count
+        # [start, end (inclusive), next byte to fetch]
+        return [[start, min(start + size, length) - 1, start]
+                for start in range(0, length, size)]
+
+    def _load_progress(self, sidecar, url, length, validator):
+        if not os.path.isfile(sidecar):
+            return None
+        try:
+            with open(sidecar) as f:
+                record = json.load(f)
+        except ValueError:
+            return None
+        if [record.get('url'), record.get('length'),
+                record.get('validator')] != [url, length, validator]:
+            logger.info('%s is stale, starting over.' % sidecar)
+            return None
+        return record['parts']
+
+    def _save_progress(self, sidecar, url, length, validator, parts):
+        record = {'url': url, 'length': length, 'validator': validator,
+                  'parts': parts}
+        tmp = sidecar + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(record, f)
+        _replace(tmp, sidecar)
+
+    def _ranged(self, url, filename, length, checksum, validator):
+        tmp = filename + '.part'
+        sidecar = tmp + '.progress'
+        parts = None
+        if os.path.isfile(tmp):
+            parts = self._load_progress(sidecar, url, length, validator)
+        if parts is None:
+            parts = self._parts(length)
+        held = sum(part[2] - part[0] for part in parts)
+        progress = Progress(filename, length, held, quiet=self.quiet)
+        self._expect(length - held)
+        lock = progress.lock
+        stop = threading.Event()
+
+        def save():
+            with lock:
+                self._save_progress(sidecar, url, length, validator, parts)
+
+        def saver():
+            while not stop.wait(self.save_interval):
+                save()
+
+        def fetch_part(part):
+            policy = self.retry_policy
+            attempt = 0
+            while True:
+                try:
+                    return fetch_range(part)
+                except requests.exceptions.RequestException as e:
+                    if not policy.should_retry(attempt, True, error=e):
+                        raise
+                    logger.info('Retrying bytes %d-%d of %s after %s'
+                                % (part[2], part[1], url, e))
+                time.sleep(self.deadline.cap(policy.delay(attempt)))
+                attempt += 1
+
+        def fetch_range(part):
+            headers = {'Range': 'bytes=%d-%d' % (part[2], part[1])}
+            if validator:
+                headers['If-Range'] = validator
+            with self._slot():
+                res = self._get(url, headers)
+                res.raise_for_status()
+                if res.status_code != 206:
+                    raise IOError('%s changed during download.' % url)
+                # A server may send less than was asked for, but never
+                # another part of the file.
+                sent = res.headers.get('content-range', '')
+                match = CONTENT_RANGE.match(sent)
+                if not match or int(match.group(1)) != part[2] or (
+                        int(match.group(2)) > part[1]) or (
+                        int(match.group(3)) != length):
+                    raise IOError('%s sent range "%s" for bytes %d-%d of %d.'
+                                  % (url, sent, part[2], part[1], length))
+                end = int(match.group(2)) + 1
+                for chunk in res.iter_content(chunk_size=self.chunk_size):
+                    self.deadline.check()
+                    chunk = chunk[:end - part[2]]
+                    if chunk:
+                        offset = part[2]
+                        _pwrite(fd, chunk, offset)
+                        with lock:
+                            part[2] += len(chunk)
+                        self._received(progress, len(chunk))
+                        digest.feed(offset, chunk)
+
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            digest = SequentialDigest(fd, parts, lock, self.chunk_size)
+            if os.fstat(fd).st_size != length:
+                if hasattr(os, 'posix_fallocate') and length:
+                    os.posix_fallocate(fd, 0, length)
+                os.ftruncate(fd, length)
+            save()
+            # Hash what an earlier run left behind.
+            digest.catch_up()
+            thread = threading.Thread(target=saver)
+            thread.daemon = True
+            thread.start()
+            pending = [part for part in parts if part[2] <= part[1]]
+            try:
+                with futures.ThreadPoolExecutor(
+                        max_workers=max(1, len(pending))) as executor:
+                    for result in [executor.submit(fetch_part, part)
+                                   for part in pending]:
+                        result.result()
+            finally:
+                stop.set()
+                thread.join()
+                save()
+            # Short ranges leave gaps; keep them for the next run.
+            missing = sum(part[1] + 1 - part[2] for part in parts)
+            if missing:
+                raise SomeThingWrong(message='Download of %s is missing %d '
+                                     'of %d bytes, run it again to resume.'
+                                     % (filename, missing, length))
+            digest.catch_up()
+        finally:
+            os.close(fd)
+        os.remove(sidecar)
+        progress.finish()
+        self._complete(tmp, filename, checksum, validator,
+                       digest.hexdigest())
+        return filename
+
+
+class SequentialDigest(object):
+    '''SHA-256 of a file whose parts are written concurrently.
+
+    Chunks written at the hashed position are hashed as they arrive.
+    Parts that run ahead are left on disk, and once the bytes before
+    them are complete they are read back, usually from the page cache,
+    after which their remaining chunks are hashed inline too.
+    '''
+
+    def __init__(self, fd, parts, lock, chunk_size=M):
+        self.fd = fd
+        self.parts = parts
+        # The lock guarding the parts' progress.
+        self.parts_lock = lock
+        self.chunk_size = chunk_size
+        self.hash = hashlib.sha256()
+        self.position = 0
+        self.lock = threading.Lock()
+
+    def _contiguous(self):
+        # End of the bytes written without a gap from the start.
+        with self.parts_lock:
+            end = 0
+            for start, last, next in sorted(self.parts):
+                if start > end:
+                    break
+                end = max(end, next)
+                if next <= last:
+                    break
+        return end
+
+    def feed(self, offset, chunk):
+        with self.lock:
+            if offset == self.position:
+                self.hash.update(chunk)
+                self.position += len(chunk)
+                ended = any(self.position == part[1] + 1
+                            for part in self.parts)
+            else:
+                ended = False
+        if ended:
+            self.catch_up()
+
+    def catch_up(self):
+        '''Hash the bytes already written past the position.'''
+        with self.lock:
+            end = self._contiguous()
+            while self.position < end:
+                data = _pread(self.fd, min(self.chunk_size,
+                                           end - self.position),
+                              self.position)
+                if not data:
+                    break
+                self.hash.update(data)
+                self.position += len(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+@contextlib.contextmanager
+def _nothing():
+    yield
+
+
+class TokenBucket(object):
+    '''Bandwidth limit of rate bytes a second, shared by threads.
+
+    The bucket holds up to burst bytes, one second's worth by default.
+    consume() takes bytes already received and sleeps until the bucket
+    has refilled what went over, so the callers together stay at rate.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or self.rate
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= size
+            debt = -self.tokens
+        if debt > 0:
+            time.sleep(debt / self.rate)
+
+
+def _digest_header(headers):
+    # RFC 3230 instance digest, such as "SHA-256=<base64>".
+    for value in (headers.get('digest') or '').split(','):
+        algorithm, _, encoded = value.strip().partition('=')
+        if algorithm.lower() == 'sha-256' and encoded:
+            try:
+                return binascii.hexlify(base64.b64decode(encoded)).decode(
+                    'ascii')
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+def _get_xattr(filename, name):
+    try:
+        return os.getxattr(filename, name).decode('utf-8')
+    except (AttributeError, OSError):
+        return None
+
+
+def _set_xattr(filename, name, value):
+    # Not every platform or file system has extended attributes; such
+    # downloads are matched by hashing them again.
+    try:
+        os.setxattr(filename, name, value.encode('utf-8'))
+    except (AttributeError, OSError):
+        pass
+
+
+def _replace(source, target):
+    getattr(os, 'replace', os.rename)(source, target)
+
+
+class Progress(object):
+    '''Byte counter printing a one line report per megabyte moved.
+
+    length may be None when the total is not known in advance. Reports
+    go to stream, stdout unless the data itself goes there.
+    '''
+
+    def __init__(self, filename, length, position=0, quiet=False,
+                 verb='Downloading', done='received', stream=None):
+        self.filename = filename
+        self.length = length
+        self.position = position
+        self.quiet = quiet
+        self.verb = verb
+        self.done = done
+        self.stream = stream
+        self.reported = -1
+        self.lock = threading.Lock()
+
+    def expect(self, size):
+        '''Add size bytes to the length.'''
+        with self.lock:
+            self.length = (self.length or 0) + size
+
+    def advance(self, size):
+        with self.lock:
+            self.position += size
+            current = self.position // M
+            if self.quiet or current == self.reported:
+                return
+            self.reported = current
+            stream = self.stream or sys.stdout
+            stream.write('\r' + self.line())
+            stream.flush()
+
+    def line(self):
+        return ('%(verb)s %(filename)s, total %(length)sM,'
+                ' %(done)s %(position)sM' %
+                {'verb': self.verb,
+                 'filename': self.filename,
+                 'position': self.position // M,
+                 'done': self.done,
+                 'length': '?' if self.length is None
+                 else self.length // M})
+
+    def finish(self):
+        if not self.quiet:
+            stream = self.stream or sys.stdout
+            stream.write('\n')
+            stream.flush()
+
+
+_pwrite_lock = threading.Lock()
+
+
+def _pwrite(fd, data, offset):
+    if hasattr(os, 'pwrite'):
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+        return
+    with _pwrite_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, data)
+
+
+def _pread(fd, size, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+    with _pwrite_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
@@ -17,3 +17,33 @@ class VlanNotExist(SomeThingWrong):
     """Vlan does not exist."""
     def __init__(self, vlan):
         self.message = "Vlan %s does not exist." % vlan
+
+
+class WaitTimeout(SomeThingWrong):
+    """Timed out waiting for a status."""
+    def __init__(self, vm, status, current):
+        self.message = "VM %s is %s, not %s, after waiting." % (
+            vm, current, status)
+
+
+class VmFailed(SomeThingWrong):
+    """Virtual machine failed."""
+    def __init__(self, vm, status):
+        self.message = "VM %s is %s." % (vm, status)
+
+
+class DeadlineExceeded(SomeThingWrong):
+    """Ran out of time."""
+
+
+class NothingMatched(SomeThingWrong):
+    """Nothing matched."""
+    def __init__(self, kind, pattern):
+        self.message = "No %s matches %s." % (kind, pattern)
+
+
+class ChecksumMismatch(SomeThingWrong):
+    """Checksum mismatch."""
+    def __init__(self, filename, expected, actual):
+        self.message = "%s has checksum %s, expected %s." % (
+            filename, actual, expected)
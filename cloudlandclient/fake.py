@@ -0,0 +1,434 @@
+'''
+In-process fake of the cloudland API, for benchmarks and experiments.
+
+It speaks the protocol CloudlandClient uses: POST op=login sets a session
+cookie, POST exec=* changes the inventory and GET action=get_* lists it,
+all at the same URL. Snapshot downloads are served from /snapshots/ with
+Range support and a SHA-256 Digest header.
+
+    with FakeCloudland(vms=10000, latency=0.005) as fake:
+        client = CloudlandClient(fake.endpoint, 'user', 'password')
+'''
+
+import base64
+import hashlib
+import json
+import random
+import re
+import socket
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl
+    from urllib.parse import urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl
+    from urlparse import urlparse
+
+from cloudlandclient.client import LOGIN_REQUIRED
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing a list response early, as a limited list does,
+        # are expected.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class FakeCloudland(object):
+    '''A cloudland endpoint on 127.0.0.1.
+
+    vms, images, vlans, volumes and snapshots set the size of the initial
+    inventory. Every request is delayed by latency seconds, and a
+    failure_rate fraction of them fail with HTTP 503. Launched VMs stay
+    'building' for boot_time seconds. Snapshots are snapshot_size bytes.
+    calls counts requests by operation.
+    '''
+
+    def __init__(self, vms=10, images=3, vlans=3, volumes=10, snapshots=3,
+                 latency=0.0, failure_rate=0.0, boot_time=0.0,
+                 snapshot_size=1024 * 1024, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.boot_time = boot_time
+        self.snapshot_size = snapshot_size
+        self._digest = None
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.sessions = set()
+        self.counter = 0
+        self.images = dict(('image-%d' % i, ['image-%d' % i, '10G', 'linux',
+                                             'image %d' % i, 'admin'])
+                           for i in range(images))
+        self.vlans = dict((5000 + i, ['%d' % (5000 + i), 'vlan', 'admin'])
+                          for i in range(vlans))
+        self.vms = {}
+        for i in range(vms):
+            self._add_vm('image-%d' % (i % max(images, 1)),
+                         5000 + i % max(vlans, 1), 'vm%d' % i,
+                         'running' if i % 4 else 'shut_off')
+        self.volumes = dict(('vol-%d' % i, ['vol-%d' % i, '10', 'volume',
+                                            '', '', 'false', 'available'])
+                            for i in range(volumes))
+        # VLANs attached to VMs besides their first, by VM. The VM list
+        # does not show them, as on a real server.
+        self.nics = {}
+        # Bytes received of unfinished image uploads, by name.
+        self.uploads = {}
+        self.snapshots = dict(('snap-%d' % i, ['snap-%d' % i, 'available',
+                                               'snapshot', 'admin'])
+                              for i in range(snapshots))
+        self.server = None
+        self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:%d/cloudland/api/' % (
+            self.server.server_address[1])
+
+    def start(self):
+        fake = self
+
+        class Handler(_Handler):
+            pass
+        Handler.fake = fake
+        self.server = _Server(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def expire_sessions(self):
+        '''Forget every login, as when the server's sessions time out.'''
+        with self.lock:
+            self.sessions.clear()
+
+    def snapshot_data(self, offset, size):
+        '''Bytes of every snapshot file, the same for a given offset.'''
+        pattern = hashlib.sha1(b'cloudland').digest() * 3277
+        start = offset % len(pattern)
+        data = pattern[start:] + pattern * (size // len(pattern) + 1)
+        return data[:size]
+
+    def snapshot_digest(self):
+        '''Base64 SHA-256 of every snapshot file, as in a Digest header.'''
+        with self.lock:
+            if self._digest is None:
+                digest = hashlib.sha256()
+                for offset in range(0, self.snapshot_size, 1024 * 1024):
+                    digest.update(self.snapshot_data(
+                        offset, min(1024 * 1024, self.snapshot_size - offset)))
+                self._digest = base64.b64encode(digest.digest()).decode(
+                    'ascii')
+            return self._digest
+
+    def _next_id(self, prefix):
+        self.counter += 1
+        return '%s-%d' % (prefix, self.counter)
+
+    def _add_vm(self, image, vlan, name, status):
+        vm = self._next_id('vm')
+        ip = '10.%d.%d.%d' % (vlan % 256, len(self.vms) // 250 % 256,
+                              len(self.vms) % 250 + 2)
+        self.vms[vm] = [vm, image, ip, name or vm, str(vlan), status,
+                        '5900', 0]
+        return vm
+
+    def _rows(self, table):
+        now = time.time()
+        rows = []
+        for row in table.values():
+            if table is self.vms:
+                if row[5] == 'building' and row[7] <= now:
+                    row[5] = 'running'
+                row = row[:7]
+            rows.append('|'.join(row))
+        return rows
+
+    def list(self, action, params):
+        with self.lock:
+            if action == 'get_vm_list':
+                return self._rows(self.vms) + [0]
+            if action == 'get_img_list':
+                return self._rows(self.images) + [0]
+            if action == 'get_link_list':
+                return self._rows(self.vlans) + [0]
+            if action == 'get_vol_list':
+                return self._rows(self.volumes) + [0]
+            if action == 'get_snapshot_list':
+                return self._rows(self.snapshots) + [0]
+            if action == 'get_upload':
+                name = params.get('name')
+                return ['%s|%d' % (name, len(self.uploads.get(name, b''))),
+                        0]
+            if action == 'get_img':
+                image = self.images.get(params.get('name'))
+                if image is None:
+                    return {}
+                return dict(zip(['name', 'size', 'os', 'desc', 'owner'],
+                                image))
+        return ['Unknown action %s' % action, 1]
+
+    def execute(self, op, data, base):
+        with self.lock:
+            return self._execute(op, data, base)
+
+    def _execute(self, op, data, base):
+        vm = data.get('vm_ID')
+        if op == 'launch_vm':
+            if data.get('image') not in self.images:
+                return ['%s|no such image' % data.get('image'), 1]
+            vm = self._add_vm(data['image'], int(data.get('vlan') or 0),
+                              data.get('name'), 'building')
+            self.vms[vm][7] = time.time() + self.boot_time
+            return ['%s|building' % vm, 0]
+        if op in ('create_vm', 'destroy_vm', 'clear_vm', 'attach_nic',
+                  'create_snapshot') and vm not in self.vms:
+            return ['%s|no such vm' % vm, 1]
+        if op == 'create_vm':
+            self.vms[vm][5] = 'running'
+            return ['%s|running' % vm, 0]
+        if op == 'destroy_vm':
+            self.vms[vm][5] = 'shut_off'
+            return ['%s|shut_off' % vm, 0]
+        if op == 'clear_vm':
+            del self.vms[vm]
+            self.nics.pop(vm, None)
+            return ['%s|deleted' % vm, 0]
+        if op == 'attach_nic':
+            self.nics.setdefault(vm, []).append(int(data.get('vlan')))
+            return ['%s|%s|attached' % (vm, data.get('vlan')), 0]
+        if op == 'upload_img_part':
+            name = data['img_name']
+            offset = int(data.get('offset') or 0)
+            received = self.uploads.setdefault(name, bytearray())
+            if offset == 0:
+                del received[:]
+            if offset != len(received):
+                return ['%s|%d|offset %d' % (name, len(received), offset), 1]
+            received.extend(data.get('img_file', b''))
+            return ['%s|%d' % (name, len(received)), 0]
+        if op == 'upload_img' and data.get('img_sha256'):
+            name = data['img_name']
+            received = self.uploads.get(name, bytearray())
+            digest = hashlib.sha256(received).hexdigest()
+            if digest != data['img_sha256'] or len(received) != int(
+                    data.get('img_size', -1)):
+                return ['%s|checksum mismatch' % name, 1]
+            del self.uploads[name]
+            self.images[name] = [name, '%dM' % (len(received) // 1048576),
+                                 data.get('platform', ''),
+                                 data.get('img_desc', ''), 'admin']
+            return ['%s|created' % name, 0]
+        if op == 'upload_img':
+            name = data.get('img_name') or data.get('img_url', '').split(
+                '/')[-1] or self._next_id('image')
+            self.images[name] = [name, '10G', data.get('platform', ''),
+                                 data.get('img_desc', ''), 'admin']
+            return ['%s|created' % name, 0]
+        if op == 'delete_img':
+            self.images.pop(data.get('img_name'), None)
+            return ['%s|deleted' % data.get('img_name'), 0]
+        if op == 'create_net':
+            vlan = int(data['vlan'])
+            self.vlans[vlan] = [str(vlan), 'vlan', 'admin']
+            return ['%d|created' % vlan, 0]
+        if op == 'clear_net':
+            self.vlans.pop(int(data['vlan']), None)
+            return ['%s|deleted' % data['vlan'], 0]
+        if op == 'create_vol':
+            volume = self._next_id('vol')
+            self.volumes[volume] = [volume, data.get('vol_size', ''),
+                                    data.get('vol_desc', ''), '', '',
+                                    'false', 'available']
+            return ['%s|available' % volume, 0]
+        if op in ('delete_vol', 'attach_vol', 'detach_vol'):
+            volume = self.volumes.get(data.get('vol_name'))
+            if volume is None:
+                return ['%s|no such volume' % data.get('vol_name'), 1]
+            if op == 'delete_vol':
+                del self.volumes[volume[0]]
+                return ['%s|deleted' % volume[0], 0]
+            if op == 'attach_vol':
+                volume[3], volume[6] = vm, 'attached'
+                return ['%s|%s|attached' % (vm, volume[0]), 0]
+            attached, volume[3], volume[6] = volume[3], '', 'available'
+            return ['%s|%s|available' % (attached, volume[0]), 0]
+        if op == 'create_snapshot':
+            snapshot = self._next_id('snap')
+            self.snapshots[snapshot] = [snapshot, 'available',
+                                        data.get('snap_desc', ''), 'admin']
+            return ['%s|available' % snapshot, 0]
+        if op == 'delete_snapshot':
+            self.snapshots.pop(data.get('snapshot'), None)
+            return ['%s|deleted' % data.get('snapshot'), 0]
+        if op == 'download_snapshot':
+            if data.get('snapshot') not in self.snapshots:
+                return [0]
+            # The URI is followed by one more value, which the shell
+            # drops.
+            return ['%ssnapshots/%s.qcow2' % (base, data['snapshot']),
+                    data['snapshot'], 0]
+        return ['Unknown exec %s' % op, 1]
+
+
+def _multipart(body, boundary):
+    # Form fields as text and files as bytes, by name.
+    fields = {}
+    for part in body.split(b'--' + boundary)[1:-1]:
+        head, _, value = part[2:].partition(b'\r\n\r\n')
+        name = re.search(br'name="([^"]*)"', head).group(1).decode('utf-8')
+        value = value[:-2]
+        if b'filename=' not in head:
+            value = value.decode('utf-8')
+        fields[name] = value
+    return fields
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this small
+    # responses wait out the client's delayed ACK.
+    disable_nagle_algorithm = True
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _count(self, operation):
+        with self.fake.lock:
+            calls = self.fake.calls
+            calls[operation] = calls.get(operation, 0) + 1
+
+    def _delay(self):
+        fake = self.fake
+        if fake.latency:
+            time.sleep(fake.latency)
+        if fake.failure_rate and fake.random.random() < fake.failure_rate:
+            self._send(503, 'Service Unavailable')
+            return True
+        return False
+
+    def _send(self, status, body, headers=()):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _session(self):
+        cookies = self.headers.get('Cookie') or ''
+        match = re.search(r'sid=([0-9a-f]+)', cookies)
+        return match and match.group(1) in self.fake.sessions
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if '/snapshots/' in url.path:
+            return self._snapshot()
+        params = dict(parse_qsl(url.query))
+        self._count(params.get('action'))
+        if self._delay():
+            return
+        if not self._session():
+            return self._send(200, LOGIN_REQUIRED)
+        self._send(200, json.dumps(self.fake.list(params.get('action'),
+                                                  params)))
+
+    def _body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+            length = self.headers.get('Content-Length') or 0
+            return self.rfile.read(int(length))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            if size == 0:
+                # Trailers, if any, end with an empty line.
+                while self.rfile.readline().strip():
+                    pass
+                return b''.join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def do_POST(self):
+        body = self._body()
+        match = re.search(r'boundary=(\S+)',
+                          self.headers.get('Content-Type', ''))
+        if match:
+            data = _multipart(body, match.group(1).encode('ascii'))
+        else:
+            data = dict(parse_qsl(body.decode('utf-8'),
+                                  keep_blank_values=True))
+        operation = data.get('op') or data.get('exec')
+        self._count(operation)
+        if self._delay():
+            return
+        if data.get('op') == 'login':
+            if not data.get('username') or not (
+                    data.get('sha1') or data.get('password1')):
+                return self._send(200, LOGIN_REQUIRED)
+            sid = hashlib.sha1(('%s%s' % (data['username'], time.time()))
+                               .encode('utf-8')).hexdigest()
+            with self.fake.lock:
+                self.fake.sessions.add(sid)
+            return self._send(200, 'Welcome',
+                              [('Set-Cookie', 'sid=%s; Path=/' % sid)])
+        if not self._session():
+            return self._send(200, LOGIN_REQUIRED)
+        base = 'http://%s%s' % (self.headers.get('Host'),
+                                self.path.split('cloudland/api/')[0])
+        self._send(200, json.dumps(self.fake.execute(operation, data, base)))
+
+    def _snapshot(self):
+        self._count('snapshot_file')
+        if self._delay():
+            return
+        size = self.fake.snapshot_size
+        start, end = 0, size - 1
+        status = 200
+        headers = [('ETag', '"%d"' % size), ('Accept-Ranges', 'bytes'),
+                   ('Digest', 'SHA-256=%s' % self.fake.snapshot_digest())]
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            status = 206
+            headers.append(('Content-Range',
+                            'bytes %d-%d/%d' % (start, end, size)))
+        self.send_response(status)
+        self.send_header('Content-Length', str(end - start + 1))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        position = start
+        while position <= end:
+            chunk = min(1024 * 1024, end - position + 1)
+            self.wfile.write(self.fake.snapshot_data(position, chunk))
+            position += chunk
@@ -0,0 +1,166 @@
+'''
+Per-operation request metrics, collected through client hooks.
+
+    collector = MetricsCollector()
+    client.add_hook(collector)
+    ...
+    print(collector.prometheus())
+'''
+
+import bisect
+import json
+import threading
+
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class OperationStats(object):
+    __slots__ = ('requests', 'errors', 'retries', 'statuses', 'bytes_sent',
+                 'bytes_received', 'duration', 'buckets')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.statuses = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.duration = 0.0
+        # Count per bucket of BUCKETS, plus one for slower requests.
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, info):
+        self.requests += 1
+        self.retries += info['retries']
+        status = info['status']
+        if info['error'] is not None or status is None or status >= 400:
+            self.errors += 1
+        status = 'error' if status is None else str(status)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes_sent += info['payload_size']
+        self.bytes_received += info['response_size']
+        self.duration += info['duration']
+        self.buckets[bisect.bisect_left(BUCKETS, info['duration'])] += 1
+
+    def quantile(self, q):
+        '''Upper bucket bound below which a fraction q of requests fell.'''
+        rank = q * self.requests
+        seen = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return None
+
+    def as_dict(self):
+        return {'requests': self.requests,
+                'errors': self.errors,
+                'retries': self.retries,
+                'statuses': dict(self.statuses),
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'duration_sum': self.duration,
+                'duration_p50': self.quantile(0.5),
+                'duration_p99': self.quantile(0.99),
+                'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'],
+                                    self.buckets))}
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+class MetricsCollector(object):
+    '''Client hook keeping latency histograms and counters per operation.
+
+    Thread safe, so one collector may be shared by several clients.
+    '''
+
+    def __init__(self, prefix='cloudland'):
+        self.prefix = prefix
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, event, info):
+        if event != 'end':
+            return
+        operation = info['operation'] or 'unknown'
+        with self.lock:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = OperationStats()
+            stats.add(info)
+
+    def reset(self):
+        with self.lock:
+            self.operations.clear()
+
+    def as_dict(self):
+        with self.lock:
+            return dict((operation, stats.as_dict())
+                        for operation, stats in self.operations.items())
+
+    def json(self):
+        return json.dumps(self.as_dict(), sort_keys=True, indent=2)
+
+    def prometheus(self):
+        '''The metrics in the Prometheus text exposition format.'''
+        p = self.prefix
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP %s_%s %s' % (p, name, help))
+            lines.append('# TYPE %s_%s %s' % (p, name, kind))
+            for suffix, labels, value in samples:
+                lines.append('%s_%s%s{%s} %s' % (
+                    p, name, suffix,
+                    ','.join('%s="%s"' % (k, _label(v)) for k, v in labels),
+                    value))
+
+        with self.lock:
+            operations = sorted(self.operations.items())
+            histogram = []
+            for operation, stats in operations:
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), stats.buckets):
+                    cumulative += count
+                    histogram.append(('_bucket', [('operation', operation),
+                                                  ('le', bound)], cumulative))
+                histogram.append(('_sum', [('operation', operation)],
+                                  stats.duration))
+                histogram.append(('_count', [('operation', operation)],
+                                  stats.requests))
+            metric('request_duration_seconds', 'histogram',
+                   'Request latency, retries included.', histogram)
+            metric('requests_total', 'counter', 'Requests by HTTP status.',
+                   [('', [('operation', operation), ('status', status)],
+                     count)
+                    for operation, stats in operations
+                    for status, count in sorted(stats.statuses.items())])
+            for name, help, attr in (
+                    ('request_errors_total', 'Failed requests.', 'errors'),
+                    ('request_retries_total', 'Retried attempts.', 'retries'),
+                    ('request_sent_bytes_total', 'Payload bytes.',
+                     'bytes_sent'),
+                    ('request_received_bytes_total', 'Response bytes.',
+                     'bytes_received')):
+                metric(name, 'counter', help,
+                       [('', [('operation', operation)],
+                         getattr(stats, attr))
+                        for operation, stats in operations])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        '''Save the metrics to filename.
+
+        They are written as JSON if filename ends with .json and in the
+        Prometheus text format otherwise.
+        '''
+        if filename.endswith('.json'):
+            text = self.json()
+        else:
+            text = self.prometheus()
+        with open(filename, 'w') as f:
+            f.write(text)
@@ -0,0 +1,144 @@
+'''
+Mirror snapshots into a local directory.
+
+Every snapshot matching the patterns, all of them by default, is
+downloaded into the directory under the file name of its download URL.
+Several snapshots download at once. Together they keep to a cap on the
+requests streaming at a time and, optionally, to one token bucket
+limiting their bandwidth. A file already present with the remote size
+and checksum or ETag is skipped; see download.Downloader.
+'''
+
+import os
+import threading
+import time
+
+from cloudlandclient import bulk
+from cloudlandclient.download import Downloader
+from cloudlandclient.download import M
+from cloudlandclient.download import Progress
+from cloudlandclient.download import TokenBucket
+from cloudlandclient.exc import NothingMatched
+from cloudlandclient.exc import SomeThingWrong
+from cloudlandclient import retry
+from cloudlandclient import utils
+
+DOWNLOADED = 'downloaded'
+SKIPPED = 'skipped'
+
+
+class Throughput(Progress):
+    '''Progress of many downloads with their rate and time left.
+
+    The length grows as downloads start, so until the last one has
+    started the time left only covers those running or done.
+    '''
+
+    def __init__(self, files, quiet=False):
+        Progress.__init__(self, 'snapshots', 0, quiet=quiet,
+                          verb='Mirroring')
+        self.files = files
+        self.finished = 0
+        self.started = time.time()
+        self.stopped = None
+
+    def file_done(self):
+        with self.lock:
+            self.finished += 1
+
+    def finish(self):
+        self.stopped = time.time()
+        Progress.finish(self)
+
+    def elapsed(self):
+        return (self.stopped or time.time()) - self.started
+
+    def rate(self):
+        '''Bytes received a second since the start.'''
+        elapsed = self.elapsed()
+        return self.position / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        '''Seconds left at the current rate, None before any data.'''
+        rate = self.rate()
+        if not rate:
+            return None
+        return max(0, self.length - self.position) / rate
+
+    def line(self):
+        eta = self.eta()
+        return ('Mirroring %d/%d snapshots, %dM of %dM at %.1fM/s, %s left'
+                % (self.finished, self.files, self.position // M,
+                   self.length // M, self.rate() / M,
+                   '?' if eta is None else '%ds' % eta))
+
+
+class Mirror(object):
+    '''Download snapshots through a CloudlandClient into directory.
+
+    concurrency is the number of snapshots fetched at once, connections
+    the number of requests streaming at once over all of them, and
+    bandwidth, if given, the bytes a second they may receive together.
+    Connections beyond the client's pool_maxsize are not kept alive.
+    After a run, meter holds the Throughput of the run.
+    '''
+
+    def __init__(self, client, directory, concurrency=4, connections=8,
+                 bandwidth=None, quiet=True):
+        self.client = client
+        self.directory = directory
+        self.concurrency = concurrency
+        self.connections = max(1, connections)
+        self.bandwidth = bandwidth
+        self.quiet = quiet
+        self.meter = None
+
+    def run(self, patterns=None, force=False, deadline=None):
+        '''Mirror the snapshots matching patterns, all by default.
+
+        Returns a bulk.Outcome per snapshot, whose result is its file
+        name and DOWNLOADED or SKIPPED, then a failed Outcome per pattern
+        matching nothing. With force, existing files are downloaded
+        again. Snapshots not fetched within deadline fail with
+        DeadlineExceeded, keeping what was received for the next run.
+        '''
+        deadline = retry.Deadline.of(deadline)
+        ids, unmatched = self.client.resolve('snapshot', patterns or ['*'],
+                                             deadline=deadline)
+        if ids and not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.meter = Throughput(len(ids), quiet=self.quiet)
+        slots = threading.BoundedSemaphore(self.connections)
+        bandwidth = None
+        if self.bandwidth:
+            bandwidth = TokenBucket(self.bandwidth)
+
+        def fetch(snapshot):
+            try:
+                deadline.check()
+                # Empty for a snapshot deleted since the list was read.
+                found = utils.loads(self.client.snapshot_download(
+                    snapshot=snapshot, deadline=deadline))
+                if not found:
+                    raise SomeThingWrong(message='Snapshot %s does not '
+                                         'exist.' % snapshot)
+                uri = found[0]
+                filename = os.path.join(self.directory, uri.split('/')[-1])
+                downloader = Downloader(session=self.client.session,
+                                        connections=self.connections,
+                                        quiet=True, bandwidth=bandwidth,
+                                        slots=slots, meter=self.meter,
+                                        timeout=(self.client.connect_timeout,
+                                                 self.client.read_timeout),
+                                        retry_policy=self.client.retry_policy)
+                downloader.fetch(uri, filename, force=force,
+                                 deadline=deadline)
+            finally:
+                self.meter.file_done()
+            return filename, SKIPPED if downloader.skipped else DOWNLOADED
+        outcomes = bulk.run(fetch, ids, concurrency=self.concurrency)
+        self.meter.finish()
+        return outcomes + [bulk.Outcome(pattern,
+                                        error=NothingMatched('snapshot',
+                                                             pattern))
+                           for pattern in unmatched]
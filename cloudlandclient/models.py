@@ -0,0 +1,160 @@
+'''
+Typed records for the pipe-delimited rows of cloudland list responses.
+
+Each record type is built from the column header of its list command,
+for example VM|IMAGE|IP|NAME|VXLAN|STATUS|VNC, and stores one attribute
+per lower-cased column in __slots__. Its first column is the id.
+'''
+
+from cloudlandclient import utils
+
+# VM statuses waited for by the lifecycle commands. A VM missing from
+# the VM list counts as DELETED.
+RUNNING = 'running'
+STOPPED = 'shut_off'
+DELETED = 'deleted'
+FAILED = ('error',)
+
+
+class Record(object):
+    __slots__ = ()
+    head = ''
+    fields = ()
+    # Fields an Inventory keeps a hash index on, besides the id.
+    indexes = ()
+    # Fields that may hold several comma or space separated values.
+    multivalued = ()
+
+    def __init__(self, *values):
+        for field, value in zip(self.fields, values):
+            setattr(self, field, value)
+        for field in self.fields[len(values):]:
+            setattr(self, field, '')
+
+    @classmethod
+    def from_line(cls, line):
+        return cls(*line.split('|')[:len(cls.fields)])
+
+    @property
+    def id(self):
+        return getattr(self, self.fields[0])
+
+    def keys(self, field):
+        value = getattr(self, field)
+        if field in self.multivalued:
+            return [v for v in value.replace(',', ' ').split() if v]
+        return [value]
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self.fields)
+
+    def __iter__(self):
+        return (getattr(self, field) for field in self.fields)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, '|'.join(self))
+
+
+def _record(name, head, indexes=(), multivalued=()):
+    fields = tuple(field.lower() for field in head.split('|'))
+    return type(name, (Record,), {'__slots__': fields,
+                                  'head': head,
+                                  'fields': fields,
+                                  'indexes': indexes,
+                                  'multivalued': multivalued})
+
+
+VM = _record('VM', 'VM|IMAGE|IP|NAME|VXLAN|STATUS|VNC',
+             indexes=('name', 'ip', 'vxlan', 'status', 'image'),
+             multivalued=('ip',))
+Image = _record('Image', 'IMAGE|SIZE|OS|DESC|OWNER',
+                indexes=('os', 'owner'))
+Vlan = _record('Vlan', 'VLAN|DESC|OWNER',
+               indexes=('owner',))
+Volume = _record('Volume', 'VOLUME|SIZE|DESC|VM|DEVICE|BOOTABLE|STATUS',
+                 indexes=('vm', 'status'))
+Snapshot = _record('Snapshot', 'SNAPSHOT|STATUS|DESC|OWNER',
+                   indexes=('status', 'owner'))
+
+# Record type of each list command, keyed by its resource name.
+KINDS = {'vm': VM,
+         'image': Image,
+         'vlan': Vlan,
+         'volume': Volume,
+         'snapshot': Snapshot}
+
+
+def parse(cls, body):
+    '''Records of type cls for every row of a list response body.'''
+    return [cls.from_line(line) for line in utils.loads(body) if line]
+
+
+class Inventory(object):
+    '''Records of one type with hash indexes.
+
+    The indexes are on the id and on the fields named by the type's
+    indexes.
+
+        vms = Inventory(VM, records)
+        vms.get('vm-1')
+        vms.find(vxlan='5001', status='running')
+    '''
+
+    def __init__(self, cls, records=()):
+        self.cls = cls
+        self.records = []
+        self.by_id = {}
+        self.index = dict((field, {}) for field in cls.indexes)
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        self.records.append(record)
+        self.by_id[record.id] = record
+        for field, index in self.index.items():
+            for key in record.keys(field):
+                index.setdefault(key, []).append(record)
+
+    def get(self, id, default=None):
+        return self.by_id.get(id, default)
+
+    def lookup(self, field, value):
+        '''Records whose field holds value, from its index.'''
+        return list(self.index[field].get(str(value), ()))
+
+    def find(self, **criteria):
+        '''Records matching every field=value pair in criteria.'''
+        if not criteria:
+            return list(self.records)
+        indexed = [field for field in criteria if field in self.index]
+        if 'id' in criteria:
+            record = self.get(str(criteria.pop('id')))
+            candidates = [record] if record is not None else []
+        elif indexed:
+            # Start from the smallest index hit and filter the rest.
+            field = min(indexed, key=lambda f: len(
+                self.index[f].get(str(criteria[f]), ())))
+            candidates = self.lookup(field, criteria.pop(field))
+        else:
+            candidates = self.records
+        return [record for record in candidates
+                if all(str(value) in record.keys(field)
+                       for field, value in criteria.items())]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __contains__(self, id):
+        return id in self.by_id
@@ -0,0 +1,265 @@
+'''
+Bring VLANs, VMs, volumes and their attachments in line with a spec.
+
+A spec is a dict, usually read from JSON, such as:
+
+    {"vlans": [{"vlan": 5001, "network": "172.16.1.0",
+                "netmask": "255.255.255.0", "gateway": "172.16.1.1"}],
+     "vms": [{"name": "web-1", "image": "centos7", "vlan": 5001,
+              "vlans": [5002], "cpu": 2, "memory": 2048}],
+     "volumes": [{"desc": "web-1-data", "size": 10, "vm": "web-1"}]}
+
+VLANs are known by number, VMs by name and volumes by description.
+plan() reads the current state with one list call per resource type and
+returns the steps creating what is missing, each depending on the steps
+that create what it needs. Plan.apply() runs independent steps
+concurrently. Nothing that exists is changed or deleted.
+
+The VM list shows a VM's first VLAN only, so whether a VM that exists
+has the others of its "vlans" cannot be told. They are attached to the
+VMs the plan creates only; attaching them to the others would add
+another NIC on every run.
+'''
+
+from concurrent import futures
+
+from cloudlandclient import bulk
+from cloudlandclient.exc import SomeThingWrong
+from cloudlandclient.models import RUNNING
+from cloudlandclient import utils
+
+
+class Step(object):
+    '''One call of a plan.
+
+    action and resource describe it, requires holds the keys of the
+    steps it waits for.
+    '''
+    __slots__ = ('key', 'action', 'resource', 'requires', 'func')
+
+    def __init__(self, key, action, resource, func, requires=()):
+        self.key = key
+        self.action = action
+        self.resource = resource
+        self.func = func
+        self.requires = list(requires)
+
+    def __repr__(self):
+        return '<Step %s>' % self.key
+
+
+class Plan(object):
+    '''Steps to reconcile a spec, in an order respecting requires.'''
+
+    def __init__(self, client):
+        self.client = client
+        self.steps = []
+        self.keys = {}
+        # Ids of VMs and volumes by spec name, filled in as they are
+        # found or created.
+        self.vms = {}
+        self.volumes = {}
+        # VMs created by this plan, which must boot before attaching.
+        self.booting = set()
+
+    def add(self, key, action, resource, func, requires=()):
+        step = Step(key, action, resource, func,
+                    [r for r in requires if r in self.keys])
+        self.steps.append(step)
+        self.keys[key] = step
+        return step
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def lines(self):
+        '''ACTION|RESOURCE|REQUIRES rows describing the plan.'''
+        return ['%s|%s|%s' % (step.action, step.resource,
+                              ', '.join(step.requires))
+                for step in self.steps]
+
+    def apply(self, concurrency=8):
+        '''Run the steps, each once those it requires succeeded.
+
+        Returns a bulk.Outcome per step, in plan order. Steps whose
+        requirements failed are not run and fail too.
+        '''
+        outcomes = dict((step.key, bulk.Outcome(step)) for step in self)
+        pending = list(self.steps)
+        running = {}
+        finished = set()
+        executor = futures.ThreadPoolExecutor(max_workers=max(1,
+                                                              concurrency))
+        try:
+            while pending or running:
+                for step in list(pending):
+                    failed = [r for r in step.requires
+                              if r in finished and not outcomes[r].ok]
+                    if failed:
+                        outcomes[step.key].error = SomeThingWrong(
+                            message='Skipped, %s failed.' % failed[0])
+                        finished.add(step.key)
+                        pending.remove(step)
+                    elif all(r in finished for r in step.requires):
+                        pending.remove(step)
+                        future = executor.submit(bulk.call, _run, step)
+                        running[future] = step
+                if not running:
+                    continue
+                done, _ = futures.wait(
+                    running, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    outcomes[step.key] = future.result()
+                    finished.add(step.key)
+        finally:
+            executor.shutdown(wait=True)
+        return [outcomes[step.key] for step in self.steps]
+
+
+def _run(step):
+    return step.func()
+
+
+def _id(body):
+    # The first column of the first row of a create response.
+    return utils.cut(utils.loads(body))[0]
+
+
+def plan(client, spec, deadline=None):
+    '''The Plan bringing the cloud in line with spec.'''
+    result = Plan(client)
+    vlans = client.inventory('vlan', deadline=deadline)
+    vms = client.inventory('vm', deadline=deadline)
+    volumes = client.inventory('volume', deadline=deadline)
+
+    for vlan in spec.get('vlans', ()):
+        number = int(vlan['vlan'])
+        if str(number) in vlans:
+            continue
+        result.add('vlan/%d' % number, 'create', 'vlan %d' % number,
+                   _create_vlan(client, vlan))
+
+    for vm in spec.get('vms', ()):
+        name = vm['name']
+        record = (vms.lookup('name', name) or [None])[0]
+        if record is not None:
+            result.vms[name] = record.id
+            continue
+        result.add('vm/%s' % name, 'create', 'vm %s' % name,
+                   _create_vm(result, vm),
+                   requires=['vlan/%d' % int(vm['vlan'])])
+        for vlan in vm.get('vlans', ()):
+            if str(vlan) == str(vm['vlan']):
+                continue
+            result.add('vm/%s/vlan/%s' % (name, vlan), 'attach',
+                       'vlan %s to vm %s' % (vlan, name),
+                       _attach_vlan(result, name, vlan),
+                       requires=['vm/%s' % name, 'vlan/%s' % vlan])
+
+    for volume in spec.get('volumes', ()):
+        desc = volume['desc']
+        record = (volumes.find(desc=desc) or [None])[0]
+        if record is None:
+            result.add('volume/%s' % desc, 'create', 'volume %s' % desc,
+                       _create_volume(result, volume))
+            current = None
+        else:
+            result.volumes[desc] = record.id
+            current = record.vm
+        vm = volume.get('vm')
+        if not vm:
+            continue
+        known = result.vms.get(vm)
+        if known is None:
+            # A VM outside the spec the volume is attached to.
+            found = (vms.lookup('name', vm) or [None])[0]
+            if found is not None:
+                known = result.vms[vm] = found.id
+        if current and current == known:
+            continue
+        result.add('volume/%s/vm/%s' % (desc, vm), 'attach',
+                   'volume %s to vm %s' % (desc, vm),
+                   _attach_volume(result, desc, vm),
+                   requires=['volume/%s' % desc, 'vm/%s' % vm])
+    return result
+
+
+def _create_vlan(client, vlan):
+    def create():
+        body = client.vlan_create(
+            vlan=int(vlan['vlan']),
+            network=vlan['network'],
+            netmask=vlan['netmask'],
+            gateway=vlan.get('gateway'),
+            start_ip=vlan.get('start_ip'),
+            end_ip=vlan.get('end_ip'),
+            shared=str(vlan.get('shared', False)).lower(),
+            use_dhcp=str(vlan.get('use_dhcp', True)).lower())
+        utils.loads(body)
+        return body
+    return create
+
+
+def _create_vm(plan, vm):
+    def create():
+        metadata = {}
+        if vm.get('user_data'):
+            metadata['user_data'] = utils.read_file(vm['user_data'])
+        body = plan.client.vm_create(
+            image=vm['image'], vlan=int(vm['vlan']), name=vm['name'],
+            cpu=vm.get('cpu'), memory=vm.get('memory'),
+            increase=vm.get('increase'), metadata=metadata)
+        plan.vms[vm['name']] = _id(body)
+        plan.booting.add(vm['name'])
+        return body
+    return create
+
+
+def _running(plan, name):
+    # Attaching to a VM this plan created waits for it to boot.
+    if name not in plan.booting:
+        return
+    outcome = plan.client.wait_for([plan.vms[name]], RUNNING)[0]
+    if not outcome.ok:
+        raise outcome.error
+
+
+def _vm_id(plan, name):
+    if name not in plan.vms:
+        raise SomeThingWrong(message='VM %s is not in the spec and does '
+                             'not exist.' % name)
+    return plan.vms[name]
+
+
+def _attach_vlan(plan, name, vlan):
+    def attach():
+        vm = _vm_id(plan, name)
+        _running(plan, name)
+        body = plan.client.vlan_attach(vlan=int(vlan), vm=vm)
+        utils.loads(body)
+        return body
+    return attach
+
+
+def _create_volume(plan, volume):
+    def create():
+        body = plan.client.volume_create(size=volume['size'],
+                                         image=volume.get('image'),
+                                         desc=volume['desc'])
+        plan.volumes[volume['desc']] = _id(body)
+        return body
+    return create
+
+
+def _attach_volume(plan, desc, name):
+    def attach():
+        vm = _vm_id(plan, name)
+        _running(plan, name)
+        body = plan.client.volume_attach(volume=plan.volumes[desc], vm=vm)
+        utils.loads(body)
+        return body
+    return attach
@@ -0,0 +1,102 @@
+'''
+Retry and time budget policy for API calls.
+'''
+
+import random
+import time
+
+import requests
+# The urllib3 requests raises from, vendored by older releases.
+from requests.packages.urllib3 import exceptions as urllib3_exceptions
+
+from cloudlandclient.exc import DeadlineExceeded
+
+# Errors of connecting, including subclasses such as NameResolutionError;
+# NewConnectionError is missing from the urllib3 of requests before 2.8.
+_CONNECT_ERRORS = tuple(getattr(urllib3_exceptions, name)
+                        for name in ('NewConnectionError',
+                                     'ConnectTimeoutError')
+                        if hasattr(urllib3_exceptions, name))
+
+
+class Deadline(object):
+    '''A wall clock budget shared by every request of an operation.
+
+    Bulk and waiting operations take a deadline and pass it down, so
+    retries, pauses and request timeouts all draw from the same budget.
+    '''
+
+    def __init__(self, seconds=None):
+        self.expires = None if seconds is None else time.time() + seconds
+
+    @classmethod
+    def of(cls, deadline):
+        '''A Deadline from a Deadline, a number of seconds or None.'''
+        if isinstance(deadline, Deadline):
+            return deadline
+        return cls(deadline)
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.time())
+
+    def cap(self, seconds):
+        '''seconds, shortened to what is left of the budget.'''
+        remaining = self.remaining()
+        if remaining is None:
+            return seconds
+        if seconds is None:
+            return remaining
+        return min(seconds, remaining)
+
+    def check(self):
+        if self.remaining() == 0:
+            raise DeadlineExceeded()
+
+
+def _connect_failed(error):
+    # The request never reached the server, so even a mutating call is
+    # safe to send again.
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError):
+        return False
+    reason = getattr(error.args[0] if error.args else None, 'reason', None)
+    return isinstance(reason, _CONNECT_ERRORS)
+
+
+class RetryPolicy(object):
+    '''Exponential backoff with full jitter.
+
+    Idempotent calls, the list and show GETs, are retried after any
+    connection error, timeout or a status in statuses. Mutating exec
+    POSTs are retried only when the connection could not be made.
+    '''
+
+    def __init__(self, retries=3, backoff=0.5, max_backoff=30,
+                 statuses=(500, 502, 503, 504)):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = statuses
+
+    def delay(self, attempt):
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def should_retry(self, attempt, idempotent, error=None, response=None):
+        if attempt >= self.retries:
+            return False
+        if error is not None:
+            if _connect_failed(error):
+                return True
+            return idempotent and isinstance(
+                error, (requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout,
+                        requests.exceptions.ChunkedEncodingError))
+        return idempotent and response.status_code in self.statuses
+
+
+# A policy that sends every request exactly once.
+NO_RETRY = RetryPolicy(retries=0)
@@ -3,18 +3,97 @@ Command line interface to cloudland.
 '''
 
 import argparse
-import cloudlandclient
-from cloudlandclient.client import CloudlandClient
+from cloudlandclient.exc import SomeThingWrong
+from cloudlandclient import metrics
+from cloudlandclient import models
 from cloudlandclient import utils
+import contextlib
+import io
 import json
 import logging
 import os
+import shlex
 import sys
+import threading
+import time
 
 
 logger = logging.getLogger(__name__)
 
 
+def output_args(func):
+    '''Add the --format and --fields options of list and show commands.'''
+    utils.arg('--fields', metavar='<FIELDS>',
+              help='Comma separated columns to print, for example, '
+                   'vm,name,status.')(func)
+    utils.arg('--format', choices=utils.FORMATS, default='table',
+              help='Output format. All but table are written row by row '
+                   'as the response arrives.')(func)
+    return func
+
+
+def list_args(func):
+    '''Add the --filter, --sort and --limit options of list commands.'''
+    utils.arg('--limit', metavar='<LIMIT>', type=int,
+              help='Print at most <LIMIT> rows. Without --sort, stop '
+                   'reading the list once they are found.')(func)
+    utils.arg('--sort', metavar='<FIELD[:desc],...>',
+              help='Sort rows by these fields, for example, '
+                   'vxlan,name:desc.')(func)
+    utils.arg('--filter', metavar='<FIELD=VALUE>', action='append',
+              help='Only print rows where FIELD is VALUE, or is not with '
+                   'FIELD!=VALUE. VALUE may have * and ? wildcards. '
+                   'Repeat to combine filters.')(func)
+    return func
+
+
+def watch_args(func):
+    '''Add the --watch and --interval options of list commands.'''
+    utils.arg('--interval', metavar='<SECONDS>', type=float, default=5,
+              help='Seconds between polls with --watch.')(func)
+    utils.arg('--watch', action='store_true',
+              help='Keep polling and print added, removed and changed '
+                   'rows as JSON lines.')(func)
+    return func
+
+
+def wait_args(state):
+    '''Add the --wait and --wait-timeout options of VM commands.
+
+    --wait waits until the virtual machines are state, as in 'running'.
+    '''
+    def add(func):
+        utils.arg('--wait-timeout', metavar='<SECONDS>', type=int,
+                  default=600,
+                  help='Seconds to wait with --wait.')(func)
+        utils.arg('--wait', action='store_true',
+                  help='Wait until the virtual machines are %s.'
+                       % state)(func)
+        return func
+    return add
+
+
+def bulk_args(func):
+    '''Add the --concurrency and --rate options of bulk commands.
+
+    These are the commands taking several ids or patterns.
+    '''
+    utils.arg('--rate', metavar='<PER SECOND>', type=float,
+              help='Start at most this many calls a second.')(func)
+    utils.arg('--concurrency', metavar='<CONCURRENCY>', type=int,
+              default=8,
+              help='Calls to run at the same time.')(func)
+    return func
+
+
+def _progress_wanted(output):
+    # Progress goes to a terminal only. Downloads to stdout report on
+    # stderr; under batch both are captured, and a download's worker
+    # threads would write past the capture.
+    stream = sys.stderr if output == '-' else sys.stdout
+    return stream.isatty()
+
+
 class CloudlandShell:
 
     def get_base_parser(self):
@@ -32,8 +111,7 @@ class CloudlandShell:
                             help=argparse.SUPPRESS)
 
         parser.add_argument('--version',
-                            action='version',
-                            version=cloudlandclient.__version__,
+                            action=VersionAction,
                             help="Shows the client version and exits.")
 
         parser.add_argument('--debug',
@@ -52,15 +130,46 @@ class CloudlandShell:
                             default=os.environ.get('CLOUDLAND_ENDPOINT'),
                             help='Defaults to env[CLOUDLAND_ENDPOINT].')
 
+        parser.add_argument('--metrics',
+                            metavar='<FILE>',
+                            help='Write request metrics to <FILE>, as JSON '
+                                 'if it ends with .json and in the '
+                                 'Prometheus text format otherwise.')
+
         return parser
 
-    def get_subcommand_parser(self):
-        parser = self.get_base_parser()
+    def get_subcommand_parser(self, parser=None, commands=None):
+        '''Add subcommands to parser.
+
+        Only those named in commands are added if given, since building
+        every subparser dominates startup.
+        '''
+        if parser is None:
+            parser = self.get_base_parser()
         self.subcommands = {}
         subparsers = parser.add_subparsers(metavar='<subcommand>')
-        self._find_actions(subparsers, self)
+        self._find_actions(subparsers, self, commands)
         return parser
 
+    def _commands_for(self, args):
+        '''Subcommands needed to parse the leftover args.
+
+        args are those the base parser left; None means all subcommands
+        are needed.
+        '''
+        names = [a for a in args if not a.startswith('-')]
+        if not names:
+            return None
+        known = set(a[3:].replace('_', '-') for a in dir(self)
+                    if a.startswith('do_'))
+        if names[0] not in known:
+            return None
+        if names[0] == 'help':
+            if len(names) < 2 or names[1] not in known:
+                return None
+            return names[:2]
+        return names[:1]
+
     @utils.arg('command', metavar='<subcommand>', nargs='?',
                help='Display help for <subcommand>.')
     def do_help(self, args):
@@ -74,11 +183,13 @@ class CloudlandShell:
         else:
             self.parser.print_help()
 
-    @utils.arg('image', help='Image to create the virtual machine.')
-    @utils.arg('vlan', type=int,
+    @utils.arg('image', nargs='?',
+               help='Image to create the virtual machine.')
+    @utils.arg('vlan', type=int, nargs='?',
                help='VLAN attched to the virtual machine to create.')
     @utils.arg('--name', metavar='<NAME>', required=False,
-               help='Hostname of the virtual machine to create.')
+               help='Hostname of the virtual machine to create, '
+                    'for example, web-{i} when creating several.')
     @utils.arg('--cpu', metavar='<CPU>', type=int, required=False,
                help='CPU number of the virtual machine to create.')
     @utils.arg('--memory', metavar='<MEMORY>', type=int,
@@ -88,81 +199,267 @@ class CloudlandShell:
                help=' Disk size to increase in Giga bytes.')
     @utils.arg('--user-data', metavar='<USER DATA>', required=False,
                help='User data of the virtual machine to create.')
+    @utils.arg('--count', metavar='<COUNT>', type=int, default=1,
+               help='Number of virtual machines to create.')
+    @utils.arg('--manifest', metavar='<MANIFEST>',
+               help='JSON file with a list of virtual machines to create, '
+                    'each with the keys image, vlan, name, cpu, memory, '
+                    'increase and user_data.')
+    @utils.arg('--concurrency', metavar='<CONCURRENCY>', type=int,
+               default=8,
+               help='Virtual machines to create at the same time.')
+    @wait_args('running')
     def do_vm_create(self, args):
         """Create virtual machine."""
         metadata = {}
         if args.user_data:
             metadata["user_data"] = utils.read_file(args.user_data)
-        body = self.client.vm_create(
+        specs = None
+        if args.manifest:
+            specs = json.loads(utils.read_file(args.manifest))
+            for spec in specs:
+                if 'user_data' in spec:
+                    spec['metadata'] = {
+                        'user_data': utils.read_file(spec.pop('user_data'))}
+        elif args.image is None or args.vlan is None:
+            raise Exception('<image> and <vlan> are required '
+                            'without --manifest.')
+        if specs is None and args.count == 1:
+            body = self.client.vm_create(
+                image=args.image,
+                vlan=args.vlan,
+                name=args.name,
+                cpu=args.cpu,
+                memory=args.memory,
+                increase=args.increase,
+                metadata=metadata)
+            utils.pretty(head="VM|STATUS", body=body)
+            if args.wait:
+                return self._wait(body, models.RUNNING, args)
+            return
+        outcomes = self.client.vm_create_many(
             image=args.image,
             vlan=args.vlan,
+            count=args.count,
             name=args.name,
+            specs=specs,
+            concurrency=args.concurrency,
             cpu=args.cpu,
             memory=args.memory,
             increase=args.increase,
             metadata=metadata)
-        utils.pretty(head="VM|STATUS", body=body)
+        lines = []
+        vms = []
+        for outcome in outcomes:
+            name = outcome.item['name'] or ''
+            if outcome.ok:
+                created = [line for line in utils.loads(outcome.result)
+                           if line]
+                lines.extend('%s|%s' % (name, line) for line in created)
+                vms.extend(utils.cut(created))
+            else:
+                lines.append('%s||%s' % (name, outcome.error))
+        utils.pretty_lines(head='NAME|VM|STATUS', lines=lines)
+        result = None
+        if args.wait and vms:
+            result = self._wait(vms, models.RUNNING, args)
+        if not all(outcome.ok for outcome in outcomes):
+            return 1
+        return result
+
+    def _bulk(self, head, many, patterns, args, **kwargs):
+        '''Run a *_many client call on patterns.
+
+        Prints a row for every item. Returns the ids it succeeded on and
+        whether any failed.
+        '''
+        outcomes = many(patterns, concurrency=args.concurrency,
+                        rate=args.rate, **kwargs)
+        lines = []
+        done = []
+        for outcome in outcomes:
+            if outcome.ok:
+                lines.extend('%s|' % line
+                             for line in utils.loads(outcome.result) if line)
+                done.append(outcome.item)
+            else:
+                lines.append('%s|%s|%s' % (outcome.item,
+                                           '|' * (head.count('|') - 1),
+                                           outcome.error))
+        utils.pretty_lines(head=head + '|ERROR', lines=lines)
+        failed = len(outcomes) - len(done)
+        print('%d succeeded, %d failed.' % (len(done), failed))
+        return done, failed > 0
+
+    def _act(self, kind, head, action, many, patterns, args, **kwargs):
+        '''Run action on a lone id, or many on every record matched.
+
+        Returns the ids it succeeded on and whether any failed. A lone
+        plain id in patterns is sent as is, without fetching the list.
+        Only when the server refuses it is the list fetched, once, in case
+        it was a VM name; what it resolved to then goes to many.
+        '''
+        resolved = None
+        if len(patterns) == 1 and not any(c in patterns[0] for c in '*?['):
+            body = action(patterns[0], **kwargs)
+            try:
+                utils.loads(body)
+            except SomeThingWrong:
+                resolved = self.client.resolve(kind, patterns)
+                if patterns[0] in resolved[0]:
+                    # An existing id the server refused.
+                    raise
+            else:
+                utils.pretty(head=head, body=body)
+                return patterns, False
+        return self._bulk(head, many, patterns, args, resolved=resolved,
+                          **kwargs)
+
+    def _vm_action(self, args, action, many, status, **kwargs):
+        '''Run action on the VMs of args.vm.
+
+        action runs on a lone VM, many on all VMs args.vm matches; then
+        waits for status with --wait.
+        '''
+        vms, failed = self._act('vm', 'VM|STATUS', action, many, args.vm,
+                                args, **kwargs)
+        result = None
+        if args.wait and vms:
+            result = self._wait(vms, status, args)
+        if failed:
+            return 1
+        return result
+
+    def _watch(self, kind, args):
+        try:
+            for event in self.client.watch(kind, interval=args.interval):
+                sys.stdout.write(json.dumps(event, sort_keys=True) + '\n')
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            return 0
 
+    def _wait(self, vms, status, args):
+        '''Wait for vms, or the VMs of a response body, to reach status.'''
+        if not isinstance(vms, list):
+            vms = utils.cut(utils.loads(vms))
+        outcomes = self.client.wait_for(vms, status,
+                                        timeout=args.wait_timeout)
+        lines = ['%s|%s|%.1f' % (outcome.item, outcome.result,
+                                 outcome.elapsed) for outcome in outcomes]
+        utils.pretty_lines(head='VM|STATUS|SECONDS', lines=lines)
+        for outcome in outcomes:
+            if not outcome.ok:
+                print(str(outcome.error))
+        if not all(outcome.ok for outcome in outcomes):
+            return 1
+
+    @output_args
+    @list_args
+    @watch_args
     def do_vm_list(self, args):
         """List virtual machines."""
-        body = self.client.vm_list()
-        head = 'VM|IMAGE|IP|NAME|VXLAN|STATUS|VNC'
-        utils.pretty(head=head, body=body)
-
-    @utils.arg('vm', metavar='<VM>',
-               help='The virtual machine to start')
+        if args.watch:
+            return self._watch('vm', args)
+        rows = self.client.iter_list('vm', filters=args.filter,
+                                     sort=args.sort, limit=args.limit)
+        utils.output(models.VM.head, rows, args.format, args.fields)
+
+    @utils.arg('vm', metavar='<VM>', nargs='+',
+               help='The virtual machines to start. Several ids, or '
+                    'patterns with * and ?, are matched against the ids '
+                    'and names of one VM list.')
+    @wait_args('running')
+    @bulk_args
     def do_vm_start(self, args):
-        '''Start virtual machine.'''
-        body = self.client.vm_start(vm=args.vm)
-        utils.pretty(head='VM|STATUS', body=body)
-
-    @utils.arg('vm', metavar='<VM>',
-               help='The virtual machine to stop')
+        '''Start virtual machines.'''
+        return self._vm_action(args, self.client.vm_start,
+                               self.client.vm_start_many, models.RUNNING)
+
+    @utils.arg('vm', metavar='<VM>', nargs='+',
+               help='The virtual machines to stop. Several ids, or '
+                    'patterns with * and ?, are matched against the ids '
+                    'and names of one VM list.')
     @utils.arg('--force', type=bool, default=False,
                help='force stop, may lost data(true or false).')
+    @wait_args('stopped')
+    @bulk_args
     def do_vm_stop(self, args):
-        '''Destroy virtual machine.'''
+        '''Destroy virtual machines.'''
         force = False
         if args.force:
             force = args.force
-        body = self.client.vm_stop(vm=args.vm, force=force)
-        utils.pretty(head='VM|STATUS', body=body)
-
-    @utils.arg('vm', metavar='<VM>',
-               help='The virtual machine to be deleted')
+        return self._vm_action(args, self.client.vm_stop,
+                               self.client.vm_stop_many, models.STOPPED,
+                               force=force)
+
+    @utils.arg('vm', metavar='<VM>', nargs='+',
+               help='The virtual machines to be deleted. Several ids, or '
+                    'patterns with * and ?, are matched against the ids '
+                    'and names of one VM list.')
+    @wait_args('gone')
+    @bulk_args
     def do_vm_delete(self, args):
-        '''Delete virtual machine.'''
-        body = self.client.vm_delete(vm=args.vm)
-        utils.pretty(head='VM|STATUS', body=body)
+        '''Delete virtual machines.'''
+        return self._vm_action(args, self.client.vm_delete,
+                               self.client.vm_delete_many, models.DELETED)
 
+    @output_args
+    @list_args
+    @watch_args
     def do_image_list(self, args):
         '''List images.'''
-        body = self.client.image_list()
-        utils.pretty(head='IMAGE|SIZE|OS|DESC|OWNER', body=body)
-
-    @utils.arg('image', metavar='<IMAGE>',
-               help='The image to be deleted.')
+        if args.watch:
+            return self._watch('image', args)
+        rows = self.client.iter_list('image', filters=args.filter,
+                                     sort=args.sort, limit=args.limit)
+        utils.output(models.Image.head, rows, args.format, args.fields)
+
+    @utils.arg('image', metavar='<IMAGE>', nargs='+',
+               help='The images to be deleted, with * and ? wildcards.')
+    @bulk_args
     def do_image_delete(self, args):
-        '''Delete image.'''
-        body = self.client.image_delete(image=args.image)
-        utils.pretty(head='IMAGE|STATUS', body=body)
-
-    @utils.arg('url', metavar='<IMAGE URL>',
-               help='The url to the image binary.')
+        '''Delete images.'''
+        if self._act('image', 'IMAGE|STATUS', self.client.image_delete,
+                     self.client.image_delete_many, args.image, args)[1]:
+            return 1
+
+    @utils.arg('url', metavar='<IMAGE URL|FILE|->',
+               help='The url to the image binary, or a local file or - '
+                    'for stdin to upload.')
     @utils.arg('platform', metavar='<OS PLATFORM>',
                help='The OS platform of the image(linux or windows).')
     @utils.arg('--shared', type=bool, default=True,
                help='Share the image or not(true or false).')
     @utils.arg('--desc', help='Image description.')
+    @utils.arg('--name', metavar='<NAME>',
+               help='Image name when uploading, by default the file name. '
+                    'Required with -.')
+    @utils.arg('--no-resume', dest='resume', action='store_false',
+               help='Upload from the start even if an earlier upload of '
+                    'the same name stopped midway.')
+    @utils.arg('--part-size', metavar='<MEGABYTES>', type=int, default=64,
+               help='Size of each upload request.')
     def do_image_create(self, args):
         '''Create image.'''
-        body = self.client.image_create(
-            url=args.url,
-            platform=args.platform,
-            shared=str(args.shared).lower(),
-            desc=args.desc)
+        if args.url == '-' or os.path.isfile(args.url):
+            body = self.client.image_upload(
+                args.url,
+                platform=args.platform,
+                name=args.name,
+                shared=str(args.shared).lower(),
+                desc=args.desc,
+                resume=args.resume,
+                part_size=args.part_size * 1024 * 1024,
+                quiet=not sys.stdout.isatty())
+        else:
+            body = self.client.image_create(
+                url=args.url,
+                platform=args.platform,
+                shared=str(args.shared).lower(),
+                desc=args.desc)
         utils.pretty(head='IMAGE|STATUS', body=body)
 
+    @output_args
     @utils.arg('image', metavar='<IMAGE>',
                help='The image to be shown.')
     def do_image_show(self, args):
@@ -171,16 +468,20 @@ class CloudlandShell:
         body = dict(json.loads(body))
         # TODO(0) remove below workaround once image show is ready.
         head = '|'.join(body.keys()).upper()
-        body = '|'.join([v.strip() for v in body.values()]).replace(',', '')
-        body = '["%s"]' % body
-        utils.pretty(head=head, body=body)
+        row = '|'.join([v.strip() for v in body.values()]).replace(',', '')
+        utils.output(head, [row], args.format, args.fields)
 
+    @output_args
+    @list_args
+    @watch_args
     def do_vlan_list(self, args):
         '''List vlan.'''
-        body = self.client.vlan_list()
+        if args.watch:
+            return self._watch('vlan', args)
+        rows = self.client.iter_list('vlan', filters=args.filter,
+                                     sort=args.sort, limit=args.limit)
         # NETWORK|NETMASK|GATEWAY|START_IP|END_IP
-        utils.pretty(head='VLAN|DESC|OWNER',
-                     body=body)
+        utils.output(models.Vlan.head, rows, args.format, args.fields)
 
     @utils.arg('size', metavar='<VOLUME SIZE>', type=int,
                help='Volume size in G')
@@ -196,18 +497,25 @@ class CloudlandShell:
             desc=args.desc)
         utils.pretty(head='VOLUME|STATUS', body=body)
 
+    @output_args
+    @list_args
+    @watch_args
     def do_volume_list(self, args):
         '''List volume.'''
-        body = self.client.volume_list()
-        utils.pretty(
-            head='VOLUME|SIZE|DESC|VM|DEVICE|BOOTABLE|STATUS', body=body)
-
-    @utils.arg('volume', metavar='<VOLUME>',
-               help='The volume to be deleted.')
+        if args.watch:
+            return self._watch('volume', args)
+        rows = self.client.iter_list('volume', filters=args.filter,
+                                     sort=args.sort, limit=args.limit)
+        utils.output(models.Volume.head, rows, args.format, args.fields)
+
+    @utils.arg('volume', metavar='<VOLUME>', nargs='+',
+               help='The volumes to be deleted, with * and ? wildcards.')
+    @bulk_args
     def do_volume_delete(self, args):
-        '''Delete volume.'''
-        body = self.client.volume_delete(args.volume)
-        utils.pretty(head='VOLUME|STATUS', body=body)
+        '''Delete volumes.'''
+        if self._act('volume', 'VOLUME|STATUS', self.client.volume_delete,
+                     self.client.volume_delete_many, args.volume, args)[1]:
+            return 1
 
     @utils.arg('volume', metavar='<VOLUME>',
                help='The volume to detach.')
@@ -274,31 +582,98 @@ class CloudlandShell:
             vm=args.vm)
         utils.pretty(head='VM|VLAN|STATUS', body=body)
 
+    @output_args
+    @list_args
+    @watch_args
     def do_snapshot_list(self, args):
         '''List snapshots.'''
-        body = self.client.snapshot_list()
-        utils.pretty(head='SNAPSHOT|STATUS|DESC|OWNER', body=body)
-
-    @utils.arg('snapshot', metavar='<SNAPSHOT>',
-               help='Existing SNAPSHOT id.')
+        if args.watch:
+            return self._watch('snapshot', args)
+        rows = self.client.iter_list('snapshot', filters=args.filter,
+                                     sort=args.sort, limit=args.limit)
+        utils.output(models.Snapshot.head, rows, args.format, args.fields)
+
+    @utils.arg('snapshot', metavar='<SNAPSHOT>', nargs='+',
+               help='Existing SNAPSHOT ids, with * and ? wildcards.')
+    @bulk_args
     def do_snapshot_delete(self, args):
-        '''Delete a SNAPSHOT.'''
-        body = self.client.snapshot_delete(snapshot=args.snapshot)
-        utils.pretty(head='SNAPSHOT|STATUS', body=body)
+        '''Delete SNAPSHOTs.'''
+        if self._act('snapshot', 'SNAPSHOT|STATUS',
+                     self.client.snapshot_delete,
+                     self.client.snapshot_delete_many, args.snapshot,
+                     args)[1]:
+            return 1
 
     @utils.arg('snapshot', metavar='<SNAPSHOT>',
                help='Existing SNAPSHOT id.')
+    @utils.arg('--connections', metavar='<CONNECTIONS>', type=int, default=4,
+               help='Parallel connections when the server supports '
+                    'ranged downloads.')
+    @utils.arg('--output', metavar='<FILE|->', default=None,
+               help='Save to FILE, or write to stdout with -. Defaults to '
+                    'the file name in the URL.')
+    @utils.arg('--checksum', metavar='<SHA256>', default=None,
+               help='Expected SHA-256 of the snapshot. Defaults to the '
+                    'one the server sends, if any.')
+    @utils.arg('--force', action='store_true', default=False,
+               help='Download even if a matching local copy exists.')
     def do_snapshot_download(self, args):
-        '''Download a SNAPSHOT.'''
+        '''Download a SNAPSHOT, verifying its checksum when known.'''
         snapshot = args.snapshot
         body = self.client.snapshot_download(snapshot=snapshot)
+        # The URI and one more value, or nothing if there is no such
+        # snapshot.
         result = utils.loads(body)
-        result.pop()
         if len(result) == 0:
             print('Snapshot %s does not exist.' % snapshot)
             return -1
-        uri = result.pop()
-        utils.download(uri)
+        uri = result[0]
+        utils.download(uri, session=self.client.session,
+                       connections=args.connections, filename=args.output,
+                       checksum=args.checksum, force=args.force,
+                       quiet=not _progress_wanted(args.output),
+                       timeout=(self.client.connect_timeout,
+                                self.client.read_timeout),
+                       retry_policy=self.client.retry_policy)
+
+    @utils.arg('directory', metavar='<DIRECTORY>',
+               help='Directory to download into.')
+    @utils.arg('snapshot', metavar='<SNAPSHOT>', nargs='*',
+               help='SNAPSHOT ids or patterns, all snapshots by default.')
+    @utils.arg('--concurrency', metavar='<CONCURRENCY>', type=int,
+               default=4,
+               help='Snapshots to download at the same time.')
+    @utils.arg('--connections', metavar='<CONNECTIONS>', type=int, default=8,
+               help='Requests streaming at the same time, over all '
+                    'snapshots.')
+    @utils.arg('--bandwidth', metavar='<MB PER SECOND>', type=float,
+               help='Limit on the download rate of all snapshots together.')
+    @utils.arg('--force', action='store_true', default=False,
+               help='Download even if a matching local copy exists.')
+    def do_snapshot_mirror(self, args):
+        '''Download SNAPSHOTs into a DIRECTORY, skipping current copies.'''
+        from cloudlandclient.download import M
+        from cloudlandclient.mirror import Mirror
+        mirror = Mirror(self.client, args.directory,
+                        concurrency=args.concurrency,
+                        connections=args.connections,
+                        bandwidth=args.bandwidth and args.bandwidth * M,
+                        quiet=not sys.stdout.isatty())
+        outcomes = mirror.run(args.snapshot, force=args.force)
+        lines = []
+        for outcome in outcomes:
+            if outcome.ok:
+                lines.append('%s|%s|%s|' % ((outcome.item,) + outcome.result))
+            else:
+                lines.append('%s|||%s' % (outcome.item, outcome.error))
+        utils.pretty_lines(head='SNAPSHOT|FILE|STATUS|ERROR', lines=lines)
+        meter = mirror.meter
+        failed = len([outcome for outcome in outcomes if not outcome.ok])
+        print('%d snapshots, %d failed; received %dM in %.1fs, %.1fM/s.' % (
+            len(outcomes), failed, meter.position // M, meter.elapsed(),
+            meter.rate() / M))
+        if failed:
+            return 1
 
     @utils.arg('vm', metavar='<VM>',
                help='The virtual machine to create SNAPSHOT')
@@ -309,9 +684,182 @@ class CloudlandShell:
                                            desc=args.desc)
         utils.pretty(head='SNAPSHOT|STATUS', body=body)
 
-    def _find_actions(self, subparsers, actions_module):
+    @utils.arg('spec', metavar='<SPEC>',
+               help='JSON file with the "vlans", "vms" and "volumes" to '
+                    'have, - for stdin.')
+    @utils.arg('--dry-run', action='store_true',
+               help='Print the plan without changing anything.')
+    @utils.arg('--concurrency', metavar='<CONCURRENCY>', type=int,
+               default=8,
+               help='Independent steps to run at the same time.')
+    def do_apply(self, args):
+        '''Create what a spec describes and does not exist yet.
+
+        VLANs are matched by number, VMs by name and volumes by
+        description, with one list call each. Missing ones are created
+        and attached, VLANs before the VMs on them and volumes and VMs
+        before their attachments. Extra VLANs are attached to the VMs it
+        creates only.
+        '''
+        from cloudlandclient import reconcile
+        if args.spec == '-':
+            spec = json.load(sys.stdin)
+        else:
+            spec = json.loads(utils.read_file(args.spec))
+        plan = reconcile.plan(self.client, spec)
+        if not len(plan):
+            print('Nothing to do.')
+            return
+        if args.dry_run:
+            utils.pretty_lines(head='ACTION|RESOURCE|REQUIRES',
+                               lines=plan.lines())
+            return
+        outcomes = plan.apply(concurrency=args.concurrency)
+        lines = ['%s|%s|%s|%.1f|%s' % (
+            outcome.item.action, outcome.item.resource,
+            'done' if outcome.ok else 'failed', outcome.elapsed,
+            outcome.error or '') for outcome in outcomes]
+        utils.pretty_lines(head='ACTION|RESOURCE|RESULT|SECONDS|ERROR',
+                           lines=lines)
+        if not all(outcome.ok for outcome in outcomes):
+            return 1
+
+    def _run_line(self, line):
+        '''Run the subcommand on one batch or shell line.
+
+        Returns its exit status.
+        '''
+        argv = shlex.split(line, comments=True)
+        if argv and argv[0] in ('batch', 'shell'):
+            raise Exception("'%s' cannot be nested." % argv[0])
+        try:
+            args = self.parser.parse_args(argv)
+        except SystemExit as e:
+            return e.code
+        return args.func(args) or 0
+
+    def _run_captured(self, item):
+        number, line = item
+        start = time.time()
+        with self.stdout.capture() as output, self.stderr.capture() as error:
+            try:
+                status = self._run_line(line)
+                failure = None
+            except Exception as e:
+                status, failure = 1, str(e)
+        result = {'line': number,
+                  'command': line,
+                  'status': status,
+                  'output': output.getvalue(),
+                  'seconds': round(time.time() - start, 3)}
+        if failure or error.getvalue():
+            result['error'] = failure or error.getvalue()
+        return result
+
+    @utils.arg('file', metavar='<FILE>', nargs='?', default='-',
+               help='File with one subcommand per line, - for stdin.')
+    @utils.arg('--concurrency', metavar='<CONCURRENCY>', type=int,
+               default=1,
+               help='Lines to run at the same time. Lines up to a "wait" '
+                    'line must then be independent of each other.')
+    @utils.arg('--stop-on-error', action='store_true',
+               help='Stop at the first line that fails.')
+    def do_batch(self, args):
+        '''Run subcommands from a file with one session.
+
+        Each line is a subcommand with its arguments, as given to
+        cloudland, and "#" starts a comment. All of them share one login,
+        connection pool and catalog cache. A JSON line with the command,
+        its exit status, output and time is printed for every line.
+        '''
+        from cloudlandclient import bulk
+        if args.file == '-':
+            lines = sys.stdin.read().splitlines()
+        else:
+            lines = utils.read_file(args.file).splitlines()
+        # Lines are parsed with every subcommand, not just batch.
+        self.parser = self.get_subcommand_parser()
+        groups = [[]]
+        for number, line in enumerate(lines, 1):
+            try:
+                words = shlex.split(line, comments=True)
+            except ValueError:
+                # Such as an unclosed quote, reported when the line runs.
+                words = [line]
+            if not words:
+                continue
+            if line.strip() == 'wait':
+                groups.append([])
+            else:
+                groups[-1].append((number, line))
+        stdout = sys.stdout
+        self.stdout, self.stderr = ThreadOutput(stdout), ThreadOutput(
+            sys.stderr)
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        failed = False
+        try:
+            for group in groups:
+                if args.concurrency > 1:
+                    results = [outcome.result for outcome in bulk.run(
+                        self._run_captured, group, args.concurrency)]
+                else:
+                    results = (self._run_captured(item) for item in group)
+                for result in results:
+                    stdout.write(json.dumps(result, sort_keys=True) + '\n')
+                    stdout.flush()
+                    failed = failed or result['status'] != 0
+                    if failed and args.stop_on_error:
+                        return 1
+        finally:
+            sys.stdout, sys.stderr = stdout, self.stderr.stream
+        if failed:
+            return 1
+
+    def do_shell(self, args):
+        '''Run subcommands interactively with one session.
+
+        Lines are subcommands with their arguments, as given to cloudland.
+        All of them share one login, connection pool and catalog cache.
+        Leave with "exit" or end of file.
+        '''
+        try:
+            import readline  # noqa
+        except ImportError:
+            pass
+        try:
+            read = raw_input
+        except NameError:
+            read = input
+        self.parser = self.get_subcommand_parser()
+        interactive = sys.stdin.isatty()
+        while True:
+            try:
+                line = read('cloudland> ' if interactive else '')
+            except EOFError:
+                break
+            except KeyboardInterrupt:
+                print('')
+                continue
+            if line.strip() in ('exit', 'quit'):
+                break
+            if not line.strip():
+                continue
+            try:
+                self._run_line(line)
+            except KeyboardInterrupt:
+                print('')
+            except Exception as e:
+                print(str(e))
+                if args.debug:
+                    logger.exception(e)
+        if interactive:
+            print('')
+
+    def _find_actions(self, subparsers, actions_module, commands=None):
         for attr in (a for a in dir(actions_module) if a.startswith('do_')):
             command = attr[3:].replace('_', '-')
+            if commands is not None and command not in commands:
+                continue
             callback = getattr(actions_module, attr)
             desc = callback.__doc__ or ''
             help = desc.strip().split('\n')[0]
@@ -337,30 +885,42 @@ class CloudlandShell:
             level=log_lvl)
 
     def main(self, argv):
-        # Parse args once to find version
+        # Parse args once to find version and the subcommand
         parser = self.get_base_parser()
         (options, args) = parser.parse_known_args(argv)
-        self.parser = self.get_subcommand_parser()
         if not args and options.help or not argv:
+            self.parser = self.get_subcommand_parser(parser)
             self.do_help(options)
             return 0
         self._setup_logging(options.debug)
 
+        self.parser = self.get_subcommand_parser(
+            parser, self._commands_for(args))
         args = self.parser.parse_args(argv)
         if args.func == self.do_help:
             self.do_help(args)
             return 0
         if args.endpoint and args.username and args.password:
-            self.client = CloudlandClient(
-                args.endpoint, args.username, args.password)
-            if self.client.cookies:
-                try:
-                    return args.func(args)
-                except Exception as e:
-                    print(str(e))
-                    if options.debug:
-                        raise e
-                    return 1
+            from cloudlandclient.client import CloudlandClient
+            # Without --metrics no hook is added, and requests pay nothing.
+            hooks = []
+            if args.metrics:
+                hooks.append(metrics.MetricsCollector())
+            try:
+                with CloudlandClient(args.endpoint, args.username,
+                                     args.password,
+                                     hooks=hooks) as self.client:
+                    if self.client.cookies:
+                        try:
+                            return args.func(args)
+                        except Exception as e:
+                            print(str(e))
+                            if options.debug:
+                                raise e
+                            return 1
+            finally:
+                if hooks:
+                    hooks[0].write(args.metrics)
         print("Please check whether "
               "\n\t--username CLOUDLAND_USERNAME "
               "\n\t--password CLOUDLAND_PASSWORD "
@@ -368,6 +928,56 @@ class CloudlandShell:
               "are set correctly.")
 
 
+class ThreadOutput(object):
+    '''Stand-in for sys.stdout or sys.stderr, buffered per thread.
+
+    What a thread writes inside capture() goes to that thread's own
+    buffer.
+    '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            self.stream.write(text)
+        else:
+            if not isinstance(text, type(u'')):
+                text = text.decode('utf-8')
+            buffer.write(text)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+    def isatty(self):
+        return False
+
+    @contextlib.contextmanager
+    def capture(self):
+        self.local.buffer = io.StringIO()
+        try:
+            yield self.local.buffer
+        finally:
+            self.local.buffer = None
+
+
+class VersionAction(argparse.Action):
+    '''--version, resolving the version only when it is asked for.'''
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS,
+                 default=argparse.SUPPRESS, help=None):
+        super(VersionAction, self).__init__(
+            option_strings=option_strings, dest=dest, default=default,
+            nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        import cloudlandclient
+        parser.exit(message='%s\n' % cloudlandclient.version_string())
+
+
 class HelpFormatter(argparse.HelpFormatter):
     def start_section(self, heading):
         # Title-case the headings
@@ -0,0 +1,73 @@
+import asyncio
+
+import testtools
+
+from cloudlandclient.tests import base
+
+try:
+    from cloudlandclient.aio import AsyncCloudlandClient
+except ImportError:
+    AsyncCloudlandClient = None
+
+
+@testtools.skipIf(AsyncCloudlandClient is None, 'aiohttp is not installed')
+class AsyncClientTest(base.TestCase):
+
+    def setUp(self):
+        super(AsyncClientTest, self).setUp()
+        self.fake = self.fake()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def run_client(self, func, **kwargs):
+        '''The result of await func(client) with a logged in client.'''
+        async def run():
+            async with AsyncCloudlandClient(self.fake.endpoint, 'user',
+                                            'secret', **kwargs) as client:
+                return await func(client)
+        return self.loop.run_until_complete(run())
+
+    def test_list(self):
+        body = self.run_client(lambda client: client.vm_list())
+        self.assertIn('vm-1|', body)
+
+    def test_relogin_on_get(self):
+        async def expired(client):
+            self.fake.expire_sessions()
+            return await client.vm_list()
+        body = self.run_client(expired)
+        self.assertIn('vm-1|', body)
+        self.assertEqual(2, self.fake.calls['login'])
+
+    def test_relogin_on_post(self):
+        async def expired(client):
+            self.fake.expire_sessions()
+            return await client.vm_start('vm-1')
+        self.assertEqual('["vm-1|running", 0]', self.run_client(expired))
+        self.assertEqual(2, self.fake.calls['create_vm'])
+
+    def test_one_relogin_for_many(self):
+        async def expired(client):
+            self.fake.expire_sessions()
+            return await asyncio.gather(*[client.vm_list()
+                                          for _ in range(10)])
+        bodies = self.run_client(expired)
+        self.assertTrue(all('vm-1|' in body for body in bodies))
+        self.assertEqual(2, self.fake.calls['login'])
+
+    def test_write_drops_probe_response(self):
+        self.run_client(lambda client: client.vlan_list())
+
+        async def create(client):
+            self.assertIn('get_link_list', client._primed)
+            await client.vlan_create(6000, '172.16.0.0', '255.255.255.0',
+                                     None, None, None, 'false', 'true')
+            return await client.vlan_list()
+        self.assertIn('6000', self.run_client(create, session_ttl=0))
+
+    def test_vm_create_many(self):
+        outcomes = self.run_client(
+            lambda client: client.vm_create_many(
+                image='image-0', vlan=5000, count=3, name='web-{i}'))
+        self.assertTrue(all(outcome.ok for outcome in outcomes))
+        self.assertEqual(3, self.fake.calls['launch_vm'])
@@ -0,0 +1,50 @@
+import threading
+
+import fixtures
+import testtools
+
+from cloudlandclient.client import CloudlandClient
+from cloudlandclient.fake import FakeCloudland
+
+
+class TestCase(testtools.TestCase):
+    '''Test case with its own temp directory.
+
+    The directory also holds the cookie files of the clients it
+    makes.
+    '''
+
+    def setUp(self):
+        super(TestCase, self).setUp()
+        self.tmp = self.useFixture(fixtures.TempDir()).path
+        self.useFixture(fixtures.MonkeyPatch('tempfile.tempdir', self.tmp))
+
+    def fake(self, **kwargs):
+        '''A started FakeCloudland, stopped at cleanup.'''
+        fake = FakeCloudland(**kwargs)
+        fake.start()
+        self.addCleanup(fake.stop)
+        return fake
+
+    def client(self, fake, **kwargs):
+        client = CloudlandClient(fake.endpoint, 'user', 'secret', **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+
+def together(count, func):
+    '''Results of func() called by count threads released at once.'''
+    start = threading.Event()
+    results = [None] * count
+
+    def run(i):
+        start.wait()
+        results[i] = func()
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(count)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+    return results
@@ -0,0 +1,533 @@
+import itertools
+import os
+import threading
+import time
+
+import fixtures
+
+from cloudlandclient.client import CloudlandClient
+from cloudlandclient.client import cookie_dir
+from cloudlandclient.client import CookieFileMixin
+from cloudlandclient.exc import ImageNotExist
+from cloudlandclient.exc import SomeThingWrong
+from cloudlandclient.exc import VlanNotExist
+from cloudlandclient.exc import VmFailed
+from cloudlandclient.exc import WaitTimeout
+from cloudlandclient.models import DELETED
+from cloudlandclient import retry
+from cloudlandclient.tests import base
+from cloudlandclient import utils
+
+
+class ReloginTest(base.TestCase):
+
+    def test_replays_after_expiry(self):
+        fake = self.fake(vms=5)
+        client = self.client(fake)
+        fake.expire_sessions()
+        self.assertEqual(5, len(utils.loads(client.vm_list())))
+        self.assertEqual(2, fake.calls['login'])
+
+    def test_streamed_list_replays(self):
+        fake = self.fake(vms=5)
+        client = self.client(fake, coalesce=False)
+        fake.expire_sessions()
+        self.assertEqual(5, len(client.records('vm')))
+        self.assertEqual(2, fake.calls['login'])
+
+    def test_threads_log_in_once(self):
+        fake = self.fake(vms=5, latency=0.05)
+        client = self.client(fake, coalesce=False)
+        fake.expire_sessions()
+        results = base.together(10, client.vm_list)
+        self.assertEqual(1, len(set(results)))
+        self.assertEqual(2, fake.calls['login'])
+
+    def test_cookies_are_reused(self):
+        fake = self.fake()
+        self.client(fake).close()
+        self.client(fake)
+        self.assertEqual(1, fake.calls['login'])
+
+
+class CookieFileTest(base.TestCase):
+
+    def setUp(self):
+        super(CookieFileTest, self).setUp()
+        if not hasattr(os, 'getuid'):
+            self.skipTest('No file owners.')
+        self.fake = self.fake()
+
+    def cookie_file(self, endpoint, username):
+        owner = CookieFileMixin()
+        owner.endpoint = endpoint
+        owner.username = username
+        return owner.cpath
+
+    def test_shared_directory_refused(self):
+        os.chmod(cookie_dir(), 0o770)
+        self.assertRaises(SomeThingWrong, cookie_dir)
+        self.assertRaises(SomeThingWrong, self.client, self.fake)
+
+    def test_foreign_directory_refused(self):
+        uid = os.getuid()
+        # The directory named for that user is made, and owned, by this one.
+        self.useFixture(fixtures.MonkeyPatch('os.getuid', lambda: uid + 1))
+        self.assertRaises(SomeThingWrong, cookie_dir)
+
+    def test_foreign_file_not_loaded(self):
+        self.client(self.fake).close()
+        client = self.client(self.fake)
+        self.assertTrue(client.load_cookies())
+        fstat = os.fstat
+
+        def foreign(fd):
+            st = list(fstat(fd))
+            st[4] += 1
+            return os.stat_result(st)
+        self.useFixture(fixtures.MonkeyPatch('os.fstat', foreign))
+        self.assertIsNone(client.load_cookies())
+
+    def test_failed_write_keeps_old_file(self):
+        client = self.client(self.fake)
+        with open(client.cpath, 'rb') as f:
+            saved = f.read()
+
+        def broken(obj, f):
+            f.write(saved[:10])
+            raise IOError('No space left on device')
+        self.useFixture(fixtures.MonkeyPatch(
+            'cloudlandclient.client.pickle.dump', broken))
+        self.assertRaises(IOError, client.dump_cookies)
+        with open(client.cpath, 'rb') as f:
+            self.assertEqual(saved, f.read())
+        self.assertEqual(sorted([os.path.basename(client.cpath),
+                                 os.path.basename(client.cpath) + '.lock']),
+                         sorted(os.listdir(cookie_dir())))
+
+    def test_file_per_endpoint_and_user(self):
+        self.assertEqual(3, len(set([
+            self.cookie_file('http://a/cloudland/api/', 'user'),
+            self.cookie_file('http://b/cloudland/api/', 'user'),
+            self.cookie_file('http://a/cloudland/api/', 'other')])))
+        self.assertEqual(self.cookie_file('http://a/cloudland/api', 'user'),
+                         self.cookie_file('http://a/cloudland/api/', 'user'))
+        self.client(self.fake)
+        other = CloudlandClient(self.fake.endpoint, 'other', 'secret')
+        self.addCleanup(other.close)
+        self.assertEqual(2, self.fake.calls['login'])
+        self.client(self.fake)
+        self.assertEqual(2, self.fake.calls['login'])
+
+    def test_waiting_client_reuses_login(self):
+        first = self.client(self.fake)
+        second = self.client(self.fake)
+        self.assertEqual(1, self.fake.calls['login'])
+        generation = second.generation
+        self.fake.expire_sessions()
+        locked = threading.Event()
+        waiting = threading.Event()
+        lock_cookies = CookieFileMixin.lock_cookies
+
+        # first takes the lock only once second saw the expiry, and logs
+        # in while second waits for it.
+        def lock_first():
+            fd = lock_cookies(first)
+            locked.set()
+            waiting.wait(10)
+            return fd
+
+        def lock_second():
+            locked.wait(10)
+            waiting.set()
+            return lock_cookies(second)
+        first.lock_cookies = lock_first
+        second.lock_cookies = lock_second
+        relogin = threading.Thread(target=first.relogin,
+                                   args=(first.generation,))
+        relogin.start()
+        self.assertEqual(10, len(utils.loads(second.vm_list())))
+        relogin.join()
+        self.assertEqual(2, self.fake.calls['login'])
+        self.assertEqual(generation + 1, second.generation)
+        self.assertEqual(first.cookies.get_dict(), second.cookies.get_dict())
+
+
+class CoalesceTest(base.TestCase):
+
+    def test_concurrent_gets_share_one_request(self):
+        fake = self.fake(vms=50, latency=0.5)
+        client = self.client(fake)
+        results = base.together(10, client.vm_list)
+        self.assertEqual(1, len(set(results)))
+        self.assertEqual(1, fake.calls['get_vm_list'])
+
+    def test_concurrent_records_share_one_request(self):
+        fake = self.fake(vms=50, latency=0.5)
+        client = self.client(fake)
+        results = base.together(10, lambda: client.inventory('vm'))
+        self.assertEqual([50] * 10, [len(r) for r in results])
+        self.assertEqual(1, fake.calls['get_vm_list'])
+
+    def test_disabled(self):
+        fake = self.fake(latency=0.2)
+        client = self.client(fake, coalesce=False)
+        base.together(5, client.vm_list)
+        self.assertEqual(5, fake.calls['get_vm_list'])
+
+    def test_window(self):
+        fake = self.fake()
+        client = self.client(fake, coalesce_window=0.5)
+        client.vm_list()
+        client.vm_list()
+        self.assertEqual(1, fake.calls['get_vm_list'])
+        time.sleep(0.6)
+        client.vm_list()
+        self.assertEqual(2, fake.calls['get_vm_list'])
+
+    def test_write_ends_sharing(self):
+        fake = self.fake(vms=3)
+        client = self.client(fake, coalesce_window=60)
+        self.assertEqual(3, len(utils.loads(client.vm_list())))
+        self.assertEqual(3, len(client.records('vm')))
+        client.vm_create('image-0', 5000)
+        self.assertEqual(4, len(utils.loads(client.vm_list())))
+        self.assertEqual(4, len(client.records('vm')))
+
+    def test_write_during_flight_is_not_shared(self):
+        fake = self.fake(vms=3, latency=0.3)
+        client = self.client(fake)
+        started = threading.Event()
+        before = []
+
+        def read():
+            started.set()
+            before.append(client.vm_list())
+        thread = threading.Thread(target=read)
+        thread.start()
+        started.wait()
+        time.sleep(0.05)
+        client.vm_create('image-0', 5000)
+        after = client.vm_list()
+        thread.join()
+        self.assertEqual(4, len(utils.loads(after)))
+        self.assertEqual(2, fake.calls['get_vm_list'])
+
+    def test_errors_are_shared_not_kept(self):
+        fake = self.fake(latency=0.3)
+        client = self.client(fake, coalesce_window=60)
+        calls = []
+        get = client._get
+
+        def failing(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                time.sleep(0.3)
+                raise SomeThingWrong(message='boom')
+            return get(*args)
+        client._get = failing
+
+        def call():
+            try:
+                return client.vm_list()
+            except SomeThingWrong as e:
+                return str(e)
+        self.assertEqual(['boom'] * 5, base.together(5, call))
+        self.assertEqual(1, len(calls))
+        self.assertEqual(3, len(utils.loads(client.vlan_list())))
+        client.vm_list()
+        self.assertEqual(2, len([args for args in calls
+                                 if args[0]['action'] == 'get_vm_list']))
+
+
+class PrimedTest(base.TestCase):
+
+    def probed(self, fake):
+        self.client(fake).close()
+        client = self.client(fake, session_ttl=0)
+        self.assertIn('get_link_list', client._primed)
+        return client
+
+    def test_probe_feeds_first_get(self):
+        fake = self.fake()
+        client = self.probed(fake)
+        calls = fake.calls['get_link_list']
+        client.vlan_list()
+        self.assertEqual(calls, fake.calls['get_link_list'])
+
+    def test_failed_probe_not_kept(self):
+        fake = self.fake()
+        self.client(fake).close()
+        fake.failure_rate = 1
+        client = self.client(fake, session_ttl=0,
+                             retry_policy=retry.NO_RETRY)
+        self.assertNotIn('get_link_list', client._primed)
+        fake.failure_rate = 0
+        self.assertIn('5000', client.vlan_list())
+
+    def test_write_drops_probe_response(self):
+        fake = self.fake()
+        client = self.probed(fake)
+        client.vlan_create(6000, '172.16.0.0', '255.255.255.0', None, None,
+                           None, 'false', 'true')
+        self.assertIn('6000', client.vlan_list())
+
+
+class WaitForTest(base.TestCase):
+
+    def test_no_timeout(self):
+        fake = self.fake(vms=1)
+        client = self.client(fake)
+        vm = client.records('vm')[0]
+        outcome = client.wait_for([vm.name], vm.status, timeout=None)[0]
+        self.assertTrue(outcome.ok)
+        self.assertEqual(vm.status, outcome.result)
+
+    def test_timeout(self):
+        fake = self.fake(vms=1, boot_time=60)
+        client = self.client(fake)
+        vm = utils.cut(utils.loads(client.vm_create('image-0', 5000)))[0]
+        start = time.time()
+        outcome = client.wait_for([vm], 'running', timeout=0.3,
+                                  interval=0.05)[0]
+        self.assertLess(time.time() - start, 2)
+        self.assertIsInstance(outcome.error, WaitTimeout)
+        self.assertEqual('building', outcome.result)
+        self.assertEqual('VM %s is building, not running, after waiting.'
+                         % vm, str(outcome.error))
+
+    def test_failed(self):
+        fake = self.fake(vms=4)
+        client = self.client(fake)
+        with fake.lock:
+            fake.vms['vm-2'][5] = 'error'
+            fake.vms['vm-3'][5] = 'failed'
+        outcomes = client.wait_for(['vm-2', 'vm-3'], 'running', timeout=5,
+                                   interval=0.05, failed=('error', 'failed'))
+        self.assertEqual(['error', 'failed'],
+                         [outcome.result for outcome in outcomes])
+        for outcome in outcomes:
+            self.assertIsInstance(outcome.error, VmFailed)
+        self.assertEqual('VM vm-2 is error.', str(outcomes[0].error))
+
+    def test_missing(self):
+        fake = self.fake(vms=2)
+        client = self.client(fake)
+        client.vm_delete('vm-2')
+        outcome, = client.wait_for(['vm-2'], DELETED, timeout=5)
+        self.assertTrue(outcome.ok)
+        outcome, = client.wait_for(['vm-9'], 'running', timeout=0.3,
+                                   interval=0.05)
+        self.assertIsInstance(outcome.error, WaitTimeout)
+        self.assertEqual(DELETED, outcome.result)
+
+    def test_one_list_per_round(self):
+        fake = self.fake(vms=0, boot_time=0.3)
+        client = self.client(fake)
+        vms = [utils.cut(utils.loads(outcome.result))[0]
+               for outcome in client.vm_create_many('image-0', 5000,
+                                                    count=8)]
+        calls = fake.calls.get('get_vm_list', 0)
+        rounds = []
+        sleep = time.sleep
+
+        def pause(seconds):
+            rounds.append(seconds)
+            sleep(seconds)
+        self.useFixture(fixtures.MonkeyPatch('time.sleep', pause))
+        outcomes = client.wait_for(vms, 'running', timeout=5, interval=0.05)
+        self.assertEqual([True] * 8, [outcome.ok for outcome in outcomes])
+        self.assertGreater(len(rounds), 1)
+        self.assertEqual(calls + len(rounds) + 1, fake.calls['get_vm_list'])
+
+
+class VmCreateManyTest(base.TestCase):
+
+    def setUp(self):
+        super(VmCreateManyTest, self).setUp()
+        self.fake = self.fake(latency=0.01)
+        self.client = self.client(self.fake)
+
+    def test_input_order(self):
+        outcomes = self.client.vm_create_many('image-0', 5000, count=6,
+                                              name='web-{i}')
+        self.assertEqual(['web-%d' % i for i in range(1, 7)],
+                         [outcome.item['name'] for outcome in outcomes])
+        for outcome in outcomes:
+            vm = utils.cut(utils.loads(outcome.result))[0]
+            self.assertEqual(outcome.item['name'], self.fake.vms[vm][3])
+
+    def test_partial_failures(self):
+        outcomes = self.client.vm_create_many(
+            'image-0', 5000, name='web-{i}',
+            specs=[{}, {'image': 'missing'}, {'name': 'web-{0}'},
+                   {'name': 'web-{x}'}, {'vlan': 1}, {}])
+        self.assertEqual([True, False, False, False, False, True],
+                         [outcome.ok for outcome in outcomes])
+        self.assertIsInstance(outcomes[1].error, ImageNotExist)
+        self.assertIsInstance(outcomes[2].error, IndexError)
+        self.assertIsInstance(outcomes[3].error, KeyError)
+        self.assertIsInstance(outcomes[4].error, VlanNotExist)
+        self.assertEqual('web-6', outcomes[5].item['name'])
+        self.assertEqual(2, self.fake.calls['launch_vm'])
+
+    def test_one_catalog_fetch(self):
+        self.client.vm_create_many(specs=[{'image': 'image-%d' % (i % 3),
+                                           'vlan': 5000 + i % 3}
+                                          for i in range(9)])
+        self.assertEqual(1, self.fake.calls['get_img_list'])
+        self.assertEqual(1, self.fake.calls['get_link_list'])
+        self.assertEqual(9, self.fake.calls['launch_vm'])
+
+
+class BulkTest(base.TestCase):
+
+    def test_deadline_cuts_calls_short(self):
+        fake = self.fake(latency=1)
+        client = self.client(fake)
+        start = time.time()
+        outcomes = client.vm_start_many(['vm-1', 'vm-2'], deadline=0.3,
+                                        resolved=(['vm-1', 'vm-2'], []))
+        self.assertLess(time.time() - start, 0.9)
+        self.assertEqual([False, False], [outcome.ok for outcome in outcomes])
+
+
+class WatchTest(base.TestCase):
+
+    def setUp(self):
+        super(WatchTest, self).setUp()
+        self.fake = self.fake(vms=3)
+        self.client = self.client(self.fake, retry_policy=retry.NO_RETRY)
+        # Run by the sleep of the same 1-based number.
+        self.actions = {}
+        self.delays = []
+
+        def sleep(seconds):
+            self.delays.append(seconds)
+            action = self.actions.pop(len(self.delays), None)
+            if action is not None:
+                with self.fake.lock:
+                    action()
+        self.useFixture(fixtures.MonkeyPatch('time.sleep', sleep))
+
+    def change(self):
+        self.fake.vms['vm-3'][5] = 'shut_off'
+
+    def test_events(self):
+        events = self.client.watch('vm', interval=1, max_interval=8)
+        self.assertEqual([('added', 'vm-1'), ('added', 'vm-2'),
+                          ('added', 'vm-3')],
+                         sorted((e['event'], e['id'])
+                                for e in itertools.islice(events, 3)))
+
+        def change_and_remove():
+            self.change()
+            del self.fake.vms['vm-2']
+        self.actions[1] = change_and_remove
+        changed, removed = sorted([next(events), next(events)],
+                                  key=lambda e: e['event'])
+        self.assertEqual(('changed', 'vm-3', 'shut_off', 'running'),
+                         (changed['event'], changed['id'],
+                          changed['row']['status'],
+                          changed['old']['status']))
+        self.assertEqual(('removed', 'vm-2'), (removed['event'],
+                                               removed['id']))
+        self.actions[4] = lambda: self.fake._add_vm('image-0', 5000, 'new',
+                                                    'running')
+        added = next(events)
+        self.assertEqual(('added', 'new'), (added['event'],
+                                            added['row']['name']))
+        # Slower while nothing changes, back to interval after a change.
+        self.assertEqual([1, 1, 2, 4], self.delays)
+
+    def test_errors_back_off(self):
+        events = self.client.watch('vm', interval=1, max_interval=4,
+                                   initial=False)
+
+        def fail():
+            self.fake.failure_rate = 1
+
+        def recover():
+            self.fake.failure_rate = 0
+            self.change()
+        self.actions[1] = fail
+        self.actions[4] = recover
+        event = next(events)
+        self.assertEqual(('changed', 'vm-3'), (event['event'], event['id']))
+        self.assertEqual([2, 4, 4, 4], self.delays)
+        self.assertEqual(5, self.fake.calls['get_vm_list'])
+
+
+class SessionTest(base.TestCase):
+
+    def test_pool(self):
+        fake = self.fake()
+        client = self.client(fake, pool_connections=2, pool_maxsize=4,
+                             pool_block=True)
+        adapter = client.session.get_adapter(fake.endpoint)
+        self.assertIs(adapter, client.session.get_adapter('https://x/'))
+        self.assertEqual(2, adapter._pool_connections)
+        self.assertEqual(4, adapter._pool_maxsize)
+        self.assertTrue(adapter._pool_block)
+        self.assertNotEqual('close', client.session.headers['Connection'])
+
+    def test_connections_are_reused(self):
+        fake = self.fake()
+        client = self.client(fake)
+        for _ in range(5):
+            client.vm_list()
+            client.vlan_list()
+        pool = client.session.get_adapter(fake.endpoint).poolmanager
+        keys = list(pool.pools.keys())
+        self.assertEqual(1, len(keys))
+        self.assertEqual(1, pool.pools[keys[0]].num_connections)
+
+    def test_no_keep_alive(self):
+        session = CloudlandClient.make_session(keep_alive=False)
+        self.addCleanup(session.close)
+        self.assertEqual('close', session.headers['Connection'])
+
+
+class CatalogTest(base.TestCase):
+
+    def setUp(self):
+        super(CatalogTest, self).setUp()
+        self.fake = self.fake()
+        self.client = self.client(self.fake)
+        self.vlans = self.fake.calls.get('get_link_list', 0)
+
+    def test_one_fetch_for_many_creates(self):
+        for _ in range(5):
+            self.client.vm_create('image-0', 5000)
+        self.assertEqual(1, self.fake.calls['get_img_list'])
+        self.assertEqual(self.vlans + 1, self.fake.calls['get_link_list'])
+        self.assertEqual(5, self.fake.calls['launch_vm'])
+
+    def test_unknown_names_use_the_cache(self):
+        self.assertRaises(ImageNotExist, self.client.vm_create, 'missing',
+                          5000)
+        self.assertRaises(VlanNotExist, self.client.vm_create, 'image-0',
+                          6000)
+        self.assertRaises(VlanNotExist, self.client.vm_create, 'image-0',
+                          6000)
+        self.assertEqual(1, self.fake.calls['get_img_list'])
+        self.assertEqual(self.vlans + 1, self.fake.calls['get_link_list'])
+
+    def test_vlan_create_refetches(self):
+        self.assertEqual([5000, 5001, 5002], sorted(self.client.vlans()))
+        self.client.vlan_create(6000, '172.16.0.0', '255.255.255.0', None,
+                                None, None, 'false', 'true')
+        self.client.vm_create('image-0', 6000)
+        self.assertEqual(self.vlans + 2, self.fake.calls['get_link_list'])
+        self.assertIn(6000, self.client.vlans())
+        self.assertEqual(1, self.fake.calls['launch_vm'])
+
+    def test_ttl(self):
+        client = self.client
+        client.catalog_ttl = 0.2
+        client.images()
+        client.images()
+        self.assertEqual(1, self.fake.calls['get_img_list'])
+        time.sleep(0.3)
+        client.images()
+        self.assertEqual(2, self.fake.calls['get_img_list'])
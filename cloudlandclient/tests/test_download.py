@@ -0,0 +1,222 @@
+import hashlib
+import os
+import re
+import socket
+import time
+
+import requests
+
+from cloudlandclient import download
+from cloudlandclient.download import Downloader
+from cloudlandclient.download import M
+from cloudlandclient.exc import ChecksumMismatch
+from cloudlandclient.exc import SomeThingWrong
+from cloudlandclient import retry
+from cloudlandclient.tests import base
+from cloudlandclient import utils
+
+
+def xattrs(directory):
+    '''Whether files in directory can have extended attributes.'''
+    filename = os.path.join(directory, 'xattrs')
+    open(filename, 'w').close()
+    try:
+        os.setxattr(filename, 'user.test', b'1')
+    except (AttributeError, OSError):
+        return False
+    finally:
+        os.remove(filename)
+    return True
+
+
+class Interrupted(Exception):
+    pass
+
+
+class FailingSession(object):
+    '''A session whose responses break off after chunks chunks in all.
+
+    Every chunk after those raises error, or only the first one if once.
+    '''
+
+    def __init__(self, session, chunks, error=Interrupted, once=False):
+        self.session = session
+        self.left = chunks
+        self.error = error
+        self.once = once
+
+    def get(self, *args, **kwargs):
+        r = self.session.get(*args, **kwargs)
+        iter_content = r.iter_content
+
+        def chunks(chunk_size):
+            for chunk in iter_content(chunk_size=chunk_size):
+                self.left -= 1
+                if self.left == -1 or self.left < 0 and not self.once:
+                    raise self.error()
+                yield chunk
+        r.iter_content = chunks
+        return r
+
+
+class RangeSession(object):
+    '''A session asking the server for other ranges than asked for.
+
+    The server then answers as one sending such ranges would, and
+    Digest headers are dropped. shrink sends the first half of
+    every range of more than a byte, shift every range starting a
+    byte later.
+    '''
+
+    def __init__(self, session, shrink=False, shift=False):
+        self.session = session
+        self.shrink = shrink
+        self.shift = shift
+
+    def get(self, url, headers=None, **kwargs):
+        headers = dict(headers or {})
+        match = re.match(r'bytes=(\d+)-(\d+)$', headers.get('Range', ''))
+        if match:
+            start, end = int(match.group(1)), int(match.group(2))
+            if self.shrink and end > start:
+                end = start + (end - start) // 2
+            if self.shift and end > start:
+                start += 1
+            headers['Range'] = 'bytes=%d-%d' % (start, end)
+        r = self.session.get(url, headers=headers, **kwargs)
+        r.headers.pop('digest', None)
+        return r
+
+
+class DownloadTest(base.TestCase):
+
+    size = 3 * M + 12345
+
+    def setUp(self):
+        super(DownloadTest, self).setUp()
+        self.fake = self.fake(snapshot_size=self.size)
+        self.session = self.client(self.fake).session
+        self.url = self.fake.endpoint.split('cloudland/api/')[0] + \
+            'snapshots/snap-0.qcow2'
+        self.target = os.path.join(self.tmp, 'snap-0.qcow2')
+        self.expected = hashlib.sha256(
+            self.fake.snapshot_data(0, self.size)).hexdigest()
+
+    def downloader(self, session=None, connections=4, **kwargs):
+        return Downloader(session=session or self.session,
+                          connections=connections, part_size=M // 2,
+                          chunk_size=64 * 1024, save_interval=0.01,
+                          quiet=True, **kwargs)
+
+    def assertDownloaded(self, downloader):
+        self.assertEqual(self.expected, downloader.digest)
+        with open(self.target, 'rb') as f:
+            self.assertEqual(self.expected,
+                             hashlib.sha256(f.read()).hexdigest())
+        self.assertFalse(os.path.exists(self.target + '.part'))
+
+    def test_ranged_digest(self):
+        for connections in (1, 3, 7):
+            if os.path.exists(self.target):
+                os.remove(self.target)
+            downloader = self.downloader(connections=connections)
+            downloader.fetch(self.url, self.target, force=True)
+            self.assertDownloaded(downloader)
+
+    def test_resume(self):
+        broken = self.downloader(FailingSession(self.session, 20))
+        self.assertRaises(Interrupted, broken.fetch, self.url, self.target)
+        self.assertTrue(os.path.exists(self.target + '.part'))
+        self.assertFalse(os.path.exists(self.target))
+        calls = self.fake.calls['snapshot_file']
+        downloader = self.downloader()
+        downloader.fetch(self.url, self.target)
+        self.assertDownloaded(downloader)
+        self.assertLess(self.fake.calls['snapshot_file'] - calls, 10)
+
+    def test_part_retried(self):
+        dropped = FailingSession(self.session, 20, once=True,
+                                 error=requests.exceptions.ConnectionError)
+        downloader = self.downloader(
+            dropped, retry_policy=retry.RetryPolicy(backoff=0))
+        downloader.fetch(self.url, self.target)
+        self.assertDownloaded(downloader)
+        # The probe, a range per connection and the one asked for again.
+        self.assertEqual(1 + 4 + 1, self.fake.calls['snapshot_file'])
+
+    def test_stalled_server(self):
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        # Connections are accepted by the kernel and never answered.
+        server.listen(5)
+        url = 'http://127.0.0.1:%d/snap-0.qcow2' % server.getsockname()[1]
+        downloader = self.downloader(requests.Session(), timeout=(1, 0.2))
+        start = time.time()
+        self.assertRaises(requests.exceptions.ReadTimeout, downloader.fetch,
+                          url, self.target)
+        self.assertLess(time.time() - start, 5)
+
+    def test_checksum_mismatch(self):
+        downloader = self.downloader()
+        self.assertRaises(ChecksumMismatch, downloader.fetch, self.url,
+                          self.target, checksum='sha256:' + '0' * 64)
+        self.assertFalse(os.path.exists(self.target))
+        self.assertFalse(os.path.exists(self.target + '.part'))
+
+    def test_short_ranges_kept_for_resume(self):
+        short = self.downloader(RangeSession(self.session, shrink=True))
+        self.assertRaises(SomeThingWrong, short.fetch, self.url, self.target)
+        self.assertFalse(os.path.exists(self.target))
+        self.assertTrue(os.path.exists(self.target + '.part'))
+        self.assertTrue(os.path.exists(self.target + '.part.progress'))
+        downloader = self.downloader()
+        downloader.fetch(self.url, self.target)
+        self.assertDownloaded(downloader)
+
+    def test_other_range_refused(self):
+        shifted = self.downloader(RangeSession(self.session, shift=True))
+        self.assertRaises(IOError, shifted.fetch, self.url, self.target)
+        self.assertFalse(os.path.exists(self.target))
+        downloader = self.downloader()
+        downloader.fetch(self.url, self.target)
+        self.assertDownloaded(downloader)
+
+    def test_skips_current_copy(self):
+        self.downloader().fetch(self.url, self.target)
+        calls = self.fake.calls['snapshot_file']
+        downloader = self.downloader()
+        downloader.fetch(self.url, self.target)
+        self.assertTrue(downloader.skipped)
+        self.assertEqual(calls + 1, self.fake.calls['snapshot_file'])
+
+    def test_skips_without_hashing(self):
+        if not xattrs(self.tmp):
+            self.skipTest('No extended attributes in %s.' % self.tmp)
+        self.downloader().fetch(self.url, self.target)
+        downloader = self.downloader()
+        downloader._hash = None
+        downloader.fetch(self.url, self.target)
+        self.assertTrue(downloader.skipped)
+        self.assertEqual(self.expected, downloader.digest)
+        # The stored digest is enough without the ETag.
+        os.removexattr(self.target, download.VALIDATOR_XATTR)
+        downloader.fetch(self.url, self.target)
+        self.assertTrue(downloader.skipped)
+
+    def test_stored_digest_mismatch(self):
+        if not xattrs(self.tmp):
+            self.skipTest('No extended attributes in %s.' % self.tmp)
+        self.downloader().fetch(self.url, self.target)
+        os.setxattr(self.target, download.DIGEST_XATTR, b'0' * 64)
+        downloader = self.downloader()
+        downloader._hash = None
+        downloader.fetch(self.url, self.target)
+        self.assertFalse(downloader.skipped)
+        self.assertDownloaded(downloader)
+
+    def test_utils_download(self):
+        utils.download(self.url, session=self.session, filename=self.target,
+                       quiet=True)
+        with open(self.target, 'rb') as f:
+            self.assertEqual(self.size, len(f.read()))
@@ -0,0 +1,113 @@
+import json
+import os
+
+from cloudlandclient import metrics
+from cloudlandclient import retry
+from cloudlandclient.tests import base
+
+
+def info(duration, status, retries=0, error=None):
+    return {'operation': 'get_vm_list', 'method': 'GET',
+            'payload_size': 18, 'duration': duration, 'status': status,
+            'response_size': 100, 'retries': retries, 'error': error}
+
+
+class HookTest(base.TestCase):
+
+    def setUp(self):
+        super(HookTest, self).setUp()
+        self.fake = self.fake()
+        self.events = []
+
+        def hook(event, info):
+            self.events.append((event, dict(info)))
+        self.client = self.client(
+            self.fake, retry_policy=retry.RetryPolicy(retries=2, backoff=0),
+            hooks=[hook])
+        # Leave out the login.
+        del self.events[:]
+
+    def test_info(self):
+        self.client.vm_list()
+        self.assertEqual(['start', 'end'],
+                         [event for event, _ in self.events])
+        start, end = [info for _, info in self.events]
+        self.assertEqual({'operation': 'get_vm_list', 'method': 'GET',
+                          'payload_size': 18, 'retries': 0}, start)
+        self.assertEqual('get_vm_list', end['operation'])
+        self.assertEqual(200, end['status'])
+        self.assertEqual(0, end['retries'])
+        self.assertIsNone(end['error'])
+        self.assertGreater(end['duration'], 0)
+        self.assertGreater(end['response_size'], 0)
+
+    def test_retries(self):
+        self.fake.failure_rate = 1
+        self.client.image_list()
+        end = self.events[-1][1]
+        self.assertEqual('get_img_list', end['operation'])
+        self.assertEqual(503, end['status'])
+        self.assertEqual(2, end['retries'])
+        self.assertEqual(3, self.fake.calls['get_img_list'])
+
+    def test_failing_hook_is_ignored(self):
+        def broken(event, info):
+            raise ValueError(event)
+        self.client.add_hook(broken)
+        self.assertIn('vm-1|', self.client.vm_list())
+        self.assertEqual(2, len(self.events))
+
+
+class MetricsCollectorTest(base.TestCase):
+
+    def setUp(self):
+        super(MetricsCollectorTest, self).setUp()
+        self.collector = metrics.MetricsCollector()
+        self.collector('start', info(None, None))
+        self.collector('end', info(0.02, 200))
+        self.collector('end', info(0.3, 503, retries=2))
+
+    def test_prometheus(self):
+        lines = self.collector.prometheus().splitlines()
+        for line in (
+                '# TYPE cloudland_request_duration_seconds histogram',
+                'cloudland_request_duration_seconds_bucket'
+                '{operation="get_vm_list",le="0.01"} 0',
+                'cloudland_request_duration_seconds_bucket'
+                '{operation="get_vm_list",le="0.025"} 1',
+                'cloudland_request_duration_seconds_bucket'
+                '{operation="get_vm_list",le="0.5"} 2',
+                'cloudland_request_duration_seconds_bucket'
+                '{operation="get_vm_list",le="+Inf"} 2',
+                'cloudland_request_duration_seconds_count'
+                '{operation="get_vm_list"} 2',
+                '# TYPE cloudland_requests_total counter',
+                'cloudland_requests_total'
+                '{operation="get_vm_list",status="200"} 1',
+                'cloudland_requests_total'
+                '{operation="get_vm_list",status="503"} 1',
+                'cloudland_request_errors_total{operation="get_vm_list"} 1',
+                'cloudland_request_retries_total{operation="get_vm_list"} 2',
+                'cloudland_request_sent_bytes_total'
+                '{operation="get_vm_list"} 36'):
+            self.assertIn(line, lines)
+
+    def test_json(self):
+        stats = json.loads(self.collector.json())['get_vm_list']
+        self.assertEqual(2, stats['requests'])
+        self.assertEqual(1, stats['errors'])
+        self.assertEqual(2, stats['retries'])
+        self.assertEqual({'200': 1, '503': 1}, stats['statuses'])
+        self.assertEqual(200, stats['bytes_received'])
+        self.assertEqual(0.025, stats['duration_p50'])
+        self.assertEqual(0.5, stats['duration_p99'])
+
+    def test_write(self):
+        filename = os.path.join(self.tmp, 'metrics.json')
+        self.collector.write(filename)
+        with open(filename) as f:
+            self.assertEqual(2, json.load(f)['get_vm_list']['requests'])
+        filename = os.path.join(self.tmp, 'metrics.prom')
+        self.collector.write(filename)
+        with open(filename) as f:
+            self.assertEqual(self.collector.prometheus(), f.read())
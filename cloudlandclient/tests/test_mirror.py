@@ -0,0 +1,139 @@
+import os
+import time
+
+import fixtures
+
+from cloudlandclient import download
+from cloudlandclient.download import TokenBucket
+from cloudlandclient.exc import DeadlineExceeded
+from cloudlandclient.exc import NothingMatched
+from cloudlandclient.mirror import DOWNLOADED
+from cloudlandclient.mirror import Mirror
+from cloudlandclient.mirror import SKIPPED
+from cloudlandclient.tests import base
+
+
+class MirrorTest(base.TestCase):
+
+    def setUp(self):
+        super(MirrorTest, self).setUp()
+        self.fake = self.fake(snapshots=3, snapshot_size=200 * 1024)
+        self.client = self.client(self.fake)
+        self.directory = os.path.join(self.tmp, 'mirror')
+
+    def mirror(self, *patterns, **kwargs):
+        bandwidth = kwargs.pop('bandwidth', None)
+        return Mirror(self.client, self.directory, concurrency=2,
+                      connections=4, bandwidth=bandwidth).run(
+                          list(patterns) or None, **kwargs)
+
+    def results(self, outcomes):
+        return [(outcome.item, outcome.result and (
+            os.path.basename(outcome.result[0]), outcome.result[1]))
+            for outcome in outcomes]
+
+    def test_mirror(self):
+        self.assertEqual(
+            [('snap-%d' % i, ('snap-%d.qcow2' % i, DOWNLOADED))
+             for i in range(3)], self.results(self.mirror()))
+        with open(os.path.join(self.directory, 'snap-1.qcow2'), 'rb') as f:
+            self.assertEqual(self.fake.snapshot_data(0, 200 * 1024),
+                             f.read())
+
+    def test_skip_and_force(self):
+        self.mirror()
+        calls = self.fake.calls['snapshot_file']
+        outcomes = self.mirror()
+        self.assertEqual([SKIPPED] * 3,
+                         [outcome.result[1] for outcome in outcomes])
+        # Only the probes.
+        self.assertEqual(calls + 3, self.fake.calls['snapshot_file'])
+        outcomes = self.mirror('snap-2', force=True)
+        self.assertEqual([('snap-2', ('snap-2.qcow2', DOWNLOADED))],
+                         self.results(outcomes))
+
+    def test_unmatched(self):
+        outcomes = self.mirror('snap-0', 'nothing-*')
+        self.assertEqual([True, False], [outcome.ok for outcome in outcomes])
+        self.assertEqual('nothing-*', outcomes[1].item)
+        self.assertIsInstance(outcomes[1].error, NothingMatched)
+
+    def test_deleted_while_mirroring(self):
+        resolve = self.client.resolve
+
+        def resolve_then_delete(*args, **kwargs):
+            result = resolve(*args, **kwargs)
+            self.client.snapshot_delete('snap-1')
+            return result
+        self.client.resolve = resolve_then_delete
+        outcomes = self.mirror()
+        self.assertEqual([True, False, True],
+                         [outcome.ok for outcome in outcomes])
+        self.assertEqual('Snapshot snap-1 does not exist.',
+                         str(outcomes[1].error))
+
+    def test_deadline(self):
+        self.fake.snapshot_size = 8 * download.M
+        start = time.time()
+        outcomes = self.mirror(bandwidth=4 * download.M, deadline=0.5)
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual([DeadlineExceeded] * 3,
+                         [type(outcome.error) for outcome in outcomes])
+        self.assertTrue(os.path.exists(os.path.join(self.directory,
+                                                    'snap-0.qcow2.part')))
+        self.assertEqual([DOWNLOADED] * 3,
+                         [outcome.result[1] for outcome in self.mirror()])
+
+
+class Clock(object):
+    '''time.time and time.sleep without waiting.'''
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TokenBucketTest(base.TestCase):
+
+    def setUp(self):
+        super(TokenBucketTest, self).setUp()
+        self.clock = Clock()
+        self.useFixture(fixtures.MonkeyPatch(
+            'cloudlandclient.download.time', self.clock))
+
+    def test_burst_without_sleeping(self):
+        bucket = TokenBucket(1000)
+        bucket.consume(600)
+        bucket.consume(400)
+        self.assertEqual([], self.clock.slept)
+
+    def test_sleeps_off_debt(self):
+        bucket = TokenBucket(1000, burst=500)
+        bucket.consume(1500)
+        self.assertEqual([1.0], self.clock.slept)
+        # Sleeping refilled the debt, not the burst.
+        bucket.consume(250)
+        self.assertEqual([1.0, 0.25], self.clock.slept)
+
+    def test_refills_to_burst(self):
+        bucket = TokenBucket(1000, burst=500)
+        bucket.consume(500)
+        self.clock.now += 60
+        bucket.consume(500)
+        self.assertEqual([], self.clock.slept)
+        bucket.consume(100)
+        self.assertEqual([0.1], self.clock.slept)
+
+    def test_rate(self):
+        bucket = TokenBucket(download.M)
+        for _ in range(10):
+            bucket.consume(download.M // 2)
+        # One second's burst, then half a second per consume.
+        self.assertAlmostEqual(4.0, sum(self.clock.slept))
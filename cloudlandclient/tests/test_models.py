@@ -0,0 +1,85 @@
+import testtools
+
+from cloudlandclient import models
+
+
+ROWS = ['vm-1|image-0|172.16.0.2|web1|5000|running|5901',
+        'vm-2|image-1|172.16.0.3,172.16.1.3|web2|5001|running|5902',
+        'vm-3|image-0|172.16.1.4 10.0.0.4|db1|5001|shut_off|5903',
+        # A row without its IP and the columns after it.
+        'vm-4|image-1']
+
+
+class RecordTest(testtools.TestCase):
+
+    def test_from_line(self):
+        vm = models.VM.from_line(ROWS[0])
+        self.assertEqual('vm-1', vm.id)
+        self.assertEqual('web1', vm.name)
+        self.assertEqual('5000', vm.vxlan)
+        self.assertEqual(ROWS[0], '|'.join(vm))
+        self.assertEqual(vm, models.VM.from_line(ROWS[0]))
+        self.assertFalse(hasattr(vm, '__dict__'))
+
+    def test_missing_fields(self):
+        vm = models.VM.from_line(ROWS[3])
+        self.assertEqual('', vm.ip)
+        self.assertEqual([], vm.keys('ip'))
+        self.assertEqual([''], vm.keys('status'))
+
+    def test_parse(self):
+        body = '["%s", "", 0]' % ROWS[0]
+        self.assertEqual([models.VM.from_line(ROWS[0])],
+                         models.parse(models.VM, body))
+
+
+class InventoryTest(testtools.TestCase):
+
+    def setUp(self):
+        super(InventoryTest, self).setUp()
+        self.vms = models.Inventory(models.VM, [models.VM.from_line(row)
+                                                for row in ROWS])
+
+    def ids(self, records):
+        return [record.id for record in records]
+
+    def test_get(self):
+        self.assertEqual('db1', self.vms.get('vm-3').name)
+        self.assertIsNone(self.vms.get('vm-9'))
+        self.assertIn('vm-4', self.vms)
+        self.assertEqual(4, len(self.vms))
+
+    def test_lookup(self):
+        self.assertEqual(['vm-2', 'vm-3'], self.ids(self.vms.lookup('vxlan',
+                                                                    5001)))
+        self.assertEqual(['vm-1', 'vm-2'],
+                         self.ids(self.vms.lookup('status', 'running')))
+        self.assertEqual([], self.ids(self.vms.lookup('name', 'nothing')))
+
+    def test_multivalued_ip(self):
+        self.assertEqual(['vm-2'],
+                         self.ids(self.vms.lookup('ip', '172.16.1.3')))
+        self.assertEqual(['vm-2'],
+                         self.ids(self.vms.lookup('ip', '172.16.0.3')))
+        self.assertEqual(['vm-3'],
+                         self.ids(self.vms.lookup('ip', '10.0.0.4')))
+        self.assertEqual([], self.vms.lookup('ip', ''))
+
+    def test_record_without_indexed_field(self):
+        self.assertEqual(['vm-4'], self.ids(self.vms.lookup('status', '')))
+        self.assertEqual(['vm-2', 'vm-4'],
+                         self.ids(self.vms.find(image='image-1')))
+
+    def test_find(self):
+        self.assertEqual(['vm-3'], self.ids(self.vms.find(
+            vxlan='5001', status='shut_off')))
+        self.assertEqual(['vm-2'], self.ids(self.vms.find(id='vm-2')))
+        self.assertEqual([], self.vms.find(id='vm-2', status='shut_off'))
+        self.assertEqual([], self.vms.find(id='vm-9'))
+        self.assertEqual(['vm-1', 'vm-2', 'vm-3', 'vm-4'],
+                         self.ids(self.vms.find()))
+
+    def test_find_not_indexed(self):
+        self.assertEqual(['vm-2'], self.ids(self.vms.find(vnc='5902')))
+        self.assertEqual(['vm-3'], self.ids(self.vms.find(vnc='5903',
+                                                          name='db1')))
@@ -0,0 +1,115 @@
+import threading
+import time
+
+from cloudlandclient.exc import SomeThingWrong
+from cloudlandclient import reconcile
+from cloudlandclient.tests import base
+
+
+SPEC = {
+    'vlans': [{'vlan': 5005, 'network': '172.16.5.0',
+               'netmask': '255.255.255.0', 'gateway': '172.16.5.1'}],
+    'vms': [{'name': 'db-1', 'image': 'image-0', 'vlan': 5005,
+             'vlans': [5000, 5005]},
+            {'name': 'vm0', 'image': 'image-0', 'vlan': 5000,
+             'vlans': [5001]}],
+    'volumes': [{'desc': 'db-1-data', 'size': 10, 'vm': 'db-1'}],
+}
+
+
+class PlanTest(base.TestCase):
+
+    def setUp(self):
+        super(PlanTest, self).setUp()
+        self.fake = self.fake()
+        self.client = self.client(self.fake)
+
+    def test_plan(self):
+        plan = reconcile.plan(self.client, SPEC)
+        self.assertEqual(
+            ['create|vlan 5005|',
+             'create|vm db-1|vlan/5005',
+             'attach|vlan 5000 to vm db-1|vm/db-1',
+             'create|volume db-1-data|',
+             'attach|volume db-1-data to vm db-1|volume/db-1-data, vm/db-1'],
+            plan.lines())
+        self.assertEqual('vm-1', plan.vms['vm0'])
+
+    def test_apply_twice(self):
+        outcomes = reconcile.plan(self.client, SPEC).apply()
+        self.assertEqual([None] * 5, [outcome.error for outcome in outcomes])
+        vm = self.client.inventory('vm').lookup('name', 'db-1')[0].id
+        self.assertEqual({vm: [5000]}, self.fake.nics)
+        volume = self.client.inventory('volume').find(desc='db-1-data')[0]
+        self.assertEqual(vm, volume.vm)
+        self.assertEqual(0, len(reconcile.plan(self.client, SPEC)))
+        self.assertEqual({vm: [5000]}, self.fake.nics)
+
+    def test_volume_on_vm_outside_spec(self):
+        spec = {'volumes': [{'desc': 'vm1-data', 'size': 10, 'vm': 'vm1'}]}
+        outcomes = reconcile.plan(self.client, spec).apply()
+        self.assertEqual([None] * 2, [outcome.error for outcome in outcomes])
+        volume = self.client.inventory('volume').find(desc='vm1-data')[0]
+        self.assertEqual('vm-2', volume.vm)
+        self.assertEqual(0, len(reconcile.plan(self.client, spec)))
+
+    def test_failed_requirement_skips(self):
+        spec = dict(SPEC, vms=[dict(SPEC['vms'][0], image='missing')])
+        outcomes = reconcile.plan(self.client, spec).apply()
+        self.assertEqual([True, False, False, True, False],
+                         [outcome.ok for outcome in outcomes])
+        self.assertIn('Skipped, vm/db-1 failed.', str(outcomes[2].error))
+        self.assertEqual({}, self.fake.nics)
+
+
+class ApplyTest(base.TestCase):
+
+    def plan(self, *steps):
+        '''A plan of steps (key, requires, error).
+
+        The order its steps start and end in is recorded.
+        '''
+        plan = reconcile.Plan(None)
+        self.events = []
+        lock = threading.Lock()
+
+        def func(key, error):
+            def run():
+                with lock:
+                    self.events.append('start ' + key)
+                time.sleep(0.01)
+                with lock:
+                    self.events.append('end ' + key)
+                if error:
+                    raise SomeThingWrong(message=error)
+            return run
+        for key, requires, error in steps:
+            plan.add(key, 'run', key, func(key, error), requires)
+        return plan
+
+    def test_order(self):
+        plan = self.plan(('a', [], None), ('b', ['a'], None),
+                         ('c', [], None), ('d', ['b', 'c'], None))
+        self.assertTrue(all(outcome.ok for outcome in plan.apply()))
+        for before, after in (('a', 'b'), ('b', 'd'), ('c', 'd')):
+            self.assertLess(self.events.index('end ' + before),
+                            self.events.index('start ' + after))
+        # Independent steps run at the same time.
+        self.assertLess(self.events.index('start c'),
+                        self.events.index('end a'))
+
+    def test_skips_after_failure(self):
+        plan = self.plan(('a', [], 'broken'), ('b', ['a'], None),
+                         ('c', ['b'], None), ('d', [], None))
+        outcomes = plan.apply()
+        self.assertEqual([False, False, False, True],
+                         [outcome.ok for outcome in outcomes])
+        self.assertEqual('broken', str(outcomes[0].error))
+        self.assertEqual('Skipped, b failed.', str(outcomes[2].error))
+        self.assertNotIn('start b', self.events)
+        self.assertNotIn('start c', self.events)
+
+    def test_unknown_requirement_ignored(self):
+        plan = self.plan(('a', ['exists'], None))
+        self.assertEqual([], plan.steps[0].requires)
+        self.assertTrue(plan.apply()[0].ok)
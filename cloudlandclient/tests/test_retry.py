@@ -0,0 +1,105 @@
+import socket
+
+import requests
+from requests.packages.urllib3 import exceptions as urllib3_exceptions
+import testtools
+
+from cloudlandclient.exc import DeadlineExceeded
+from cloudlandclient import retry
+
+
+def response(status):
+    r = requests.Response()
+    r.status_code = status
+    return r
+
+
+def refused():
+    '''The error of connecting to a port nothing listens on.'''
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    try:
+        requests.get('http://127.0.0.1:%d/' % port)
+    except requests.exceptions.ConnectionError as e:
+        return e
+
+
+class RetryPolicyTest(testtools.TestCase):
+
+    def setUp(self):
+        super(RetryPolicyTest, self).setUp()
+        self.policy = retry.RetryPolicy(retries=3)
+
+    def test_statuses(self):
+        self.assertTrue(self.policy.should_retry(0, True,
+                                                 response=response(503)))
+        self.assertFalse(self.policy.should_retry(0, True,
+                                                  response=response(404)))
+        self.assertFalse(self.policy.should_retry(0, False,
+                                                  response=response(503)))
+
+    def test_limit(self):
+        self.assertTrue(self.policy.should_retry(2, True,
+                                                 response=response(503)))
+        self.assertFalse(self.policy.should_retry(3, True,
+                                                  response=response(503)))
+        self.assertFalse(self.policy.should_retry(3, False, refused()))
+        self.assertFalse(retry.NO_RETRY.should_retry(0, True, refused()))
+
+    def test_errors_after_connecting(self):
+        for error in (requests.exceptions.ReadTimeout(),
+                      requests.exceptions.ConnectionError(),
+                      requests.exceptions.ChunkedEncodingError()):
+            self.assertTrue(self.policy.should_retry(0, True, error))
+            self.assertFalse(self.policy.should_retry(0, False, error))
+        self.assertFalse(self.policy.should_retry(0, True, ValueError()))
+
+    def test_connect_failed(self):
+        self.assertTrue(self.policy.should_retry(0, False, refused()))
+        self.assertTrue(self.policy.should_retry(
+            0, False, requests.exceptions.ConnectTimeout()))
+
+    @testtools.skipUnless(hasattr(urllib3_exceptions, 'NameResolutionError'),
+                          'urllib3 before 2 has no NameResolutionError')
+    def test_name_resolution_failed(self):
+        reason = urllib3_exceptions.NameResolutionError(
+            'cloudland.invalid', None, socket.gaierror(-2, 'Name unknown'))
+        error = requests.exceptions.ConnectionError(
+            urllib3_exceptions.MaxRetryError(None, '/', reason))
+        self.assertTrue(self.policy.should_retry(0, False, error))
+
+    def test_delay(self):
+        policy = retry.RetryPolicy(backoff=0.5, max_backoff=3)
+        for attempt, bound in ((0, 0.5), (2, 2), (5, 3)):
+            for _ in range(20):
+                self.assertTrue(0 <= policy.delay(attempt) <= bound)
+
+
+class DeadlineTest(testtools.TestCase):
+
+    def test_unlimited(self):
+        deadline = retry.Deadline()
+        self.assertIsNone(deadline.remaining())
+        self.assertEqual(5, deadline.cap(5))
+        self.assertIsNone(deadline.cap(None))
+        deadline.check()
+
+    def test_of(self):
+        deadline = retry.Deadline(10)
+        self.assertIs(deadline, retry.Deadline.of(deadline))
+        self.assertIsNone(retry.Deadline.of(None).expires)
+        self.assertTrue(9 < retry.Deadline.of(10).remaining() <= 10)
+
+    def test_cap(self):
+        deadline = retry.Deadline(10)
+        self.assertEqual(5, deadline.cap(5))
+        self.assertTrue(9 < deadline.cap(60) <= 10)
+        self.assertTrue(9 < deadline.cap(None) <= 10)
+
+    def test_expired(self):
+        deadline = retry.Deadline(0)
+        self.assertEqual(0, deadline.remaining())
+        self.assertEqual(0, deadline.cap(5))
+        self.assertRaises(DeadlineExceeded, deadline.check)
@@ -0,0 +1,213 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import fixtures
+
+from cloudlandclient import shell
+from cloudlandclient.tests import base
+
+
+class ShellTest(base.TestCase):
+
+    def setUp(self):
+        super(ShellTest, self).setUp()
+        self.fake = self.fake()
+        self.stdout = self.useFixture(fixtures.StringStream('stdout'))
+        self.useFixture(fixtures.MonkeyPatch('sys.stdout',
+                                             self.stdout.stream))
+
+    def run_shell(self, *argv):
+        '''Exit status and output of the cloudland command argv.'''
+        argv = ['--endpoint', self.fake.endpoint, '--username', 'user',
+                '--password', 'secret'] + list(argv)
+        status = shell.main(argv)
+        self.stdout.stream.flush()
+        return status, self.stdout.getDetails()['stdout'].as_text()
+
+    def imported(self, *argv):
+        '''Names of the cloudlandclient modules a command loads.
+
+        The cloudland command argv is run in a new interpreter.
+        '''
+        script = ('import sys\n'
+                  'from cloudlandclient import shell\n'
+                  'shell.main(sys.argv[1:])\n'
+                  'sys.stderr.write(" ".join(sys.modules))\n')
+        argv = ['--endpoint', self.fake.endpoint, '--username', 'user',
+                '--password', 'secret'] + list(argv)
+        process = subprocess.Popen([sys.executable, '-c', script] + argv,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   cwd=os.path.dirname(os.path.dirname(
+                                       shell.__file__)))
+        out, err = process.communicate()
+        self.assertEqual(0, process.returncode, err)
+        return [name for name in err.decode('utf-8').split()
+                if name.startswith('cloudlandclient')]
+
+    def lists(self):
+        return self.fake.calls.get('get_vm_list', 0)
+
+    def batch(self, text, *options):
+        '''Exit status and results of a batch of text.'''
+        batch = os.path.join(self.tmp, 'batch')
+        with open(batch, 'w') as f:
+            f.write(text)
+        status, out = self.run_shell('batch', batch, *options)
+        return status, [json.loads(line) for line in out.splitlines()]
+
+    def timed(self):
+        '''Start and end times of the batch lines run, by line.'''
+        runs = {}
+        lock = threading.Lock()
+        run_line = shell.CloudlandShell._run_line
+
+        def timed_line(shell, line):
+            start = time.time()
+            try:
+                return run_line(shell, line)
+            finally:
+                with lock:
+                    runs[line] = (start, time.time())
+        self.useFixture(fixtures.MonkeyPatch(
+            'cloudlandclient.shell.CloudlandShell._run_line', timed_line))
+        return runs
+
+    def test_lazy_imports(self):
+        modules = self.imported('vm-list')
+        self.assertIn('cloudlandclient.client', modules)
+        for module in ('download', 'upload', 'reconcile', 'mirror', 'aio'):
+            self.assertNotIn('cloudlandclient.' + module, modules)
+
+    def test_one_subparser(self):
+        cloudland = shell.CloudlandShell()
+        cloudland.main(['--endpoint', self.fake.endpoint, '--username',
+                        'user', '--password', 'secret', 'vm-list'])
+        self.assertEqual(['vm-list'], list(cloudland.subcommands))
+        cloudland.main(['help', 'vm-start'])
+        self.assertEqual(['help', 'vm-start'],
+                         sorted(cloudland.subcommands))
+
+    def test_single_id_without_list(self):
+        status, out = self.run_shell('vm-start', 'vm-1')
+        self.assertFalse(status)
+        self.assertIn('running', out)
+        self.assertEqual(0, self.lists())
+        self.assertEqual(1, self.fake.calls['create_vm'])
+        self.assertEqual('running', self.fake.vms['vm-1'][5])
+
+    def test_single_name_resolved_once(self):
+        status, out = self.run_shell('vm-stop', 'vm1')
+        self.assertFalse(status)
+        self.assertEqual(1, self.lists())
+        self.assertEqual('shut_off', self.fake.vms['vm-2'][5])
+
+    def test_single_unmatched_resolved_once(self):
+        status, out = self.run_shell('vm-delete', 'nothing')
+        self.assertEqual(1, status)
+        self.assertIn('0 succeeded, 1 failed.', out)
+        self.assertEqual(1, self.lists())
+
+    def test_patterns_resolved_once(self):
+        status, out = self.run_shell('vm-start', 'vm-5', 'vm2')
+        self.assertFalse(status)
+        self.assertIn('2 succeeded, 0 failed.', out)
+        self.assertEqual(1, self.lists())
+
+    def test_apply_dry_run(self):
+        spec = os.path.join(self.tmp, 'spec.json')
+        with open(spec, 'w') as f:
+            json.dump({'vms': [{'name': 'db-1', 'image': 'image-0',
+                                'vlan': 5000, 'vlans': [5001]}]}, f)
+        status, out = self.run_shell('apply', '--dry-run', spec)
+        self.assertFalse(status)
+        self.assertIn('vlan 5001 to vm db-1', out)
+        self.assertNotIn('launch_vm', self.fake.calls)
+        self.assertNotIn('attach_nic', self.fake.calls)
+        status, out = self.run_shell('apply', spec)
+        self.assertFalse(status)
+        self.assertEqual(1, self.fake.calls['attach_nic'])
+        status, out = self.run_shell('apply', spec)
+        self.assertIn('Nothing to do.', out)
+        self.assertEqual(1, self.fake.calls['attach_nic'])
+
+    def test_missing_snapshot_download(self):
+        status, out = self.run_shell('snapshot-download', 'missing')
+        self.assertTrue(status)
+        self.assertIn('Snapshot missing does not exist.', out)
+
+    def test_metrics(self):
+        filename = os.path.join(self.tmp, 'metrics.json')
+        status, out = self.run_shell('--metrics', filename, 'vm-list')
+        self.assertFalse(status)
+        with open(filename) as f:
+            stats = json.load(f)
+        self.assertEqual(1, stats['get_vm_list']['requests'])
+        self.assertEqual({'200': 1}, stats['get_vm_list']['statuses'])
+
+    def test_batch_reports_bad_line(self):
+        batch = os.path.join(self.tmp, 'batch')
+        with open(batch, 'w') as f:
+            f.write("vlan-list\n# comment\nvm-start 'vm-1\nvm-start vm-1\n")
+        status, out = self.run_shell('batch', batch)
+        self.assertEqual(1, status)
+        results = [json.loads(line) for line in out.splitlines()]
+        self.assertEqual([1, 3, 4], [result['line'] for result in results])
+        self.assertEqual([0, 1, 0], [result['status'] for result in results])
+        self.assertIn('No closing quotation', results[1]['error'])
+        self.assertEqual(1, self.fake.calls['create_vm'])
+
+    def test_batch_concurrency(self):
+        self.fake.latency = 0.1
+        runs = self.timed()
+        status, results = self.batch(
+            ''.join('vm-start vm-%d\n' % i for i in range(1, 7)),
+            '--concurrency', '2')
+        self.assertFalse(status)
+        self.assertEqual(list(range(1, 7)),
+                         [result['line'] for result in results])
+        times = sorted(runs.values())
+        busiest = max(len([run for run in times
+                           if run[0] <= start < run[1]])
+                      for start, _ in times)
+        self.assertEqual(2, busiest)
+
+    def test_batch_waits_between_groups(self):
+        self.fake.latency = 0.05
+        runs = self.timed()
+        status, results = self.batch(
+            'vm-start vm-1\nvm-start vm-2\nwait\n'
+            'vm-stop vm-1\nvm-stop vm-2\n', '--concurrency', '4')
+        self.assertFalse(status)
+        self.assertEqual([1, 2, 4, 5], [result['line'] for result in results])
+        first = max(runs['vm-start vm-%d' % i][1] for i in (1, 2))
+        second = min(runs['vm-stop vm-%d' % i][0] for i in (1, 2))
+        self.assertLessEqual(first, second)
+        # Both lines of a group run at once.
+        self.assertLess(runs['vm-start vm-2'][0], runs['vm-start vm-1'][1])
+
+    def test_batch_status_of_failed_line(self):
+        status, results = self.batch(
+            'vm-start vm-1\nvm-start vm-99\nvm-start vm-2\n',
+            '--concurrency', '3')
+        self.assertEqual(1, status)
+        self.assertEqual([0, 1, 0], [result['status'] for result in results])
+        self.assertEqual(3, self.fake.calls['create_vm'])
+
+    def test_list_fields(self):
+        status, out = self.run_shell('vm-list', '--format', 'json',
+                                     '--fields', 'name,STATUS', '--limit',
+                                     '2')
+        self.assertFalse(status)
+        self.assertEqual([{'name': 'vm0', 'status': 'shut_off'},
+                          {'name': 'vm1', 'status': 'running'}],
+                         json.loads(out))
+
+    def test_unknown_field(self):
+        status, out = self.run_shell('vm-list', '--fields', 'name,size')
+        self.assertEqual(1, status)
+        self.assertIn('Unknown field size', out)
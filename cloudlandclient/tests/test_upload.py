@@ -0,0 +1,77 @@
+import hashlib
+import os
+
+from cloudlandclient.download import M
+from cloudlandclient.tests import base
+from cloudlandclient.upload import Uploader
+
+
+class UploadTest(base.TestCase):
+
+    size = 3 * M + 123
+
+    def setUp(self):
+        super(UploadTest, self).setUp()
+        self.fake = self.fake()
+        self.client = self.client(self.fake)
+        self.source = os.path.join(self.tmp, 'img.qcow2')
+        data = os.urandom(self.size)
+        with open(self.source, 'wb') as f:
+            f.write(data)
+        self.checksum = hashlib.sha256(data).hexdigest()
+
+    def uploader(self, retries=3):
+        return Uploader(self.client, part_size=M, chunk_size=64 * 1024,
+                        retries=retries, quiet=True)
+
+    def fail_part(self, number, keep=None):
+        '''Make the numberth part fail.
+
+        The server keeps keep bytes of what it received, all by
+        default.
+        '''
+        send = self.client.image_upload_part
+        parts = []
+
+        def part(body):
+            parts.append(body.offset)
+            received = send(body)
+            if len(parts) != number:
+                return received
+            if keep is not None:
+                del self.fake.uploads['img.qcow2'][body.offset + keep:]
+            raise IOError('connection reset')
+        self.client.image_upload_part = part
+        return parts
+
+    def assertUploaded(self, body):
+        self.assertIn('img.qcow2|created', body)
+        self.assertEqual('3M', self.fake.images['img.qcow2'][1])
+        self.assertNotIn('img.qcow2', self.fake.uploads)
+
+    def test_upload(self):
+        self.assertUploaded(self.uploader().send(self.source))
+        self.assertEqual(4, self.fake.calls['upload_img_part'])
+
+    def test_resume_in_new_upload(self):
+        self.fail_part(3)
+        self.assertRaises(IOError, self.uploader(retries=0).send,
+                          self.source)
+        self.assertEqual(3 * M, len(self.fake.uploads['img.qcow2']))
+        del self.client.image_upload_part
+        calls = self.fake.calls['upload_img_part']
+        self.assertUploaded(self.uploader().send(self.source))
+        self.assertEqual(1, self.fake.calls['upload_img_part'] - calls)
+
+    def test_no_resume_starts_over(self):
+        self.fail_part(2)
+        self.assertRaises(IOError, self.uploader(retries=0).send,
+                          self.source)
+        del self.client.image_upload_part
+        calls = self.fake.calls['upload_img_part']
+        self.assertUploaded(self.uploader().send(self.source, resume=False))
+        self.assertEqual(4, self.fake.calls['upload_img_part'] - calls)
+
+    def test_part_kept_in_part(self):
+        self.fail_part(2, keep=M // 2)
+        self.assertUploaded(self.uploader().send(self.source))
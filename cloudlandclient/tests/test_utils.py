@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+
+import fixtures
+
+from cloudlandclient.exc import SomeThingWrong
+from cloudlandclient.tests import base
+from cloudlandclient import utils
+
+
+BODY = json.dumps(['vm-1|image-0|10.0.0.2|web', u'vm-2|镜像|10.0.0.3|db',
+                   12345, 0]).encode('utf-8')
+
+
+class IterloadsTest(base.TestCase):
+
+    def test_every_split(self):
+        expected = ['vm-1|image-0|10.0.0.2|web', u'vm-2|镜像|10.0.0.3|db',
+                    12345]
+        for i in range(len(BODY) + 1):
+            self.assertEqual(expected, list(utils.iterloads(
+                [BODY[:i], BODY[i:]])), 'split at %d' % i)
+
+    def test_byte_chunks(self):
+        chunks = [BODY[i:i + 1] for i in range(len(BODY))]
+        self.assertEqual(3, len(list(utils.iterloads(chunks))))
+
+    def test_text_chunks(self):
+        text = BODY.decode('utf-8')
+        self.assertEqual(3, len(list(utils.iterloads(
+            [text[:7], text[7:30], text[30:]]))))
+
+    def test_number_across_chunks(self):
+        self.assertEqual([123], list(utils.iterloads([b'[12', b'3, 0]'])))
+
+    def test_not_a_list(self):
+        e = self.assertRaises(SomeThingWrong, list, utils.iterloads(
+            ['You need to login', ' before proceed!']))
+        self.assertEqual('You need to login before proceed!', str(e))
+
+    def test_truncated(self):
+        e = self.assertRaises(SomeThingWrong, list,
+                              utils.iterloads([BODY[:-3]]))
+        self.assertEqual('Truncated list response.', str(e))
+
+    def test_failure_status(self):
+        e = self.assertRaises(SomeThingWrong, list,
+                              utils.iterloads([b'["a|b", 1]']))
+        self.assertEqual('List response status 1.', str(e))
+
+    def test_empty(self):
+        self.assertRaises(SomeThingWrong, list, utils.iterloads([b'[]']))
+
+
+HEAD = 'VM|NAME|VXLAN|STATUS'
+ROWS = ['vm-1|web-1|5000|running',
+        'vm-2|web-2|100|shut_off',
+        'vm-3|db-1|5001|running',
+        'vm-4|db-2|90|running',
+        'vm-5|cache',
+        '',
+        'vm-6|web-3|5000|building']
+
+
+class QueryTest(base.TestCase):
+
+    def select(self, **kwargs):
+        return [row.split('|')[0]
+                for row in utils.select(HEAD, ROWS, **kwargs)]
+
+    def test_everything(self):
+        self.assertEqual(['vm-1', 'vm-2', 'vm-3', 'vm-4', 'vm-5', 'vm-6'],
+                         self.select())
+
+    def test_filters(self):
+        self.assertEqual(['vm-1', 'vm-6'],
+                         self.select(filters=['vxlan=5000']))
+        self.assertEqual(['vm-1', 'vm-2', 'vm-6'],
+                         self.select(filters=['NAME=web-*']))
+        self.assertEqual(['vm-2', 'vm-5', 'vm-6'],
+                         self.select(filters=['status!=running']))
+        self.assertEqual(['vm-1', 'vm-6'],
+                         self.select(filters=['name=web-?', 'vxlan=5000']))
+        self.assertEqual(['vm-5'], self.select(filters=['status=']))
+
+    def test_equal_or_matching(self):
+        rows = ['a|[x]||', 'b|x||', 'c|y||']
+        self.assertEqual(['a|[x]||', 'b|x||'],
+                         list(utils.select(HEAD, rows, ['name=[x]'])))
+
+    def test_numeric_sort(self):
+        # Numbers sort before text, such as a missing value.
+        self.assertEqual(['vm-4', 'vm-2', 'vm-1', 'vm-6', 'vm-3', 'vm-5'],
+                         self.select(sort='vxlan'))
+        self.assertEqual(['vm-5', 'vm-3', 'vm-1', 'vm-6', 'vm-2', 'vm-4'],
+                         self.select(sort='vxlan:desc'))
+
+    def test_sort_keys(self):
+        self.assertEqual(['vm-5', 'vm-6', 'vm-1', 'vm-4', 'vm-3', 'vm-2'],
+                         self.select(sort='status, name:desc'))
+        self.assertEqual(['vm-5', 'vm-3', 'vm-6', 'vm-1', 'vm-2', 'vm-4'],
+                         self.select(sort='vxlan:desc,vm:desc'))
+
+    def test_limit_stops_reading(self):
+        read = []
+
+        def rows():
+            for row in ROWS:
+                read.append(row)
+                yield row
+        limited = utils.select(HEAD, rows(), filters=['status=running'],
+                               limit=2)
+        self.assertEqual(['vm-1|web-1|5000|running',
+                          'vm-3|db-1|5001|running'], list(limited))
+        self.assertEqual(ROWS[:3], read)
+
+    def test_limit_after_sort(self):
+        self.assertEqual(['vm-4', 'vm-2', 'vm-1'],
+                         self.select(sort='vxlan', limit=3))
+        self.assertEqual(['vm-3'], self.select(sort='vxlan:desc', limit=1,
+                                               filters=['vxlan!=']))
+        self.assertEqual([], self.select(limit=0))
+        self.assertEqual([], self.select(sort='vm', limit=0))
+
+    def test_bad_arguments(self):
+        # Checked when the query is made, before any row is read.
+        for kwargs, message in (
+                ({'filters': ['owner=me']}, 'Unknown field owner'),
+                ({'filters': ['status']}, 'Bad filter status'),
+                ({'filters': ['=running']}, 'Bad filter =running'),
+                ({'sort': 'name:up'}, 'Bad sort order up'),
+                ({'sort': 'size'}, 'Unknown field size')):
+            e = self.assertRaises(SomeThingWrong, utils.query, HEAD,
+                                  **kwargs)
+            self.assertIn(message, str(e))
+
+
+class IterListTest(base.TestCase):
+
+    def test_limit_closes_response(self):
+        fake = self.fake(vms=5000)
+        client = self.client(fake)
+        responses = []
+        get = client.get
+
+        def recording_get(*args, **kwargs):
+            r = get(*args, **kwargs)
+            responses.append(r)
+            r.read = 0
+            iter_content = r.iter_content
+
+            def counted(chunk_size):
+                for chunk in iter_content(chunk_size=chunk_size):
+                    r.read += len(chunk)
+                    yield chunk
+            r.iter_content = counted
+            return r
+        client.get = recording_get
+        rows = list(client.iter_list('vm', chunk_size=1024,
+                                     filters=['status=running'], limit=3))
+        self.assertEqual(3, len(rows))
+        r = responses[-1]
+        self.assertLess(r.read, 4096)
+        self.assertTrue(r.raw.closed)
+        self.assertEqual(3, len(list(client.iter_list('vm', sort='name',
+                                                      limit=3))))
+
+
+class OutputTest(base.TestCase):
+
+    rows = ['vm-1|web-1|5000|running', 'vm-2|db, "main"|100|shut_off',
+            'vm-3|short', '']
+
+    def output(self, format, fields=None, rows=None):
+        out = io.StringIO()
+        self.useFixture(fixtures.MonkeyPatch('sys.stdout', out))
+        utils.output(HEAD, iter(self.rows if rows is None else rows),
+                     format, fields)
+        return out.getvalue()
+
+    def test_columns(self):
+        self.assertEqual((['VM', 'NAME', 'VXLAN', 'STATUS'], [0, 1, 2, 3]),
+                         utils.columns(HEAD))
+        self.assertEqual((['STATUS', 'VM'], [3, 0]),
+                         utils.columns(HEAD, 'status, Vm'))
+
+    def test_unknown_field(self):
+        e = self.assertRaises(SomeThingWrong, utils.columns, HEAD,
+                              'name,size')
+        self.assertEqual('Unknown field size, choose from vm, name, vxlan, '
+                         'status.', str(e))
+
+    def test_json(self):
+        self.assertEqual([{'vm': 'vm-1', 'status': 'running'},
+                          {'vm': 'vm-2', 'status': 'shut_off'},
+                          {'vm': 'vm-3', 'status': ''}],
+                         json.loads(self.output('json', 'vm,status')))
+        self.assertEqual('[]\n', self.output('json', rows=[]))
+
+    def test_ndjson(self):
+        lines = self.output('ndjson', 'name').splitlines()
+        self.assertEqual([{'name': 'web-1'}, {'name': 'db, "main"'},
+                          {'name': 'short'}],
+                         [json.loads(line) for line in lines])
+
+    def test_csv(self):
+        self.assertEqual('NAME,VXLAN\nweb-1,5000\n"db, ""main""",100\n'
+                         'short,\n', self.output('csv', 'name,vxlan'))
+
+    def test_value(self):
+        self.assertEqual('vm-1 running\nvm-2 shut_off\nvm-3 \n',
+                         self.output('value', 'vm,status'))
+
+    def test_table(self):
+        lines = self.output('table', 'vm,vxlan').splitlines()
+        self.assertIn('VXLAN', lines[1])
+        self.assertEqual(['|', 'vm-1', '|', '5000', '|'], lines[3].split())
+        self.assertEqual(7, len(lines))
+
+    def test_unknown_format(self):
+        e = self.assertRaises(SomeThingWrong, self.output, 'yaml')
+        self.assertEqual('Unknown format yaml.', str(e))
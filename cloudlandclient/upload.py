@@ -0,0 +1,210 @@
+'''
+Streaming, resumable image uploads from a local file or stdin.
+
+The image is sent in parts of part_size bytes. Each part is one POST
+whose multipart/form-data body is generated while the file is read and
+sent with chunked transfer encoding, so no part is held in memory. A
+SHA-256 of the whole image is computed on the way and checked by the
+server when the upload is committed.
+
+The server reports how many bytes of an upload it holds, so a file
+upload that was interrupted, in this process or an earlier one, goes on
+after the last complete part.
+'''
+
+import hashlib
+import logging
+import os
+import sys
+import uuid
+
+from cloudlandclient.download import M
+from cloudlandclient.download import Progress
+from cloudlandclient.exc import SomeThingWrong
+
+
+logger = logging.getLogger(__name__)
+
+
+class MultipartBody(object):
+    '''A multipart/form-data body, generated as it is iterated.
+
+    It holds the fields followed by size bytes of stream. requests
+    sends an iterable without a length with chunked transfer
+    encoding. Iterating again, as a replayed request does, seeks back
+    to offset when the stream allows it.
+    '''
+
+    def __init__(self, fields, name, stream, offset, size, chunk_size,
+                 on_chunk=None):
+        self.fields = fields
+        self.name = name
+        self.stream = stream
+        self.offset = offset
+        self.size = size
+        self.chunk_size = chunk_size
+        self.on_chunk = on_chunk
+        self.boundary = uuid.uuid4().hex
+        self.started = False
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def _header(self, name, filename=None):
+        disposition = 'form-data; name="%s"' % name
+        if filename:
+            disposition += '; filename="%s"' % filename
+        lines = ['--%s' % self.boundary,
+                 'Content-Disposition: %s' % disposition]
+        if filename:
+            lines.append('Content-Type: application/octet-stream')
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8')
+
+    def __iter__(self):
+        if self.started:
+            if not _seekable(self.stream):
+                raise SomeThingWrong(message='Cannot send a part of %s '
+                                     'again.' % self.name)
+            self.stream.seek(self.offset)
+        self.started = True
+        for name, value in sorted(self.fields.items()):
+            if value is not None:
+                yield self._header(name) + str(value).encode('utf-8') + \
+                    b'\r\n'
+        yield self._header('img_file', self.name)
+        left = self.size
+        position = self.offset
+        while left > 0:
+            chunk = self.stream.read(min(self.chunk_size, left))
+            if not chunk:
+                break
+            if self.on_chunk is not None:
+                self.on_chunk(position, chunk)
+            position += len(chunk)
+            left -= len(chunk)
+            yield chunk
+        yield ('\r\n--%s--\r\n' % self.boundary).encode('utf-8')
+
+    def __repr__(self):
+        return '<MultipartBody %s at %d>' % (self.fields, self.offset)
+
+
+def _seekable(stream):
+    try:
+        stream.tell()
+    except (AttributeError, IOError, OSError):
+        return False
+    return getattr(stream, 'seekable', lambda: True)()
+
+
+class Uploader(object):
+    '''Upload images through a CloudlandClient.
+
+    part_size is the size of each POST, chunk_size that of each read,
+    and retries the number of times a failed part of a local file is
+    sent again before giving up.
+    '''
+
+    def __init__(self, client, part_size=64 * M, chunk_size=M, retries=3,
+                 quiet=False):
+        self.client = client
+        self.part_size = part_size
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.quiet = quiet
+
+    def send(self, source, name=None, platform='linux', shared='true',
+             desc=None, resume=True):
+        '''Upload source, a file name or '-' for stdin, as image name.
+
+        name defaults to the file name. With resume, an unfinished
+        upload of the same name continues where it stopped. Returns the
+        commit response body.
+        '''
+        if source == '-':
+            if not name:
+                raise SomeThingWrong(message='An image name is needed to '
+                                     'upload from stdin.')
+            stream = getattr(sys.stdin, 'buffer', sys.stdin)
+            return self._send(stream, None, name, platform, shared, desc,
+                              False)
+        name = name or os.path.basename(source)
+        with open(source, 'rb') as stream:
+            return self._send(stream, os.path.getsize(source), name,
+                              platform, shared, desc, resume)
+
+    def _send(self, stream, length, name, platform, shared, desc, resume):
+        checksum = hashlib.sha256()
+        # A first part at offset 0 makes the server drop what it had.
+        offset = 0
+        if resume:
+            offset = self.client.image_upload_status(name)
+            if length is None or offset > length:
+                offset = 0
+            # The checksum covers the whole image, so the part already
+            # sent is read again, locally.
+            while stream.tell() < offset:
+                checksum.update(stream.read(
+                    min(self.chunk_size, offset - stream.tell())))
+            if offset:
+                logger.info('Resuming %s at %d bytes.' % (name, offset))
+        progress = Progress(name, length, position=offset, quiet=self.quiet,
+                            verb='Uploading', done='sent')
+        # Bytes fed to the checksum, which a replayed part must not feed
+        # twice, and the end of what was read.
+        state = {'hashed': offset, 'read': offset}
+
+        def on_chunk(position, chunk):
+            state['read'] = position + len(chunk)
+            skip = max(0, state['hashed'] - position)
+            if skip < len(chunk):
+                checksum.update(chunk[skip:])
+                state['hashed'] = position + len(chunk)
+                progress.advance(len(chunk) - skip)
+
+        seekable = _seekable(stream)
+        while True:
+            # Each part starts where the server says it stopped, which
+            # after a failure may be short of what was read.
+            if seekable:
+                stream.seek(offset)
+            elif offset != state['read']:
+                raise SomeThingWrong(message='The server holds %d bytes of '
+                                     '%s, not the %d sent, and stdin cannot '
+                                     'be read again.' % (offset, name,
+                                                         state['read']))
+            body = MultipartBody({'exec': 'upload_img_part',
+                                  'img_name': name,
+                                  'offset': offset},
+                                 name, stream, offset, self.part_size,
+                                 self.chunk_size, on_chunk)
+            received = self._part(body, length)
+            if received == offset:
+                break
+            offset = received
+            if length is not None and offset >= length:
+                break
+        progress.finish()
+        return self.client.image_upload_commit(
+            name=name, platform=platform, shared=shared, desc=desc,
+            size=offset, checksum=checksum.hexdigest())
+
+    def _part(self, body, length):
+        attempt = 0
+        while True:
+            try:
+                return self.client.image_upload_part(body)
+            except Exception as e:
+                if length is None or attempt >= self.retries:
+                    raise
+                attempt += 1
+                logger.info('Retrying the part at %d after %s' % (
+                    body.offset, e))
+                # Go on from whatever the server kept.
+                received = self.client.image_upload_status(body.fields[
+                    'img_name'])
+                if received > body.offset:
+                    return received
+                body.started = False
+                body.stream.seek(body.offset)
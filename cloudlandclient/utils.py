@@ -10,41 +10,29 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import codecs
+import csv
+import fnmatch
 import hashlib
 import json
 import os
-from prettytable import PrettyTable
-import requests
 import sys
 
 
 from cloudlandclient.exc import SomeThingWrong
 
 
-def download(url):
-    filename = url.split('/')[-1]
-    res = requests.get(url, stream=True)
-    length = int(res.headers.get('content-length'))
-    position = 0
-    m = 1024 * 1024
-    previous = 0
-    current = 0
-    with open(filename, 'wb') as f:
-        for chunk in res.iter_content(chunk_size=4096):
-            if chunk:
-                f.write(chunk)
-                f.flush()
-                position = position + len(chunk)
-                current = position / m
-                if current > previous:
-                    sys.stdout.write(
-                        '\rDownloading %(filename)s, total %(length)sM,'
-                        ' received %(position)sM' %
-                        {'filename': filename,
-                         'position': position / m,
-                         'length': length / m})
-                    sys.stdout.flush()
-                    previous = current
+# requests, prettytable and the download engine are imported by the
+# functions that need them, keeping them off the CLI's startup path.
+
+def download(url, session=None, connections=4, filename=None,
+             checksum=None, force=False, quiet=False, timeout=(10, 60),
+             retry_policy=None):
+    from cloudlandclient.download import Downloader
+    return Downloader(session=session, connections=connections,
+                      quiet=quiet, timeout=timeout,
+                      retry_policy=retry_policy).fetch(
+                          url, filename, checksum=checksum, force=force)
 
 
 def loads(body):
@@ -55,6 +43,68 @@ def loads(body):
     return lines
 
 
+def iterloads(chunks):
+    '''Yield the rows of a list response body as its chunks arrive.
+
+    chunks is any iterable of bytes or text, such as a streamed
+    response's iter_content(). The trailing status is checked once the
+    closing bracket is read; a consumer that stops early skips the rest
+    of the body.
+    '''
+    # A list of chunks must not be read again after an error.
+    chunks = iter(chunks)
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    started = finished = False
+    last = _missing = object()
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            chunk = text.decode(chunk)
+        buf += chunk
+        pos = 0
+        while not finished:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buf):
+                break
+            if not started:
+                if buf[pos] != '[':
+                    # Not a list, such as the login page; report it whole.
+                    for chunk in chunks:
+                        if isinstance(chunk, bytes):
+                            chunk = text.decode(chunk)
+                        buf += chunk
+                    raise SomeThingWrong(message=buf)
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                finished = True
+                pos += 1
+                break
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                break
+            if end == len(buf) and not isinstance(value, str):
+                # A number may continue in the next chunk.
+                break
+            if last is not _missing:
+                yield last
+            last = value
+            pos = end
+        buf = buf[pos:]
+    if not finished:
+        raise SomeThingWrong(message='Truncated list response.')
+    if buf.strip():
+        raise SomeThingWrong(message=buf)
+    if last is _missing:
+        raise SomeThingWrong(message='Empty list response.')
+    if last != 0:
+        raise SomeThingWrong(message='List response status %s.' % last)
+
+
 def dumps(data):
     return json.dumps(data)
 
@@ -69,17 +119,168 @@ def cut(lines, delim='|', field=1):
 
 def pretty(head, body):
     if head and body:
-        x = PrettyTable(head.split('|'))
-        if body:
-            lines = loads(body)
-            for line in lines:
-                if line:
-                    try:
-                        x.add_row(line.split('|'))
-                    except Exception:
-                        print(body)
-                        raise
-        print(x)
+        pretty_lines(head, loads(body), body=body)
+
+
+def pretty_lines(head, lines, body=None):
+    from prettytable import PrettyTable
+    x = PrettyTable(head.split('|'))
+    for line in lines:
+        if line:
+            try:
+                x.add_row(line.split('|'))
+            except Exception:
+                print(body or line)
+                raise
+    print(x)
+
+
+# Output formats of list and show commands.
+FORMATS = ('table', 'json', 'ndjson', 'csv', 'value')
+
+
+def columns(head, fields=None):
+    '''Names and positions of the columns of head selected by fields.
+
+    fields is a comma separated list of column names in any case.
+    '''
+    names = head.split('|')
+    if not fields:
+        return names, list(range(len(names)))
+    upper = [name.upper() for name in names]
+    selected = []
+    for field in fields.split(','):
+        field = field.strip().upper()
+        if field not in upper:
+            raise SomeThingWrong(message='Unknown field %s, choose from %s.'
+                                 % (field.lower(), ', '.join(
+                                     name.lower() for name in names)))
+        selected.append(upper.index(field))
+    return [names[i] for i in selected], selected
+
+
+def _filter(head, expression):
+    '''Column position, value pattern and sense of a filter.
+
+    The filter is a field=value or field!=value expression.
+    '''
+    negate = '!=' in expression
+    field, sep, pattern = expression.partition('!=' if negate else '=')
+    if not sep or not field.strip():
+        raise SomeThingWrong(message='Bad filter %s, expected field=value '
+                             'or field!=value.' % expression)
+    return columns(head, field)[1][0], pattern.strip(), negate
+
+
+def _sort_key(value):
+    # Numeric columns, such as VXLAN and SIZE, sort as numbers.
+    if value.isdigit():
+        return (0, int(value), value)
+    return (1, 0, value)
+
+
+def query(head, filters=(), sort=None, limit=None):
+    '''A function filtering, sorting and limiting list rows.
+
+    It takes the rows of a list response with columns head and yields
+    those matching every filter, sorted and at most limit of them.
+    The arguments are checked at once. A filter is field=value or
+    field!=value, where value may hold the wildcards * and ?. sort is
+    a comma separated list of fields, each optionally suffixed by
+    :desc. Without sort, rows are filtered as they are read and
+    reading stops once limit of them matched.
+    '''
+    tests = [_filter(head, expression) for expression in filters or ()]
+    keys = []
+    for spec in (sort or '').split(','):
+        field, _, order = spec.strip().partition(':')
+        if not field:
+            continue
+        if order not in ('', 'asc', 'desc'):
+            raise SomeThingWrong(message='Bad sort order %s, expected asc '
+                                 'or desc.' % order)
+        keys.append((columns(head, field)[1][0], order == 'desc'))
+
+    def matches(cells):
+        for i, pattern, negate in tests:
+            value = cells[i] if i < len(cells) else ''
+            found = value == pattern or fnmatch.fnmatchcase(value, pattern)
+            if found == negate:
+                return False
+        return True
+
+    def apply(lines):
+        left = limit
+        if left is not None and left <= 0:
+            return
+        matched = []
+        for line in lines:
+            if not line:
+                continue
+            cells = line.split('|')
+            if not matches(cells):
+                continue
+            if keys:
+                matched.append(cells)
+                continue
+            yield line
+            if left is not None:
+                left -= 1
+                if left == 0:
+                    return
+        # Sort by the last key first; sorts are stable.
+        for i, reverse in reversed(keys):
+            matched.sort(key=lambda cells: _sort_key(
+                cells[i] if i < len(cells) else ''), reverse=reverse)
+        for cells in matched[:limit]:
+            yield '|'.join(cells)
+    return apply
+
+
+def select(head, lines, filters=(), sort=None, limit=None):
+    '''Rows of lines selected by the filters, sort and limit of query.'''
+    return query(head, filters, sort, limit)(lines)
+
+
+def output(head, lines, format='table', fields=None):
+    '''Print the rows of a list response in format, one of FORMATS.
+
+    Every format but table writes each row as it is read, so lines may
+    be a generator over a response still being downloaded.
+    '''
+    names, selected = columns(head, fields)
+
+    def rows():
+        for line in lines:
+            if line:
+                cells = line.split('|')
+                yield [cells[i] if i < len(cells) else '' for i in selected]
+    out = sys.stdout
+    if format == 'table':
+        pretty_lines('|'.join(names), ('|'.join(row) for row in rows()))
+    elif format == 'ndjson':
+        keys = [name.lower() for name in names]
+        for row in rows():
+            out.write(json.dumps(dict(zip(keys, row)), sort_keys=True) + '\n')
+    elif format == 'json':
+        keys = [name.lower() for name in names]
+        separator = '[\n'
+        for row in rows():
+            out.write(separator + json.dumps(dict(zip(keys, row)),
+                                             sort_keys=True))
+            separator = ',\n'
+        out.write('[]\n' if separator == '[\n' else '\n]\n')
+    elif format == 'csv':
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(names)
+        for row in rows():
+            writer.writerow(row)
+    elif format == 'value':
+        for row in rows():
+            out.write(' '.join(row) + '\n')
+    else:
+        raise SomeThingWrong(message='Unknown format %s.' % format)
+    out.flush()
 
 
 # Decorator for cli-args
@@ -94,6 +295,8 @@ def arg(*args, **kwargs):
 
 def sha1sum(data):
     if is_not_sha1sum(data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
         return hashlib.sha1(data).hexdigest()
     return data
 